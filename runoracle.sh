@@ -7,7 +7,7 @@ HOME="$DIR/.."
 
 if [ -z $(pgrep bitcoind) ]
 then
-    $HOME/bitcoin/bin/$(getconf LONG_BIT)/bitcoind -datadir=$HOME/.bitcoin/ -rpcport=2521 &
+    $HOME/bitcoin/bin/$(getconf LONG_BIT)/bitcoind -datadir=$HOME/.bitcoin/ -rpcport=2521 -blocknotify="pkill -USR1 -f [r]un_oracle.py" &
     sleep 2
 fi
 
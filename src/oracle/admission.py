@@ -0,0 +1,151 @@
+# Admission control for incoming fastcast requests
+#
+# Every request can trigger key generation, bitcoind calls and broadcasts,
+# so sources are rate limited before anything is parsed, and every round
+# admits at most max_per_round requests whatever their sources. Requests over
+# a limit are deferred to the pending_requests table (the fastcast cursor and
+# dedup index are already past them) and retried when they can be admitted
+# again (main loop wakes up for that, see retry_at), the rest is dropped.
+#
+# Known oracle peers (sources that advertised a body encoding recently, only
+# oracles do) aren't limited per source, their signing rounds come in bursts.
+# Over the round cap they're deferred, never dropped while there's room
+
+import logging
+import time
+
+# Sustained requests per second accepted from a single source
+SOURCE_RATE = 1.0
+# Requests a single source can send at once, also the limit of its deferred requests
+SOURCE_BURST = 20
+# Total number of deferred requests
+MAX_DEFERRED = 1000
+# Requests admitted by a single round, over that they wait for the next one
+MAX_ADMITTED_PER_ROUND = 100
+# Requests deferred by the round cap are retried after that long
+ROUND_DELAY = 1
+# Idle buckets are forgotten when we track more sources than that
+MAX_TRACKED_SOURCES = 10000
+
+class TokenBucket:
+  def __init__(self, rate, burst, now):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = float(burst)
+    self.updated = now
+
+  def refill(self, now):
+    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+  def take(self, now):
+    self.refill(now)
+    if self.tokens < 1:
+      return False
+    self.tokens -= 1
+    return True
+
+  def ready_at(self, now):
+    self.refill(now)
+    return now + max(0, (1 - self.tokens) / self.rate)
+
+  def idle(self, now):
+    self.refill(now)
+    return self.tokens >= self.burst
+
+
+class AdmissionControl:
+  def __init__(self, pending, rate=SOURCE_RATE, burst=SOURCE_BURST, max_deferred=MAX_DEFERRED,
+      max_per_round=MAX_ADMITTED_PER_ROUND, peers=None):
+    # PendingRequests table
+    self.pending = pending
+    self.rate = rate
+    self.burst = burst
+    self.max_deferred = max_deferred
+    self.max_per_round = max_per_round
+    # PeerEncodings, sources it knows aren't limited per source
+    self.peers = peers
+    self.buckets = {}
+    self.counters = {'admitted': 0, 'deferred': 0, 'dropped': 0}
+
+  def bucket(self, source, now):
+    if not source in self.buckets:
+      if len(self.buckets) >= MAX_TRACKED_SOURCES:
+        self.forget_idle(now)
+      self.buckets[source] = TokenBucket(self.rate, self.burst, now)
+    return self.buckets[source]
+
+  def forget_idle(self, now):
+    for source, bucket in self.buckets.items():
+      if bucket.idle(now):
+        del self.buckets[source]
+
+  def is_peer(self, source, now):
+    return self.peers is not None and self.peers.known(source, now)
+
+  def admit(self, requests, now=None):
+    """
+    Takes verified fastcast requests and returns those that can be handled
+    now: due deferred ones first, then the new ones, in order
+    """
+    if now is None:
+      now = time.time()
+
+    admitted = []
+
+    # Deferred requests keep their order, the rest of them waits for tokens
+    # or for the next round
+    taken = []
+    for pending in self.pending.get_due(now, self.max_deferred):
+      request = pending['request']
+      source = request['source']
+      if len(admitted) >= self.max_per_round:
+        self.pending.retry_later(pending, now + ROUND_DELAY)
+      elif pending['admitted'] or self.is_peer(source, now) or self.bucket(source, now).take(now):
+        admitted.append(request)
+        taken.append(pending)
+      else:
+        self.pending.retry_later(pending, self.bucket(source, now).ready_at(now))
+    self.pending.done_many(taken)
+
+    deferred = self.pending.count()
+    deferred_by_source = {}
+    for request in requests:
+      source = request['source']
+      peer = self.is_peer(source, now)
+      if len(admitted) < self.max_per_round and (peer or self.bucket(source, now).take(now)):
+        admitted.append(request)
+        continue
+
+      if not source in deferred_by_source:
+        deferred_by_source[source] = self.pending.count(source)
+
+      if deferred < self.max_deferred and (peer or deferred_by_source[source] < self.burst):
+        if len(admitted) >= self.max_per_round:
+          retry_at = now + ROUND_DELAY
+        else:
+          retry_at = self.bucket(source, now).ready_at(now)
+        self.pending.put(request, retry_at)
+        deferred += 1
+        deferred_by_source[source] += 1
+        self.counters['deferred'] += 1
+      else:
+        self.counters['dropped'] += 1
+
+    self.counters['admitted'] += len(admitted)
+    return admitted
+
+  def retry_at(self):
+    """
+    Earliest time a deferred request can be admitted, None if there are none
+    """
+    return self.pending.get_next_retry()
+
+  def stats(self):
+    stats = dict(self.counters)
+    stats['pending'] = self.pending.count()
+    stats['sources'] = len(self.buckets)
+    return stats
+
+  def log_stats(self):
+    logging.info('admission control: {}'.format(self.stats()))
@@ -0,0 +1,117 @@
+import Queue
+import logging
+import threading
+
+# Number of confirmations needed for block to get noticed by Oracle
+CONFIRMATIONS = 3
+
+# How long the fetcher waits after an error before trying again
+RETRY_TIME = 5
+
+# How often a fetcher waiting for room in the queue checks if it was closed
+PUT_CHECK_INTERVAL = 1
+
+def fetch_confirmed_block(btc, block_number):
+  """
+  Returns block with given number if it already has enough confirmations,
+  None otherwise
+  """
+  block_hash = btc.get_block_hash(block_number)
+  if not block_hash:
+    return None
+
+  block = btc.get_block(block_hash)
+
+  # We are waiting for enough confirmations
+  if block['confirmations'] < CONFIRMATIONS:
+    return None
+
+  return block
+
+def last_confirmed_block_number(btc):
+  return btc.get_block_count() - CONFIRMATIONS + 1
+
+
+class BlockFetcher(threading.Thread):
+  """
+  Fetches confirmed blocks one after another using its own bitcoind
+  client (btc.for_worker() of the oracle's one, jsonrpclib server can't be
+  shared between threads), staying at most `prefetch` blocks ahead of the
+  consumer. Blocks are handed over in order, committing them is up to the
+  consumer.
+
+  With `until` set it stops after that block (or on the first error), and
+  iterating over the fetcher yields the blocks. Otherwise it keeps following
+  the chain, waiting for notify_new_block or `interval` seconds between checks.
+  A consumer that stops early has to close() the fetcher, so it doesn't stay
+  blocked on the full queue
+  """
+  def __init__(self, btc, last_block_number, prefetch, until=None, wakeup=None, interval=None):
+    super(BlockFetcher, self).__init__(name='blocks')
+    self.daemon = True
+    self.btc = btc
+    self.next_block_number = last_block_number + 1
+    self.until = until
+    self.wakeup = wakeup
+    self.interval = interval
+    self.blocks = Queue.Queue(maxsize=prefetch)
+    self.block_notify = threading.Event()
+    self.closed = threading.Event()
+
+  def notify_new_block(self, *args):
+    self.block_notify.set()
+
+  def close(self):
+    self.closed.set()
+    self.block_notify.set()
+
+  def following(self):
+    return self.until is None
+
+  def put(self, block):
+    """
+    Waits for room in the queue, returns False if closed meanwhile
+    """
+    while not self.closed.is_set():
+      try:
+        self.blocks.put(block, timeout=PUT_CHECK_INTERVAL)
+        return True
+      except Queue.Full:
+        continue
+    return False
+
+  def run(self):
+    while self.following() or self.next_block_number <= self.until:
+      self.block_notify.clear()
+      # Checked after clear, so a close() meanwhile still cuts the wait short
+      if self.closed.is_set():
+        break
+      try:
+        block = fetch_confirmed_block(self.btc, self.next_block_number)
+      except:
+        logging.exception('error fetching block {}'.format(self.next_block_number))
+        if not self.following():
+          break
+        self.closed.wait(RETRY_TIME)
+        continue
+
+      if not block:
+        if not self.following():
+          break
+        self.block_notify.wait(self.interval)
+        continue
+
+      if not self.put(block):
+        return
+      if self.wakeup:
+        self.wakeup.set()
+      self.next_block_number += 1
+
+    self.put(None)
+
+  def __iter__(self):
+    while True:
+      block = self.blocks.get()
+      if block is None:
+        return
+      yield block
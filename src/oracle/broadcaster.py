@@ -0,0 +1,125 @@
+# Outbound fastcast broadcasts
+#
+# Handlers only queue their broadcasts in the outbox table, a background
+# thread sends them over its own database connection and retries failed
+# ones with exponential backoff, so handlers never wait on the gateway.
+# The outbox survives restarts, queued messages are sent on the next run
+
+from oracle_db import OracleDb, Outbox, KeyValue
+from shared.body_codec import COMPACT_VERSION, advertise, encode_body
+from shared.fastproto import broadcastMessage
+
+import json
+import logging
+import threading
+import time
+
+# How many due messages are read from the outbox at once
+OUTBOX_BATCH_SIZE = 50
+# Shards can't notify the sender, so it checks the outbox at least that often
+OUTBOX_POLL_INTERVAL = 1
+# Backoff between attempts to send a message, doubles after each failure
+RETRY_MIN_DELAY = 2
+RETRY_MAX_DELAY = 5 * 60
+
+def coalescing_for(body):
+  """
+  Returns (coalesce_key, rank) for a broadcast. Every sign broadcast carries
+  all signatures collected so far, so only the one with the most signatures
+  per pwtxid is worth sending
+  """
+  try:
+    message = json.loads(body)
+  except ValueError:
+    return None, 0
+
+  if not isinstance(message, dict):
+    return None, 0
+
+  if message.get('operation') == 'sign' and 'pwtxid' in message:
+    return 'sign:{}'.format(message['pwtxid']), int(message.get('sigs', 0))
+
+  return None, 0
+
+
+class BroadcastSender(threading.Thread):
+  def __init__(self, interval=OUTBOX_POLL_INTERVAL, compact=False, peers=None):
+    super(BroadcastSender, self).__init__(name='broadcast')
+    self.daemon = True
+    self.interval = interval
+    # Outbox keeps JSON, bodies are re-encoded right before sending. With
+    # compact allowed, they're compact once all peers (a PeerEncodings)
+    # advertised they read it
+    self.compact = compact
+    self.peers = peers
+    self.notified = threading.Event()
+
+  def notify(self):
+    self.notified.set()
+
+  def run(self):
+    db = OracleDb()
+    outbox = Outbox(db)
+
+    keys = None
+
+    while True:
+      self.notified.clear()
+
+      try:
+        if keys is None:
+          # Oracle creates the keypair before any broadcast can be queued
+          data = KeyValue(db).get_by_section_key('fastcast', 'address')
+          keys = data['pub'], data['priv']
+        timeout = self.send_due(outbox, *keys)
+      except:
+        # e.g. the database is locked by a handler, messages stay queued
+        logging.exception('error sending the outbox, retrying in {}s'.format(RETRY_MIN_DELAY))
+        time.sleep(RETRY_MIN_DELAY)
+        continue
+
+      self.notified.wait(timeout)
+
+  def send_due(self, outbox, pub, priv):
+    """
+    Sends a batch of due messages, returns how long to wait for the next one
+    """
+    messages = outbox.get_due(OUTBOX_BATCH_SIZE)
+    for message in messages:
+      self.send(outbox, message, pub, priv)
+
+    if len(messages) == OUTBOX_BATCH_SIZE:
+      return 0
+
+    timeout = self.interval
+    next_attempt = outbox.get_next_attempt()
+    if next_attempt is not None:
+      timeout = max(0, min(timeout, next_attempt - time.time()))
+    return timeout
+
+  def use_compact(self, pub):
+    if not self.compact or self.peers is None:
+      return False
+    return self.peers.common_version(ignore=pub) >= COMPACT_VERSION
+
+  def encode(self, body, pub):
+    try:
+      obj = json.loads(body)
+    except ValueError:
+      return body
+
+    if not isinstance(obj, dict):
+      return body
+    return encode_body(advertise(obj), compact=self.use_compact(pub))
+
+  def send(self, outbox, message, pub, priv):
+    try:
+      body = self.encode(message['body'], pub)
+      broadcastMessage(body, pub, priv)
+    except:
+      delay = min(RETRY_MAX_DELAY, RETRY_MIN_DELAY * 2 ** message['attempts'])
+      logging.exception('error broadcasting message {}, retrying in {}s'.format(message['id'], delay))
+      outbox.retry_later(message, delay)
+      return
+
+    outbox.sent(message)
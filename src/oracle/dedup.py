@@ -0,0 +1,172 @@
+# Duplicate message index for fastcast intake
+#
+# The gateway can return the same message more than once (pages overlapping,
+# polls within the same epoch second, replays), so every message is checked
+# against recently seen signature digests before it's parsed. Recent digests
+# are kept in memory, older ones in a rotating Bloom filter persisted in
+# KeyValue, so the index survives restarts and stays bounded. The filter is
+# saved periodically rather than on every poll, it's a few dozen KB
+
+from shared.lru_cache import LRUCache
+
+import base64
+import hashlib
+import math
+import struct
+import time
+
+# Digests kept in memory, checked before the Bloom filter
+DEDUP_RECENT_SIZE = 5000
+# Messages per Bloom filter generation, two generations are kept
+DEDUP_GENERATION_CAPACITY = 10000
+# False positive rate of a single generation at full capacity
+DEDUP_ERROR_RATE = 0.001
+# The Bloom filter is written to KeyValue after that many new messages or
+# seconds, whichever comes first, and right after a rotation. Messages
+# seen since the last save can only be handled twice after a crash if
+# they're from the last epoch second, older ones are dropped by epoch
+DEDUP_SAVE_EVERY = 500
+DEDUP_SAVE_INTERVAL = 60
+
+def message_key(request):
+  """
+  Digest identifying a fastcast message. Signature covers the body and is
+  unique per message, unsigned messages fall back to source and body
+  """
+  signature = request.get('signature')
+  if signature:
+    return hashlib.sha256(signature).hexdigest()
+  return hashlib.sha256('{}\n{}'.format(request.get('source'), request.get('body'))).hexdigest()
+
+
+class BloomFilter:
+  def __init__(self, capacity, error_rate, bits=None, count=0):
+    self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+    self.bits = bits or bytearray((self.size + 7) / 8)
+    self.count = count
+
+  def positions(self, key):
+    # Double hashing, k positions out of two 64-bit halves of one digest
+    h1, h2 = struct.unpack('<QQ', hashlib.sha256(key).digest()[:16])
+    return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+  def add(self, key):
+    for position in self.positions(key):
+      self.bits[position / 8] |= 1 << (position % 8)
+    self.count += 1
+
+  def __contains__(self, key):
+    for position in self.positions(key):
+      if not self.bits[position / 8] & (1 << (position % 8)):
+        return False
+    return True
+
+  def dump(self):
+    return {'bits': base64.b64encode(str(self.bits)), 'count': self.count}
+
+  @classmethod
+  def load(cls, data, capacity, error_rate):
+    bits = bytearray(base64.b64decode(data['bits']))
+    bloom = cls(capacity, error_rate, bits, data['count'])
+    if len(bits) * 8 < bloom.size:
+      # Parameters changed since it was saved
+      return cls(capacity, error_rate)
+    return bloom
+
+
+class RotatingBloomFilter:
+  """
+  Two Bloom filter generations, when the current one is full the previous
+  one is dropped. Keys are remembered for at least one full generation
+  """
+  def __init__(self, capacity=DEDUP_GENERATION_CAPACITY, error_rate=DEDUP_ERROR_RATE):
+    self.capacity = capacity
+    self.error_rate = error_rate
+    self.current = BloomFilter(capacity, error_rate)
+    self.previous = BloomFilter(capacity, error_rate)
+
+  def add(self, key):
+    """
+    Returns True if a generation was dropped to make room
+    """
+    rotated = False
+    if self.current.count >= self.capacity:
+      self.previous = self.current
+      self.current = BloomFilter(self.capacity, self.error_rate)
+      rotated = True
+    self.current.add(key)
+    return rotated
+
+  def __contains__(self, key):
+    return key in self.current or key in self.previous
+
+  def dump(self):
+    return {'current': self.current.dump(), 'previous': self.previous.dump()}
+
+  def load(self, data):
+    self.current = BloomFilter.load(data['current'], self.capacity, self.error_rate)
+    self.previous = BloomFilter.load(data['previous'], self.capacity, self.error_rate)
+
+
+class DedupIndex:
+  def __init__(self, kv, recent_size=DEDUP_RECENT_SIZE,
+      save_every=DEDUP_SAVE_EVERY, save_interval=DEDUP_SAVE_INTERVAL):
+    self.kv = kv
+    self.recent = LRUCache(recent_size)
+    self.bloom = RotatingBloomFilter()
+    self.save_every = save_every
+    self.save_interval = save_interval
+    # Keys added since the last save
+    self.unsaved = 0
+    self.rotated = False
+    self.saved_at = time.time()
+
+    data = kv.get_by_section_key('fastcast', 'dedup')
+    self.stored = data is not None
+    if data:
+      self.bloom.load(data)
+
+  def check_and_add(self, request):
+    """
+    Returns True if request wasn't seen before, and remembers it
+    """
+    key = message_key(request)
+    if self.recent.get(key) or key in self.bloom:
+      return False
+
+    self.recent.put(key, True)
+    if self.bloom.add(key):
+      self.rotated = True
+    self.unsaved += 1
+    return True
+
+  def save(self, now=None):
+    """
+    Writes the Bloom filter if it rotated, or enough keys or time piled up
+    since the last save
+    """
+    if not self.unsaved:
+      return
+    if now is None:
+      now = time.time()
+
+    if self.rotated or self.unsaved >= self.save_every or now - self.saved_at >= self.save_interval:
+      self.flush(now)
+
+  def flush(self, now=None):
+    """
+    Writes the Bloom filter if anything was added since the last save,
+    e.g. at shutdown
+    """
+    if not self.unsaved:
+      return
+
+    if self.stored:
+      self.kv.update('fastcast', 'dedup', self.bloom.dump())
+    else:
+      self.kv.store('fastcast', 'dedup', self.bloom.dump())
+      self.stored = True
+    self.unsaved = 0
+    self.rotated = False
+    self.saved_at = now or time.time()
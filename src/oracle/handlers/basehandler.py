@@ -1,4 +1,6 @@
 
+from shared.bitcoind_client.transaction import decode_transaction
+
 import json
 import hashlib
 
@@ -14,6 +16,14 @@ class BaseHandler:
     self.btc = oracle.btc
     getcontext().prec=8
 
+  def start(self):
+    # Called once the handler is registered, before it gets any work
+    return
+
+  def stop(self):
+    # Called when the oracle shuts down
+    return
+
   def handle_request(self, request):
     raise NotImplementedError()
 
@@ -27,6 +37,24 @@ class BaseHandler:
   def valid_task(self, task):
   	return True
 
+  def request_key(self, message):
+    # Requests and tasks sharing a key are never handled concurrently by
+    # the worker pool. None serializes them with all the other keyless ones
+    return None
+
+  def task_key(self, task):
+    return None
+
+  def spent_outputs_key(self, tx):
+    """
+    Worker key of a transaction, the outputs it spends. Decoded locally,
+    so dispatching doesn't wait on bitcoind. Transactions spending the
+    same outputs are handled one at a time
+    """
+    vin = decode_transaction(tx)['vin']
+    outpoints = sorted('{}:{}'.format(tx_input['txid'], tx_input['vout']) for tx_input in vin)
+    return hashlib.sha256(json.dumps(outpoints)).hexdigest()
+
   def get_tx_hash(self, tx):
     inputs, outputs = self.btc.get_inputs_outputs(tx)
     request_dict= {
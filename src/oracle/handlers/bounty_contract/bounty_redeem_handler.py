@@ -61,6 +61,12 @@ class GuessPasswordHandler(BaseHandler):
     message = json.loads(message)
     return message['address']
 
+  def request_key(self, message):
+    return message['pwtxid']
+
+  def task_key(self, task):
+    return json.loads(task['json_data'])['pwtxid']
+
   def handle_request(self, request):
     message = request.message
 
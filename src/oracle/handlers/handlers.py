@@ -25,3 +25,35 @@ OPERATION_REQUIRED_FIELDS = {
 
 PROTOCOL_VERSION = '0.12'
 
+
+class HandlerRegistry:
+  """
+  Keeps one long-lived instance of every handler, so handler construction
+  (KeyValue tables etc.) is paid once per oracle instead of per message,
+  task and block
+  """
+  def __init__(self, oracle, handler_classes=op_handlers):
+    self.oracle = oracle
+    self.handler_classes = handler_classes
+    self.instances = {}
+
+  def start(self):
+    for operation, handler_class in self.handler_classes.iteritems():
+      handler = handler_class(self.oracle)
+      handler.start()
+      self.instances[operation] = handler
+
+  def stop(self):
+    for handler in self.instances.itervalues():
+      handler.stop()
+    self.instances = {}
+
+  def __contains__(self, operation):
+    return operation in self.instances
+
+  def __getitem__(self, operation):
+    return self.instances[operation]
+
+  def itervalues(self):
+    return self.instances.itervalues()
+
@@ -18,10 +18,8 @@ class LockedPasswordTransaction(TableDb):
   mark_done_sql = 'update {0} set done=1 where pwtxid=?'
 
   def mark_as_done(self, pwtxid):
-    cursor = self.db.get_cursor()
     sql = self.mark_done_sql.format(self.table_name)
-
-    cursor.execute(sql, (pwtxid,))
+    self.execute_sql_properly(sql, (pwtxid,))
 
   def args_for_obj(self, obj):
     return [obj['pwtxid'], obj['json_data']]
@@ -3,6 +3,7 @@ from basehandler import BaseHandler
 import json
 import cjson
 import logging
+import multiprocessing
 import time
 import datetime
 
@@ -13,6 +14,10 @@ TIME_FOR_TRANSACTION = 30 * 60
 TIME_FOR_CONFIRMATION = 20 * 60
 NUMBER_OF_CONFIRMATIONS = 3
 
+# Observed addresses are shared by all contracts, so worker pool keys don't
+# protect them. Created on import, so forked shards share it too
+observed_addresses_lock = multiprocessing.Lock()
+
 class SafeTimelockCreateHandler(BaseHandler):
   def __init__(self, oracle):
     self.oracle = oracle
@@ -44,6 +49,10 @@ class SafeTimelockCreateHandler(BaseHandler):
     logging.info("claimed mark {} for addr {}".format(mark, return_address))
 
   def extend_observed_addresses(self, address):
+    with observed_addresses_lock:
+      self.add_observed_address(address)
+
+  def add_observed_address(self, address):
     observed_addresses = self.kv.get_by_section_key('safe_timelock', 'addresses')
     if not observed_addresses:
       self.kv.store('safe_timelock', 'addresses', {'addresses':[]})
@@ -64,6 +73,12 @@ class SafeTimelockCreateHandler(BaseHandler):
       # Already saved
       pass
 
+  def request_key(self, message):
+    return self.oracle.btc.multisig_address(message['req_sigs'], message['pubkey_list'])
+
+  def task_key(self, task):
+    return json.loads(task['json_data'])['address']
+
   def handle_request(self, request):
     message = request.message
 
@@ -93,7 +108,8 @@ class SafeTimelockCreateHandler(BaseHandler):
       self.oracle.broadcast_with_fastcast(json.dumps(reply_msg))
       return
 
-    # For now oracles are running single-thread so there is no race condition
+    # Worker pool handles requests for the same address one at a time (see
+    # request_key), so there is no race condition between check and claim
     self.claim_mark(mark, address_to_pay_on, return_address, locktime, oracle_fees, miners_fee_satoshi, req_sigs)
 
     reply_msg = { 'operation' : 'safe_timelock_created',
@@ -16,6 +16,9 @@ class TimelockMarkReleaseHandler(BaseHandler):
     self.btc = oracle.btc
     self.kv = KeyValue(self.oracle.db)
 
+  def task_key(self, task):
+    return json.loads(task['json_data'])['address']
+
   def handle_task(self, task):
     data = json.loads(task['json_data'])
 
@@ -83,13 +86,23 @@ class TimelockMarkReleaseHandler(BaseHandler):
 
     our_addresses = our_addresses['addresses']
 
-    outputs = []
-    for tx in transaction_ids:
+    # One batch request for the whole block instead of a call per transaction.
+    # Decoding goes through the shared cache, locally with LOCAL_DECODING
+    with self.btc.batch() as batch:
+      raw_futures = [(tx, batch.getrawtransaction(tx)) for tx in transaction_ids]
+
+    raw_transactions = []
+    for tx, future in raw_futures:
       try:
-        raw_transaction = self.btc.get_raw_transaction(tx)
+        raw_transactions.append((tx, future.result()))
       except ProtocolError:
         continue
-      transaction = self.btc.decode_raw_transaction(raw_transaction)
+    decoded = self.btc.decoded_transactions([raw_transaction for tx, raw_transaction in raw_transactions])
+
+    outputs = []
+    for (tx, raw_transaction), transaction in zip(raw_transactions, decoded):
+      if transaction is None:
+        continue
       for vout in transaction['vout']:
         if not 'addresses' in vout['scriptPubKey']:
           continue
@@ -99,6 +112,11 @@ class TimelockMarkReleaseHandler(BaseHandler):
           outputs.append((value_to_mark(vout['value']), vout['scriptPubKey']['addresses'][0], vout['value'], tx, vout['n']))
 
     for output in outputs:
-      self.verify_and_create_timelock(output)
+      if self.oracle.worker_pool:
+        # Keyed by address like the requests and tasks updating its marks,
+        # so they're never handled concurrently
+        self.oracle.worker_pool.submit(output[1], 'handle_block_output', 'timelock_mark_release', output)
+      else:
+        self.verify_and_create_timelock(output)
 
 
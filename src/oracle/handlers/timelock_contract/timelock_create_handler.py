@@ -12,6 +12,13 @@ class TimelockCreateHandler(BaseHandler):
     self.btc = oracle.btc
 
 
+  def request_key(self, message):
+    # pwtxid is the multisig address
+    return self.oracle.btc.multisig_address(message['req_sigs'], message['pubkey_list'])
+
+  def task_key(self, task):
+    return json.loads(task['json_data'])['pwtxid']
+
   def handle_request(self, request):
     message = request.message
 
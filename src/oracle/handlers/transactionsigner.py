@@ -31,12 +31,7 @@ class TransactionSigner(BaseHandler):
 
   def get_my_turn(self, redeem_script):
     # oracles sign transactions based on the order of their signatures
-
-    addresses = sorted(self.btc.decode_script(redeem_script)['addresses'])
-    for idx, addr in enumerate(addresses):
-      if self.btc.address_is_mine(addr):
-        return idx
-    return -1
+    return self.btc.get_my_turn(redeem_script)
 
 
   def is_proper_transaction(self, tx, prevtxs):
@@ -151,6 +146,13 @@ class TransactionSigner(BaseHandler):
     rq_data['sigs_so_far'] = tx_sigs_count
     self.kv.update('signable', rq_hash, rq_data)
 
+  def request_key(self, message):
+    return self.spent_outputs_key(message['transaction'])
+
+  def task_key(self, task):
+    message = json.loads(task['json_data'])
+    return self.spent_outputs_key(message['transaction'])
+
   def handle_request(self, request):
     body = request.message
     # if the oracle received a transaction from fastcast, it attempts to sign it
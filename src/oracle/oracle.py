@@ -1,21 +1,33 @@
 # Main Oracle file
 
-from oracle_db import OracleDb, TaskQueue, KeyValue
-from handlers.handlers import op_handlers
+from oracle_db import OracleDb, TaskQueue, KeyValue, Outbox, PendingRequests
+from admission import AdmissionControl
+from broadcaster import BroadcastSender, coalescing_for
+from dedup import DedupIndex
+from block_fetcher import (
+    CONFIRMATIONS,
+    RETRY_TIME,
+    BlockFetcher,
+    fetch_confirmed_block,
+    last_confirmed_block_number)
+from handlers.handlers import HandlerRegistry
 
 from settings_local import ORACLE_ADDRESS, ORACLE_FEE
-from shared.bitcoind_client.bitcoinclient import BitcoinClient
+from shared.bitcoind_client.bitcoinclient import (
+    BitcoinClient,
+    BitcoindUnavailable,
+    decoded_cache_stats)
+from shared.body_codec import PeerEncodings, decode_body
 from shared.fastproto import(
     generateKey,
-    broadcastMessage,
     getMessages)
 
-import json
-
-from handlers.transactionsigner import TransactionSigner
+import copy
 
 import time
+import signal
 import logging
+import threading
 
 from decimal import Decimal
 
@@ -24,8 +36,12 @@ HEURISTIC_ADD_TIME = 60 * 3
 
 class FastcastMessage:
   def __init__(self, req):
-    body = json.loads(req['body'])
+    # Parsed once here, body can be JSON or compact
+    body = decode_body(req['body'])
+    self.body = body
 
+    # Raw request, to put it back if it can't be handled now
+    self.request = req
     self.from_address = req['source']
     self.received_time = int(req['epoch'])
     if 'message_id' in body:
@@ -40,23 +56,42 @@ class FastcastMessage:
 class MissingOperationError(Exception):
   pass
 
-# Number of confirmations needed for block to get noticed by Oracle
-CONFIRMATIONS = 3
+# Fastcast gateway has no push channel, so it still has to be polled
+FASTCAST_POLL_INTERVAL = 1
+
+# bitcoind wakes us up through -blocknotify (see runoracle.sh), polling
+# is only a fallback in case the notification is not configured
+BLOCK_POLL_INTERVAL = 60
+
+# Signal sent by bitcoind's -blocknotify command
+BLOCK_NOTIFY_SIGNAL = signal.SIGUSR1
+# The signal handler only sets a flag, waits are cut into slices this long
+# so the main loop notices it
+SIGNAL_POLL_INTERVAL = 0.5
+
+# How many blocks are fetched ahead while handlers process the current one
+BLOCK_PREFETCH = 10
+
+# How many due tasks are claimed from the queue at once
+# (sqlite allows up to 999 parameters in done_many)
+TASK_BATCH_SIZE = 100
 
 class FastcastProtocolError(Exception):
   pass
 
 class Oracle:
-  def __init__(self):
+  def __init__(self, btc=None):
 
     self.db = OracleDb()
-    self.btc = BitcoinClient()
+    # A PooledBitcoinClient is shared with the workers
+    self.btc = btc or BitcoinClient()
     self.kv = KeyValue(self.db)
 
     self.task_queue = TaskQueue(self.db)
+    self.outbox = Outbox(self.db)
+    self.pending = PendingRequests(self.db)
 
-    self.handlers = op_handlers
-    self.signer = TransactionSigner(self)
+    self.start_handlers()
 
     last_received = self.kv.get_by_section_key('fastcast', 'last_epoch')
     if not last_received:
@@ -64,6 +99,51 @@ class Oracle:
 
     self.set_fastcast_address()
 
+    self.dedup = DedupIndex(self.kv)
+    # Sources advertising a compact version are oracles, admission control
+    # doesn't limit them per source
+    self.peer_encodings = PeerEncodings()
+    self.admission = AdmissionControl(self.pending, peers=self.peer_encodings)
+
+    # Set whenever something happens that the main loop should react to
+    # before its scheduled wakeup
+    self.wakeup = threading.Event()
+    # Set by the -blocknotify signal handler
+    self.block_notified = False
+    self.next_fastcast_poll = 0
+    self.next_block_check = 0
+
+    # BroadcastSender draining the outbox, set when the oracle runs
+    self.broadcaster = None
+    # Allow broadcasts in the compact body encoding, they're still JSON
+    # until all peers advertised they read it
+    self.compact_bodies = False
+
+    # Optional KeyedWorkerPool or ShardPool, requests and tasks are then
+    # handled in parallel
+    self.worker_pool = None
+
+  def start_handlers(self):
+    self.handlers = HandlerRegistry(self)
+    self.handlers.start()
+    self.signer = self.handlers['sign']
+
+  def clone_for_worker(self):
+    """
+    Returns a copy of the oracle with its own database connection and
+    bitcoind client, has to be called from the thread that will use it
+    """
+    worker = copy.copy(self)
+    worker.db = OracleDb()
+    worker.btc = self.btc.for_worker()
+    worker.kv = KeyValue(worker.db)
+    worker.task_queue = TaskQueue(worker.db)
+    worker.outbox = Outbox(worker.db)
+    worker.pending = PendingRequests(worker.db)
+    worker.worker_pool = None
+    worker.start_handlers()
+    return worker
+
   def set_fastcast_address(self):
     if self.kv.exists('fastcast', 'address'):
       return
@@ -72,11 +152,23 @@ class Oracle:
     self.kv.store('fastcast', 'address', {"pub": pub, "priv": priv})
 
   def broadcast_with_fastcast(self, message):
-    data = self.kv.get_by_section_key('fastcast', 'address')
-    pub = data['pub']
-    priv = data['priv']
+    """
+    Queues message in the outbox, it's sent by the broadcaster thread
+    """
+    coalesce_key, rank = coalescing_for(message)
+    if not self.outbox.put(message, coalesce_key, rank):
+      logging.debug('broadcast superseded by a queued one: {}'.format(coalesce_key))
+      return
+
+    if self.broadcaster:
+      self.broadcaster.notify()
 
-    broadcastMessage(message, pub, priv)
+  def request_key(self, operation, message):
+    try:
+      return self.handlers[operation].request_key(message.body)
+    except:
+      logging.exception('failed to get request key')
+      return None
 
   def handle_request(self, request):
     logging.debug(request)
@@ -86,13 +178,23 @@ class Oracle:
       logging.debug("operation {} not supported".format(operation))
       return
 
+    if self.worker_pool:
+      key = self.request_key(operation, message)
+      self.worker_pool.submit(key, 'handle_request', request)
+      return
+
     handler = self.handlers[operation]
 
     try:
-      message.message = json.loads(message.message)
+      message.message = message.body
       if 'message_id' in message.message:
         logging.info('parsing message_id: %r' % message.message['message_id'])
-      handler(self).handle_request(message)
+      handler.handle_request(message)
+    except BitcoindUnavailable as e:
+      # Fastcast cursor and dedup index are past it already
+      logging.warning('{}, request retried in {}s'.format(e, RETRY_TIME))
+      self.pending.put(message.request, time.time() + RETRY_TIME, admitted=True)
+      return
     except:
       logging.debug(message)
       logging.exception('error handling the request')
@@ -137,37 +239,19 @@ class Oracle:
 
     newer_block = last_block_number + 1
 
-    block_hash = self.btc.get_block_hash(newer_block)
-    if not block_hash:
-      return None
-
-    block = self.btc.get_block(block_hash)
-
-    # We are waiting for enough confirmations
-    if block['confirmations'] < CONFIRMATIONS:
-      return None
-
-    logging.info("New block {}".format(newer_block))
-    return block
+    return fetch_confirmed_block(self.btc, newer_block)
 
   def handle_task(self, task):
     operation = task['operation']
 
     assert(operation in self.handlers)
     handler = self.handlers[operation]
-    handler(self).handle_task(task)
+    handler.handle_task(task)
 
-    operation = task['operation']
-    handler = self.handlers[operation]
-    if handler:
-      if handler(self).valid_task(task):
-        return task
-      else:
-        logging.debug('Task marked as invalid by handler')
-        self.task_queue.done(task)
-        return None
+    if handler.valid_task(task):
+      return task
     else:
-      logging.debug("Task has invalid operation")
+      logging.debug('Task marked as invalid by handler')
       self.task_queue.done(task)
       return None
 
@@ -184,7 +268,7 @@ class Oracle:
     except:
       raise FastcastProtocolError()
 
-    msg_body = json.loads(fmsg.message)
+    msg_body = fmsg.body
 
     if not 'operation' in msg_body:
       raise MissingOperationError()
@@ -193,30 +277,198 @@ class Oracle:
     return (operation, fmsg)
 
   def filter_requests(self, old_req):
+    """
+    Drops messages older than the last epoch and duplicates. Messages from
+    the last epoch second itself are kept, dedup index drops those already
+    handled
+    """
     new_req = []
 
-    last_received = self.kv.get_by_section_key('fastcast','last_epoch')['last']
+    last_received = self.get_last_epoch()
 
     max_received = last_received
 
     for r in old_req:
       received_epoch = int(r['epoch'])
-      if received_epoch > last_received:
+      if received_epoch >= last_received and self.dedup.check_and_add(r):
         new_req.append(r)
         max_received = max(max_received, received_epoch)
 
-    if len(new_req) > 0:
+    # Periodic, also catches up on messages from previous polls
+    self.dedup.save()
+    if max_received > last_received:
       self.kv.update('fastcast', 'last_epoch', {'last':max_received})
 
     return new_req
 
-  def run(self):
+  def notify_new_block(self, *args):
+    # Signal handler, it can interrupt the main thread while it holds
+    # a lock (e.g. in wakeup.set), so it must not take any
+    self.block_notified = True
+
+  def take_block_notification(self):
+    if not self.block_notified:
+      return False
+    self.block_notified = False
+    return True
+
+  def get_last_epoch(self):
+    return self.kv.get_by_section_key('fastcast', 'last_epoch')['last']
+
+  def process_messages(self):
+    requests = getMessages(since_epoch=self.get_last_epoch())
+    self.handle_messages(requests['results'])
+
+  def handle_messages(self, requests):
+    # Proceed all requests
+    requests = self.filter_requests(requests)
+
+    # Per-source rate limiting, before anything gets parsed
+    rejected_before = self.admission.counters['deferred'] + self.admission.counters['dropped']
+    requests = self.admission.admit(requests)
+    if self.admission.counters['deferred'] + self.admission.counters['dropped'] > rejected_before:
+      self.admission.log_stats()
+
+    prepared_requests = []
+    for prev_request in requests:
+      try:
+        request = self.prepare_request(prev_request)
+      except MissingOperationError:
+        logging.info('message doesn\'t have operation field, invalid')
+        logging.info(prev_request)
+        continue
+      except FastcastProtocolError:
+        logging.info('message does not have all required fields')
+        logging.info(prev_request)
+        continue
+      self.peer_encodings.seen(request[1].from_address, request[1].body)
+      prepared_requests.append(request)
+
+    # Signing rounds between oracles are time sensitive, they go first
+    # (sort is stable, so the order is kept otherwise)
+    prepared_requests.sort(key=lambda request: request[0] != 'sign')
+
+    for request in prepared_requests:
+      self.handle_request(request)
+
+  def handle_deferred(self):
+    """
+    Handles deferred requests whose sources got tokens again, also when
+    no new messages arrived
+    """
+    retry_at = self.admission.retry_at()
+    if retry_at is not None and retry_at <= time.time():
+      self.handle_messages([])
+
+  def task_key(self, task):
+    try:
+      return self.handlers[task['operation']].task_key(task)
+    except:
+      logging.exception('failed to get task key')
+      return None
+
+  def run_task(self, task):
+    # If the handler fails, the task is retried when its lease expires
+    self.handle_task(task)
+    self.task_queue.done(task)
 
+  def dispatch_tasks(self, tasks):
+    for task in tasks:
+      key = self.task_key(task)
+      self.worker_pool.submit(key, 'run_task', task)
+
+  def handle_tasks(self, tasks):
+    handled = []
+    try:
+      for task in tasks:
+        self.handle_task(task)
+        handled.append(task)
+    finally:
+      self.task_queue.done_many(handled)
+
+  def process_tasks(self):
+    while True:
+      tasks = self.task_queue.claim_tasks(TASK_BATCH_SIZE)
+
+      if self.worker_pool:
+        self.dispatch_tasks(tasks)
+      else:
+        self.handle_tasks(tasks)
+
+      if len(tasks) < TASK_BATCH_SIZE:
+        return
+
+  def process_new_blocks(self):
+    """
+    Handles all confirmed blocks up to the tip back to back. Next blocks
+    are fetched in background while handlers work on the current one
+    """
+    last_block_number = self.get_last_block_number()
+    if last_block_number == 0:
+      last_block_number = self.set_last_block()
+
+    until = last_confirmed_block_number(self.btc)
+    if until <= last_block_number:
+      return
+
+    fetcher = None
+    if until == last_block_number + 1:
+      # Nothing to pipeline
+      blocks = [self.get_new_block()]
+    else:
+      logging.info("catching up blocks {} - {}".format(last_block_number + 1, until))
+      fetcher = BlockFetcher(self.btc.for_worker(), last_block_number, BLOCK_PREFETCH, until=until)
+      fetcher.start()
+      blocks = fetcher
+
+    try:
+      for block in blocks:
+        if not block:
+          break
+        logging.info("New block {}".format(block['height']))
+        # Commits last_block_number, so we can resume after every block
+        self.handle_new_block(block)
+    finally:
+      # Handler errors leave the rest of the blocks for the next check
+      if fetcher:
+        fetcher.close()
+
+  def handle_new_block(self, new_block):
+    # Every available handler should get a chance to handle new block
+    for h in self.handlers.itervalues():
+      h.handle_new_block(new_block)
+    KeyValue(self.db).update('blocks', 'last_block_number', {'last_block':new_block['height']})
+    logging.debug('decoded transaction cache: {}'.format(decoded_cache_stats()))
+
+  def handle_block_output(self, operation, output):
+    # Worker job, handlers submit outputs of a new block under their
+    # address key
+    self.handlers[operation].verify_and_create_timelock(output)
+
+  def wait_for_wakeup(self, wake_at):
+    """
+    Sleeps until wake_at, the next scheduled task or an explicit wakeup
+    (e.g. block notification), whichever comes first
+    """
+    next_check = self.task_queue.get_next_check()
+    if next_check is not None:
+      wake_at = min(wake_at, next_check)
+
+    retry_at = self.admission.retry_at()
+    if retry_at is not None:
+      wake_at = min(wake_at, retry_at)
+
+    while not self.block_notified:
+      timeout = wake_at - time.time()
+      if timeout <= 0 or self.wakeup.wait(min(timeout, SIGNAL_POLL_INTERVAL)):
+        return
+
+  def set_oracle_address(self):
     if not ORACLE_ADDRESS:
       self.oracle_address = self.kv.get_by_section_key('config','ORACLE_ADDRESS')
 
       if self.oracle_address is None:
-        new_addr = self.btc.server.getnewaddress()
+        new_addr = self.btc.get_new_address()
         self.oracle_address = new_addr
         logging.error("created a new address: '%s'" % new_addr)
         self.kv.store('config','ORACLE_ADDRESS',new_addr)
@@ -224,43 +476,70 @@ class Oracle:
       self.oracle_address = ORACLE_ADDRESS
 
     logging.info("my multisig address is %s" % self.oracle_address)
-    logging.info( "my pubkey: %r" % self.btc.validate_address(self.oracle_address)['pubkey'] )
+    pubkey = self.btc.validate_address(self.oracle_address)['pubkey']
+    logging.info( "my pubkey: %r" % pubkey )
+
+    # Worker keys of contracts are computed locally, refuse to start with
+    # address versions of another network (AddressVersionError)
+    self.btc.check_address_versions(self.oracle_address, pubkey)
+
+    # Before workers start, forked shards get a loaded copy
+    self.btc.load_wallet_index()
 
+  def when_available(self, fun, *args):
+    """
+    Calls fun until bitcoind answers, for startup steps the oracle can't
+    run without (bitcoind may still be starting or restarting)
+    """
     while True:
-      # Proceed all requests
-      requests = getMessages()
-      requests = requests['results']
-
-      requests = self.filter_requests(requests)
-
-      for prev_request in requests:
-        try:
-          request = self.prepare_request(prev_request)
-        except MissingOperationError:
-          logging.info('message doesn\'t have operation field, invalid')
-          logging.info(prev_request)
-          continue
-        except FastcastProtocolError:
-          logging.info('message does not have all required fields')
-          logging.info(prev_request)
-          continue
-        self.handle_request(request)
-
-
-      task = self.task_queue.get_oldest_task()
-      while task is not None:
-        self.handle_task(task)
-        self.task_queue.done(task)
-        task = self.task_queue.get_oldest_task()
+      try:
+        return fun(*args)
+      except BitcoindUnavailable as e:
+        logging.warning(e)
+        time.sleep(RETRY_TIME)
+
+  def run(self):
+    signal.signal(BLOCK_NOTIFY_SIGNAL, self.notify_new_block)
+
+    self.when_available(self.set_oracle_address)
 
-      new_block = self.get_new_block()
+    # Set before workers copy the oracle, so they can notify it
+    self.broadcaster = BroadcastSender(compact=self.compact_bodies, peers=self.peer_encodings)
+
+    # Before starting threads, shards are forked processes
+    if self.worker_pool:
+      self.worker_pool.start()
+
+    self.broadcaster.start()
+
+    try:
+      self.main_loop()
+    finally:
+      self.dedup.flush()
+      self.handlers.stop()
+
+  def main_loop(self):
+    while True:
+      # Cleared before doing any work, so wakeups arriving meanwhile aren't lost
+      self.wakeup.clear()
+      if self.take_block_notification():
+        self.next_block_check = 0
+
+      if time.time() >= self.next_fastcast_poll:
+        self.next_fastcast_poll = time.time() + FASTCAST_POLL_INTERVAL
+        self.process_messages()
+      else:
+        self.handle_deferred()
 
-      if new_block:
-        handlers = op_handlers.itervalues()
+      try:
+        self.process_tasks()
 
-        # Every available handler should get a chance to handle new block
-        for h in handlers:
-          h(self).handle_new_block(new_block)
-        KeyValue(self.db).update('blocks', 'last_block_number', {'last_block':new_block['height']})
+        if time.time() >= self.next_block_check:
+          self.next_block_check = time.time() + BLOCK_POLL_INTERVAL
+          self.process_new_blocks()
+      except BitcoindUnavailable as e:
+        # Unfinished tasks come back when their lease expires,
+        # blocks are resumed from last_block_number on the next check
+        logging.warning(e)
 
-      time.sleep(1)
+      self.wait_for_wakeup(min(self.next_fastcast_poll, self.next_block_check))
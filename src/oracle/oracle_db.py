@@ -1,11 +1,21 @@
 from collections import defaultdict
 from shared.db_classes import TableDb, GeneralDb
+from handlers.password_db import (
+    LockedPasswordTransaction,
+    RSAKeyPairs,
+    RightGuess,
+    SentPasswordTransaction)
 
 import json
 import time
+import uuid
 
 ORACLE_FILE = 'oracle.db'
 
+# Claimed tasks are hidden from other claims for that long, if they're not
+# done by then (e.g. worker died) they become available again
+TASK_LEASE_TIME = 10 * 60
+
 class KeyValue(TableDb):
   table_name = 'key_value'
   create_sql = 'create table {0} ( \
@@ -60,9 +70,10 @@ class KeyValue(TableDb):
 
 class OracleDb(GeneralDb):
 
-  def __init__(self):
-    self._filename = ORACLE_FILE
+  def __init__(self, filename=ORACLE_FILE):
+    self._filename = filename
     self.connect()
+    self.bootstrap_schema()
     operations = {
       'conditioned_transaction': TransactionRequestDb
     }
@@ -95,6 +106,7 @@ class TaskQueue(TableDb):
 
   table_name = "task_queue"
 
+  # lease_until and lease_id columns are added by add_task_leases migration
   create_sql = "create table {0} ( \
       id integer primary key autoincrement, \
       ts datetime default current_timestamp, \
@@ -103,28 +115,61 @@ class TaskQueue(TableDb):
       next_check integer not null, \
       done integer default 0);"
   insert_sql = "insert into {0} (operation, json_data, next_check, done) values (?,?,?,?)"
-  oldest_sql = "select * from {0} where next_check<? and done=0 order by ts limit 1"
-  all_sql = "select * from {0} where next_check<? and done=0 order by ts"
+  oldest_sql = "select * from {0} where next_check<=? and done=0 order by ts limit 1"
+  all_sql = "select * from {0} where next_check<=? and done=0 order by ts"
+  # Leased task becomes visible again when its lease expires
+  next_check_sql = "select min(max(next_check, lease_until)) as next_check from {0} where done=0"
+  claim_sql = "update {0} set lease_until=?, lease_id=? where id in ( \
+      select id from {0} where next_check<=? and done=0 and lease_until<=? \
+      order by ts, id limit ?)"
+  claimed_sql = "select * from {0} where lease_id=? and done=0 order by ts, id"
   all_ignore_sql = "select * from {0} where done=0 order by ts"
   mark_done_sql = "update {0} set done=1 where id=?"
+  mark_many_done_sql = "update {0} set done=1 where id in ({1})"
 
   def args_for_obj(self, obj):
     return [obj['operation'], obj['json_data'], obj['next_check'], obj['done']]
 
+  def claim_tasks(self, limit, lease_time=TASK_LEASE_TIME):
+    """
+    Claims up to limit due tasks, oldest first. Claimed tasks are hidden
+    from other claims until lease_time passes, they should be marked with
+    done/done_many before that
+    """
+    cursor = self.db.get_cursor()
+    now = time.time()
+    lease_id = uuid.uuid4().hex
+
+    sql = self.claim_sql.format(self.table_name)
+    cursor.execute(sql, (now + lease_time, lease_id, now, now, limit))
+    self.db.commit()
+
+    sql = self.claimed_sql.format(self.table_name)
+    rows = cursor.execute(sql, (lease_id, )).fetchall()
+    rows = [dict(row) for row in rows]
+    return rows
+
   def get_oldest_task(self):
     cursor = self.db.get_cursor()
     sql = self.oldest_sql.format(self.table_name)
 
-    row = cursor.execute(sql, (int(time.time()), )).fetchone()
+    row = cursor.execute(sql, (time.time(), )).fetchone()
     if row:
       row = dict(row)
     return row
 
+  def get_next_check(self):
+    cursor = self.db.get_cursor()
+    sql = self.next_check_sql.format(self.table_name)
+
+    row = cursor.execute(sql).fetchone()
+    return row['next_check']
+
   def get_all_tasks(self):
     cursor = self.db.get_cursor()
     sql = self.all_sql.format(self.table_name)
 
-    rows = cursor.execute(sql, (int(time.time()), )).fetchall()
+    rows = cursor.execute(sql, (time.time(), )).fetchall()
     rows = [dict(row) for row in rows]
     return rows
 
@@ -137,9 +182,165 @@ class TaskQueue(TableDb):
     return rows
 
   def done(self, task):
-    cursor = self.db.get_cursor()
     sql = self.mark_done_sql.format(self.table_name)
-    cursor.execute(sql, (int(task['id']), ))
+    self.execute_sql_properly(sql, (int(task['id']), ))
+
+  def done_many(self, tasks):
+    ids = [int(task['id']) for task in tasks]
+    if not ids:
+      return
+
+    sql = self.mark_many_done_sql.format(self.table_name, ','.join('?' * len(ids)))
+    self.execute_sql_properly(sql, ids)
+
+class Outbox(TableDb):
+  """
+  Fastcast broadcasts waiting to be sent by the background sender. Messages
+  with the same coalesce_key replace each other, only the one with the
+  highest rank is kept
+  """
+
+  table_name = "outbox"
+
+  create_sql = "create table {0} ( \
+      id integer primary key autoincrement, \
+      ts datetime default current_timestamp, \
+      body text not null, \
+      coalesce_key text, \
+      rank integer default 0, \
+      attempts integer default 0, \
+      next_attempt real not null);"
+  insert_sql = "insert into {0} (body, coalesce_key, rank, next_attempt) values (?,?,?,?)"
+  best_rank_sql = "select max(rank) as rank from {0} where coalesce_key=?"
+  delete_key_sql = "delete from {0} where coalesce_key=?"
+  due_sql = "select * from {0} where next_attempt<=? order by id limit ?"
+  next_attempt_sql = "select min(next_attempt) as next_attempt from {0}"
+  retry_sql = "update {0} set attempts=attempts+1, next_attempt=? where id=?"
+  delete_sql = "delete from {0} where id=?"
+
+  def put(self, body, coalesce_key=None, rank=0):
+    """
+    Queues body, returns False if it was coalesced away by a queued
+    message with the same key and the same or higher rank
+    """
+    cursor = self.db.get_cursor()
+
+    if coalesce_key is not None:
+      sql = self.best_rank_sql.format(self.table_name)
+      row = cursor.execute(sql, (coalesce_key, )).fetchone()
+      if row['rank'] is not None and row['rank'] >= rank:
+        return False
+
+      # Deleted rather than updated, so a copy that's being sent
+      # right now doesn't take the new message with it
+      sql = self.delete_key_sql.format(self.table_name)
+      cursor.execute(sql, (coalesce_key, ))
+
+    sql = self.insert_sql.format(self.table_name)
+    cursor.execute(sql, (body, coalesce_key, rank, time.time()))
+    self.db.commit()
+    return True
+
+  def get_due(self, limit):
+    cursor = self.db.get_cursor()
+    sql = self.due_sql.format(self.table_name)
+
+    rows = cursor.execute(sql, (time.time(), limit)).fetchall()
+    rows = [dict(row) for row in rows]
+    return rows
+
+  def get_next_attempt(self):
+    cursor = self.db.get_cursor()
+    sql = self.next_attempt_sql.format(self.table_name)
+
+    row = cursor.execute(sql).fetchone()
+    return row['next_attempt']
+
+  def retry_later(self, message, delay):
+    sql = self.retry_sql.format(self.table_name)
+    self.execute_sql_properly(sql, (time.time() + delay, int(message['id'])))
+
+  def sent(self, message):
+    sql = self.delete_sql.format(self.table_name)
+    self.execute_sql_properly(sql, (int(message['id']), ))
+
+class PendingRequests(TableDb):
+  """
+  Fastcast requests deferred by admission control, or put back because
+  bitcoind was unavailable while handling them. The fastcast cursor and the
+  dedup index are already past them, so they're kept here until retried.
+  Bodies can be binary (compact encoding), they're stored as blobs
+  """
+
+  table_name = "pending_requests"
+
+  create_sql = "create table {0} ( \
+      id integer primary key autoincrement, \
+      ts datetime default current_timestamp, \
+      source text not null, \
+      request text not null, \
+      body blob not null, \
+      admitted integer default 0, \
+      retry_at real not null);"
+  insert_sql = "insert into {0} (source, request, body, admitted, retry_at) values (?,?,?,?,?)"
+  due_sql = "select * from {0} where retry_at<=? order by id limit ?"
+  next_retry_sql = "select min(retry_at) as retry_at from {0}"
+  count_sql = "select count(*) as count from {0}"
+  count_source_sql = "select count(*) as count from {0} where source=? and admitted=0"
+  retry_sql = "update {0} set retry_at=? where id=?"
+  delete_many_sql = "delete from {0} where id in ({1})"
+
+  def put(self, request, retry_at, admitted=False):
+    """
+    Keeps request until retry_at. Admitted requests were already let in by
+    admission control, they aren't rate limited again
+    """
+    fields = dict(request)
+    body = fields.pop('body')
+
+    sql = self.insert_sql.format(self.table_name)
+    self.execute_sql_properly(sql, (request['source'], json.dumps(fields), buffer(body), int(admitted), retry_at))
+
+  def get_due(self, now, limit):
+    cursor = self.db.get_cursor()
+    sql = self.due_sql.format(self.table_name)
+
+    rows = []
+    for row in cursor.execute(sql, (now, limit)).fetchall():
+      request = json.loads(row['request'])
+      request['body'] = str(row['body'])
+      rows.append({'id': row['id'], 'admitted': row['admitted'], 'request': request})
+    return rows
+
+  def get_next_retry(self):
+    cursor = self.db.get_cursor()
+    sql = self.next_retry_sql.format(self.table_name)
+
+    row = cursor.execute(sql).fetchone()
+    return row['retry_at']
+
+  def count(self, source=None):
+    """
+    Number of pending requests, with source only those not admitted yet
+    """
+    cursor = self.db.get_cursor()
+    if source is None:
+      row = cursor.execute(self.count_sql.format(self.table_name)).fetchone()
+    else:
+      row = cursor.execute(self.count_source_sql.format(self.table_name), (source, )).fetchone()
+    return row['count']
+
+  def retry_later(self, pending, retry_at):
+    sql = self.retry_sql.format(self.table_name)
+    self.execute_sql_properly(sql, (retry_at, int(pending['id'])))
+
+  def done_many(self, pending):
+    ids = [int(p['id']) for p in pending]
+    if not ids:
+      return
+
+    sql = self.delete_many_sql.format(self.table_name, ','.join('?' * len(ids)))
+    self.execute_sql_properly(sql, ids)
 
 class UsedInput(TableDb):
   """
@@ -227,5 +428,53 @@ class HandledTransaction(TableDb):
     self.save({"rqhs":rqhs, "max_sigs":sigs})
 
 
-
-
+# Schema migrations, see GeneralDb.bootstrap_schema. Never change the
+# existing ones, add a new version instead
+
+def add_indexes(cursor):
+  cursor.execute("create index if not exists key_value_section_keyid on key_value (section, keyid)")
+  cursor.execute("create index if not exists task_queue_due on task_queue (done, next_check)")
+  cursor.execute("create index if not exists right_guess_pwtxid on right_guess (pwtxid)")
+  cursor.execute("create index if not exists sent_rqhs on sent (rqhs)")
+
+def add_task_leases(cursor):
+  columns = [row[1] for row in cursor.execute("pragma table_info(task_queue)")]
+  if not 'lease_until' in columns:
+    cursor.execute("alter table task_queue add column lease_until integer default 0")
+  if not 'lease_id' in columns:
+    cursor.execute("alter table task_queue add column lease_id text")
+  cursor.execute("create index if not exists task_queue_lease on task_queue (lease_id)")
+
+def add_outbox(cursor):
+  if not Outbox.table_exists_in(cursor):
+    cursor.execute(Outbox.create_sql.format(Outbox.table_name))
+  cursor.execute("create index if not exists outbox_coalesce_key on outbox (coalesce_key)")
+  cursor.execute("create index if not exists outbox_next_attempt on outbox (next_attempt)")
+
+def add_pending_requests(cursor):
+  if not PendingRequests.table_exists_in(cursor):
+    cursor.execute(PendingRequests.create_sql.format(PendingRequests.table_name))
+  cursor.execute("create index if not exists pending_requests_retry_at on pending_requests (retry_at)")
+  cursor.execute("create index if not exists pending_requests_source on pending_requests (source)")
+
+OracleDb.tables = [
+    KeyValue,
+    TransactionRequestDb,
+    TaskQueue,
+    Outbox,
+    PendingRequests,
+    UsedInput,
+    SignedTransaction,
+    HandledTransaction,
+    LockedPasswordTransaction,
+    RSAKeyPairs,
+    RightGuess,
+    SentPasswordTransaction,
+]
+
+OracleDb.migrations = [
+    (1, add_indexes),
+    (2, add_task_leases),
+    (3, add_outbox),
+    (4, add_pending_requests),
+]
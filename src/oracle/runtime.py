@@ -0,0 +1,174 @@
+# Threaded runtime for the oracle
+#
+# Python 2.7 has no asyncio, so network I/O (fastcast polling, block fetching
+# and broadcasting) runs in background threads. Handlers still run one at a
+# time on the main thread, in the order the events arrived, so their
+# semantics are the same as in Oracle.run
+
+from block_fetcher import BlockFetcher, RETRY_TIME
+from broadcaster import BroadcastSender
+from dedup import message_key
+from oracle import (
+    BLOCK_NOTIFY_SIGNAL,
+    BLOCK_POLL_INTERVAL,
+    BLOCK_PREFETCH,
+    FASTCAST_POLL_INTERVAL)
+from shared.bitcoind_client.bitcoinclient import BitcoindUnavailable
+from shared.fastproto import getMessages, get_transport
+
+import Queue
+import logging
+import signal
+import threading
+import time
+
+# Main thread wakes up at least this often, even if nothing happened
+MAX_IDLE_TIME = 60
+
+class MessageFetcher(threading.Thread):
+  """
+  Polls fastcast gateway and hands the results over to the main thread.
+  Keeps its own epoch cursor, so only new messages are fetched and verified
+  (main thread still persists last_epoch). Queue holds at most one result,
+  so a slow main thread doesn't make us pile up results.
+
+  The cursor is inclusive, messages from the last epoch second come back
+  on every fetch. They're remembered and not handed over again.
+
+  With a streaming transport the next fetch starts right away when it
+  brought something new, otherwise the poll interval is kept
+  """
+  def __init__(self, wakeup, interval, last_epoch):
+    super(MessageFetcher, self).__init__(name='fastcast')
+    self.daemon = True
+    self.wakeup = wakeup
+    self.interval = interval
+    self.last_epoch = last_epoch
+    # message_key of messages already handed over from last_epoch
+    self.last_epoch_keys = set()
+    self.results = Queue.Queue(maxsize=1)
+
+  def fresh(self, requests):
+    """
+    Drops messages handed over already and moves the cursor
+    """
+    fresh = []
+    for request in sorted(requests, key=lambda request: int(request['epoch'])):
+      epoch = int(request['epoch'])
+      if epoch < self.last_epoch:
+        continue
+
+      key = message_key(request)
+      if epoch > self.last_epoch:
+        self.last_epoch = epoch
+        self.last_epoch_keys = set()
+      elif key in self.last_epoch_keys:
+        continue
+
+      self.last_epoch_keys.add(key)
+      fresh.append(request)
+    return fresh
+
+  def run(self):
+    transport = get_transport()
+
+    while True:
+      started = time.time()
+      try:
+        requests = getMessages(since_epoch=self.last_epoch, transport=transport)
+      except:
+        logging.exception('error fetching fastcast messages')
+        time.sleep(RETRY_TIME)
+        continue
+
+      requests = self.fresh(requests['results'])
+
+      if requests:
+        self.results.put(requests)
+        self.wakeup.set()
+
+      if not transport.streaming:
+        time.sleep(self.interval)
+      elif not requests:
+        # Gateway doesn't hold the request open while the last epoch
+        # second has messages, or at all, don't hammer it then
+        time.sleep(max(0, self.interval - (time.time() - started)))
+
+
+class ThreadedRuntime:
+  def __init__(self, oracle):
+    self.oracle = oracle
+
+  def drain(self, queue):
+    items = []
+    while True:
+      try:
+        items.append(queue.get_nowait())
+      except Queue.Empty:
+        return items
+
+  def run(self):
+    oracle = self.oracle
+    # Before shards are forked, so they inherit a handler instead of
+    # being killed by the signal. Main loop passes it on to the fetcher
+    signal.signal(BLOCK_NOTIFY_SIGNAL, oracle.notify_new_block)
+
+    oracle.when_available(oracle.set_oracle_address)
+
+    # Set before workers copy the oracle, so they can notify it
+    oracle.broadcaster = BroadcastSender(compact=oracle.compact_bodies, peers=oracle.peer_encodings)
+
+    # Before any other threads are started, shards are forked processes
+    if oracle.worker_pool:
+      oracle.worker_pool.start()
+
+    last_block_number = oracle.get_last_block_number()
+    if last_block_number == 0:
+      last_block_number = oracle.when_available(oracle.set_last_block)
+
+    messages = MessageFetcher(oracle.wakeup, FASTCAST_POLL_INTERVAL, oracle.get_last_epoch())
+    blocks = BlockFetcher(oracle.btc.for_worker(), last_block_number, BLOCK_PREFETCH,
+        wakeup=oracle.wakeup, interval=BLOCK_POLL_INTERVAL)
+
+    for thread in [messages, blocks, oracle.broadcaster]:
+      thread.start()
+
+    try:
+      self.main_loop(messages, blocks)
+    finally:
+      oracle.dedup.flush()
+      oracle.handlers.stop()
+
+  def main_loop(self, messages, blocks):
+    oracle = self.oracle
+    # Fetched blocks not handled yet because bitcoind was unavailable
+    pending_blocks = []
+
+    while True:
+      # Cleared before doing any work, so wakeups arriving meanwhile aren't lost
+      oracle.wakeup.clear()
+      if oracle.take_block_notification():
+        blocks.notify_new_block()
+
+      for requests in self.drain(messages.results):
+        oracle.handle_messages(requests)
+      oracle.handle_deferred()
+
+      pending_blocks.extend(self.drain(blocks.blocks))
+
+      try:
+        oracle.process_tasks()
+
+        while pending_blocks:
+          block = pending_blocks[0]
+          logging.info("New block {}".format(block['height']))
+          oracle.handle_new_block(block)
+          pending_blocks.pop(0)
+          # Blocks can create tasks that are already due
+          oracle.process_tasks()
+      except BitcoindUnavailable as e:
+        logging.warning(e)
+        oracle.wait_for_wakeup(time.time() + RETRY_TIME)
+        continue
+
+      oracle.wait_for_wakeup(time.time() + MAX_IDLE_TIME)
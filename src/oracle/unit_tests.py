@@ -0,0 +1,544 @@
+# Focused tests of the oracle runtime pieces, they don't need bitcoind,
+# fastcast or handlers. Legacy end-to-end tests are in tests.py
+
+from admission import ROUND_DELAY, AdmissionControl, TokenBucket
+from block_fetcher import CONFIRMATIONS, BlockFetcher
+from dedup import DedupIndex, RotatingBloomFilter
+from handlers.handlers import HandlerRegistry
+from oracle_db import KeyValue, OracleDb, Outbox, PendingRequests, TaskQueue
+from runtime import MessageFetcher
+from oracle import BLOCK_NOTIFY_SIGNAL
+from worker_pool import KeyedWorkerPool, ShardPool
+from shared.body_codec import PeerEncodings
+
+import Queue
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+class FakeChain:
+  """
+  Just enough of BitcoinClient for fetching blocks
+  """
+  def __init__(self, count):
+    self.count = count
+    self.calls = 0
+
+  def get_block_count(self):
+    return self.count
+
+  def get_block_hash(self, number):
+    self.calls += 1
+    if number > self.count:
+      return None
+    return 'hash-{}'.format(number)
+
+  def get_block(self, block_hash):
+    height = int(block_hash.split('-')[1])
+    return {'height': height, 'confirmations': self.count - height + 1}
+
+
+class BlockFetcherTests(unittest.TestCase):
+  def test_fetches_confirmed_blocks_in_order(self):
+    chain = FakeChain(20)
+    fetcher = BlockFetcher(chain, 10, 2, until=20 - CONFIRMATIONS + 1)
+    fetcher.start()
+
+    heights = [block['height'] for block in fetcher]
+    self.assertEquals(heights, range(11, 20 - CONFIRMATIONS + 2))
+    self.assertTrue(chain.calls > 0)
+
+  def test_close_releases_blocked_fetcher(self):
+    fetcher = BlockFetcher(FakeChain(100), 0, 2, until=90)
+    fetcher.start()
+
+    # Consumer takes one block and gives up, the queue stays full
+    iter(fetcher).next()
+    time.sleep(0.1)
+    self.assertTrue(fetcher.is_alive())
+
+    fetcher.close()
+    fetcher.join(5)
+    self.assertFalse(fetcher.is_alive())
+
+  def test_close_stops_following(self):
+    event = threading.Event()
+    fetcher = BlockFetcher(FakeChain(5), 5, 2, wakeup=event, interval=60)
+    fetcher.start()
+
+    fetcher.close()
+    fetcher.join(5)
+    self.assertFalse(fetcher.is_alive())
+
+
+def request(source, number=0):
+  return {'source': source, 'body': str(number), 'signature': '{}-{}'.format(source, number), 'epoch': 1}
+
+
+class TempDbTestCase(unittest.TestCase):
+  def setUp(self):
+    handle, self.filename = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+
+  def tearDown(self):
+    os.remove(self.filename)
+
+
+class AdmissionTests(TempDbTestCase):
+  def admission(self, **kwargs):
+    return AdmissionControl(PendingRequests(OracleDb(self.filename)), **kwargs)
+
+  def signatures(self, requests):
+    return [request['signature'] for request in requests]
+
+  def test_token_bucket_refill(self):
+    bucket = TokenBucket(2.0, 3, now=0)
+    for _ in range(3):
+      self.assertTrue(bucket.take(0))
+    self.assertFalse(bucket.take(0))
+
+    self.assertTrue(bucket.take(0.5))
+    self.assertFalse(bucket.take(0.5))
+    # Never more than burst, however long it was idle
+    bucket.refill(1000)
+    self.assertEquals(bucket.tokens, 3)
+
+  def test_burst_then_deferred(self):
+    admission = self.admission(rate=1.0, burst=2, max_deferred=10)
+    admitted = admission.admit([request('a', n) for n in range(3)] + [request('b')], now=0)
+
+    self.assertEquals(self.signatures(admitted), ['a-0', 'a-1', 'b-0'])
+    self.assertEquals(admission.stats()['pending'], 1)
+    self.assertEquals(admission.retry_at(), 1)
+
+    # Retried without new requests once the source has a token again
+    self.assertEquals(admission.admit([], now=0.5), [])
+    self.assertEquals(self.signatures(admission.admit([], now=1)), ['a-2'])
+    self.assertEquals(admission.retry_at(), None)
+
+  def test_deferred_limits(self):
+    admission = self.admission(rate=1.0, burst=2, max_deferred=3)
+    # Per source: burst admitted, burst deferred, the rest dropped
+    admission.admit([request('a', n) for n in range(5)], now=0)
+    self.assertEquals(admission.counters, {'admitted': 2, 'deferred': 2, 'dropped': 1})
+
+    # Overall: at most max_deferred
+    admission.admit([request('b', n) for n in range(4)], now=0)
+    self.assertEquals(admission.stats()['pending'], 3)
+    self.assertEquals(admission.counters['dropped'], 2)
+
+  def test_deferred_survive_restart(self):
+    self.admission(rate=1.0, burst=1).admit([request('a', n) for n in range(2)], now=0)
+
+    admission = self.admission(rate=1.0, burst=1)
+    self.assertEquals(admission.retry_at(), 1)
+    self.assertEquals(self.signatures(admission.admit([], now=1)), ['a-1'])
+
+  def test_round_cap(self):
+    admission = self.admission(max_per_round=2)
+    admitted = admission.admit([request(source) for source in 'abcd'], now=0)
+
+    self.assertEquals(self.signatures(admitted), ['a-0', 'b-0'])
+    self.assertEquals(admission.retry_at(), ROUND_DELAY)
+    self.assertEquals(self.signatures(admission.admit([request('e')], now=ROUND_DELAY)), ['c-0', 'd-0'])
+    self.assertEquals(self.signatures(admission.admit([], now=2 * ROUND_DELAY)), ['e-0'])
+    self.assertEquals(admission.counters['dropped'], 0)
+
+  def test_peers_not_limited_per_source(self):
+    peers = PeerEncodings()
+    peers.seen('oracle', {'body_encoding': 1}, now=0)
+    admission = self.admission(rate=1.0, burst=1, max_per_round=3, peers=peers)
+
+    admitted = admission.admit([request('oracle', n) for n in range(5)] + [request('a', n) for n in range(3)], now=0)
+    self.assertEquals(self.signatures(admitted), ['oracle-0', 'oracle-1', 'oracle-2'])
+    # Over the round cap peers are deferred, others too but only up to burst
+    self.assertEquals(admission.counters, {'admitted': 3, 'deferred': 3, 'dropped': 2})
+
+  def test_put_back_requests(self):
+    admission = self.admission(rate=1.0, burst=1)
+    self.assertEquals(len(admission.admit([request('a')], now=0)), 1)
+
+    # Already admitted, doesn't need a token again. Compact bodies are binary
+    put_back = dict(request('a', 1), body='\x00fc\x01\xff')
+    admission.pending.put(put_back, retry_at=0, admitted=True)
+    self.assertEquals(admission.admit([], now=0), [put_back])
+    self.assertEquals(admission.stats()['pending'], 0)
+
+
+class FakeHandler:
+  def __init__(self, oracle):
+    self.oracle = oracle
+    self.started = 0
+    self.stopped = 0
+
+  def start(self):
+    self.started += 1
+
+  def stop(self):
+    self.stopped += 1
+
+
+class HandlerRegistryTests(unittest.TestCase):
+  def test_lifecycle(self):
+    oracle = object()
+    registry = HandlerRegistry(oracle, {'a': FakeHandler, 'b': FakeHandler})
+    registry.start()
+
+    handler = registry['a']
+    self.assertTrue(registry['a'] is handler)
+    self.assertTrue(handler.oracle is oracle)
+    self.assertEquals(handler.started, 1)
+    self.assertTrue('b' in registry)
+    self.assertFalse('c' in registry)
+    self.assertEquals(len(list(registry.itervalues())), 2)
+
+    registry.stop()
+    self.assertEquals(handler.stopped, 1)
+    self.assertFalse('a' in registry)
+
+
+class MessageFetcherTests(unittest.TestCase):
+  def message(self, epoch, signature):
+    return {'source': 'a', 'body': '', 'signature': signature, 'epoch': epoch}
+
+  def signatures(self, requests):
+    return [request['signature'] for request in requests]
+
+  def test_hands_over_only_fresh_messages(self):
+    fetcher = MessageFetcher(threading.Event(), 1, 5)
+
+    fresh = fetcher.fresh([self.message(6, 'c'), self.message(4, 'a'), self.message(5, 'b')])
+    self.assertEquals(self.signatures(fresh), ['b', 'c'])
+    self.assertEquals(fetcher.last_epoch, 6)
+
+    # Inclusive cursor returns the last second again
+    self.assertEquals(fetcher.fresh([self.message(6, 'c')]), [])
+    self.assertEquals(self.signatures(fetcher.fresh([self.message(6, 'c'), self.message(6, 'd')])), ['d'])
+
+
+class FakeKeyValue:
+  def __init__(self):
+    self.values = {}
+
+  def get_by_section_key(self, section, keyid):
+    return self.values.get((section, keyid))
+
+  def store(self, section, keyid, value):
+    assert not (section, keyid) in self.values
+    self.values[(section, keyid)] = value
+
+  def update(self, section, keyid, value):
+    self.values[(section, keyid)] = value
+
+
+class DedupTests(unittest.TestCase):
+  def test_duplicates(self):
+    dedup = DedupIndex(FakeKeyValue())
+
+    self.assertTrue(dedup.check_and_add(request('a')))
+    self.assertFalse(dedup.check_and_add(request('a')))
+    self.assertTrue(dedup.check_and_add(request('a', 1)))
+
+  def test_unsigned_messages(self):
+    dedup = DedupIndex(FakeKeyValue())
+    unsigned = {'source': 'a', 'body': 'x', 'epoch': 1}
+
+    self.assertTrue(dedup.check_and_add(unsigned))
+    self.assertFalse(dedup.check_and_add(dict(unsigned, epoch=2)))
+    self.assertTrue(dedup.check_and_add(dict(unsigned, body='y')))
+
+  def test_bloom_behind_recent(self):
+    dedup = DedupIndex(FakeKeyValue(), recent_size=2)
+    for number in range(5):
+      dedup.check_and_add(request('a', number))
+
+    # Out of the in-memory index, still caught by the Bloom filter
+    self.assertFalse(dedup.check_and_add(request('a', 0)))
+
+  def test_bloom_rotation(self):
+    bloom = RotatingBloomFilter(capacity=100)
+    keys = ['key-{}'.format(n) for n in range(250)]
+    for key in keys:
+      bloom.add(key)
+
+    # Last full generation and the current one are remembered
+    self.assertTrue(all(key in bloom for key in keys[100:]))
+    forgotten = sum(1 for key in keys[:100] if key in bloom)
+    self.assertTrue(forgotten < 5)
+
+  def test_persistence(self):
+    kv = FakeKeyValue()
+    dedup = DedupIndex(kv)
+    dedup.check_and_add(request('a'))
+    dedup.flush()
+
+    # Only the Bloom filter is persisted, the in-memory index is empty
+    restarted = DedupIndex(kv)
+    self.assertFalse(restarted.check_and_add(request('a')))
+    self.assertTrue(restarted.check_and_add(request('b')))
+
+  def test_saved_periodically(self):
+    kv = FakeKeyValue()
+    dedup = DedupIndex(kv, save_every=3, save_interval=60)
+    dedup.saved_at = 0
+
+    dedup.check_and_add(request('a'))
+    dedup.save(now=1)
+    self.assertEquals(kv.values, {})
+
+    dedup.save(now=60)
+    self.assertTrue(('fastcast', 'dedup') in kv.values)
+
+    for n in range(3):
+      kv.values = {}
+      dedup.check_and_add(request('b', n))
+      dedup.save(now=61)
+    self.assertTrue(('fastcast', 'dedup') in kv.values)
+
+  def test_saved_after_rotation(self):
+    kv = FakeKeyValue()
+    dedup = DedupIndex(kv, save_every=1000, save_interval=60)
+    dedup.bloom = RotatingBloomFilter(capacity=10)
+    dedup.saved_at = 0
+
+    for n in range(11):
+      dedup.check_and_add(request('a', n))
+      dedup.save(now=1)
+    self.assertTrue(('fastcast', 'dedup') in kv.values)
+
+
+class SchemaTests(TempDbTestCase):
+  def columns(self, db, table):
+    return [row[1] for row in db.conn.execute('pragma table_info({})'.format(table))]
+
+  def test_bootstrap_new_database(self):
+    db = OracleDb(self.filename)
+
+    self.assertEquals(db.schema_version(), OracleDb.migrations[-1][0])
+    for table in OracleDb.tables:
+      self.assertTrue(table.table_exists_in(db.conn.cursor()))
+    self.assertTrue('lease_until' in self.columns(db, 'task_queue'))
+
+  def test_migrate_from_version_0(self):
+    # Database of an oracle from before versioned schema: tables created
+    # on demand, no leases, no outbox
+    conn = sqlite3.connect(self.filename)
+    conn.execute(KeyValue.create_sql.format(KeyValue.table_name))
+    conn.execute(TaskQueue.create_sql.format(TaskQueue.table_name))
+    conn.execute("insert into key_value (section, keyid, value) values ('blocks', 'last_block_number', '{\"last_block\": 7}')")
+    conn.execute("insert into task_queue (operation, json_data, next_check, done) values ('sign', '{}', 0, 0)")
+    conn.commit()
+    conn.close()
+
+    db = OracleDb(self.filename)
+
+    self.assertEquals(db.schema_version(), OracleDb.migrations[-1][0])
+    self.assertTrue(Outbox.table_exists_in(db.conn.cursor()))
+    self.assertEquals(KeyValue(db).get_by_section_key('blocks', 'last_block_number'), {'last_block': 7})
+    self.assertEquals(len(TaskQueue(db).claim_tasks(10)), 1)
+
+  def test_reopen_keeps_version(self):
+    OracleDb(self.filename)
+    db = OracleDb(self.filename)
+    self.assertEquals(db.schema_version(), OracleDb.migrations[-1][0])
+
+
+class TaskQueueTests(TempDbTestCase):
+  def setUp(self):
+    super(TaskQueueTests, self).setUp()
+    self.tasks = TaskQueue(OracleDb(self.filename))
+
+  def add_task(self, next_check=0, operation='sign'):
+    self.tasks.save({'operation': operation, 'json_data': '{}', 'next_check': next_check, 'done': 0})
+
+  def test_claim_due_tasks_in_order(self):
+    for _ in range(3):
+      self.add_task()
+    self.add_task(next_check=time.time() + 3600)
+
+    claimed = self.tasks.claim_tasks(2)
+    self.assertEquals([task['id'] for task in claimed], [1, 2])
+    self.assertEquals([task['id'] for task in self.tasks.claim_tasks(10)], [3])
+    self.assertEquals(self.tasks.claim_tasks(10), [])
+
+  def test_lease_expiry_and_reclaim(self):
+    self.add_task()
+    self.assertEquals(len(self.tasks.claim_tasks(10, lease_time=0.2)), 1)
+    self.assertEquals(self.tasks.claim_tasks(10), [])
+
+    # Worker died without marking it done
+    time.sleep(0.3)
+    reclaimed = self.tasks.claim_tasks(10)
+    self.assertEquals(len(reclaimed), 1)
+    self.assertEquals(reclaimed[0]['id'], 1)
+
+  def test_next_check_includes_lease(self):
+    self.add_task()
+    self.tasks.claim_tasks(10, lease_time=100)
+
+    self.assertTrue(self.tasks.get_next_check() > time.time() + 50)
+
+  def test_done_many(self):
+    for _ in range(4):
+      self.add_task()
+    claimed = self.tasks.claim_tasks(10, lease_time=0)
+
+    self.tasks.done_many(claimed[:3])
+    self.tasks.done_many([])
+    self.assertEquals([task['id'] for task in self.tasks.claim_tasks(10)], [4])
+
+
+class OutboxTests(TempDbTestCase):
+  def setUp(self):
+    super(OutboxTests, self).setUp()
+    self.outbox = Outbox(OracleDb(self.filename))
+
+  def bodies(self):
+    return [message['body'] for message in self.outbox.get_due(10)]
+
+  def test_coalescing_put(self):
+    self.assertTrue(self.outbox.put('2 sigs', 'sign:a', 2))
+    self.assertTrue(self.outbox.put('other', 'sign:b', 1))
+    self.assertTrue(self.outbox.put('no key'))
+    self.assertTrue(self.outbox.put('no key'))
+
+    # Same or lower rank is dropped, higher replaces the queued one
+    self.assertFalse(self.outbox.put('1 sig', 'sign:a', 1))
+    self.assertFalse(self.outbox.put('2 sigs again', 'sign:a', 2))
+    self.assertTrue(self.outbox.put('3 sigs', 'sign:a', 3))
+
+    self.assertEquals(self.bodies(), ['other', 'no key', 'no key', '3 sigs'])
+
+  def test_retry_and_sent(self):
+    self.outbox.put('message')
+    message = self.outbox.get_due(10)[0]
+
+    self.outbox.retry_later(message, 100)
+    self.assertEquals(self.bodies(), [])
+    self.assertTrue(self.outbox.get_next_attempt() > time.time() + 50)
+
+    self.outbox.sent(message)
+    self.assertEquals(self.outbox.get_next_attempt(), None)
+
+
+class FakeDb:
+  def commit(self):
+    return
+
+
+class FakeWorkerOracle:
+  def __init__(self, oracle):
+    self.oracle = oracle
+    self.db = FakeDb()
+    self.broadcaster = None
+
+  def record(self, key, number):
+    self.oracle.results.put((key, number, threading.current_thread().name, os.getpid()))
+
+  def fail(self):
+    raise Exception('job failed')
+
+
+class FakeOracle:
+  """
+  Just enough of Oracle for the worker pools, jobs report to results
+  """
+  def __init__(self, results):
+    self.results = results
+    self.wakeup = threading.Event()
+
+  def clone_for_worker(self):
+    return FakeWorkerOracle(self)
+
+
+class KeyedWorkerPoolTests(unittest.TestCase):
+  def setUp(self):
+    self.oracle = FakeOracle(Queue.Queue())
+    self.pool = KeyedWorkerPool(self.oracle, 4)
+
+  def results(self):
+    results = []
+    while not self.oracle.results.empty():
+      results.append(self.oracle.results.get())
+    return results
+
+  def test_routing_is_stable(self):
+    other = KeyedWorkerPool(self.oracle, 4)
+    keys = ['key-{}'.format(n) for n in range(20)]
+
+    workers = [self.pool.workers.index(self.pool.worker_for(key)) for key in keys]
+    self.assertEquals(workers, [other.workers.index(other.worker_for(key)) for key in keys])
+    # Keys are spread over the workers
+    self.assertTrue(len(set(workers)) > 1)
+    self.assertTrue(self.pool.worker_for(None) is self.pool.workers[0])
+
+  def test_same_key_in_order_on_one_worker(self):
+    self.pool.start()
+    for number in range(10):
+      for key in ['a', 'b', None]:
+        self.pool.submit(key, 'record', key, number)
+    self.pool.join()
+
+    results = self.results()
+    self.assertEquals(len(results), 30)
+    for key in ['a', 'b', None]:
+      mine = [result for result in results if result[0] == key]
+      self.assertEquals([result[1] for result in mine], range(10))
+      self.assertEquals(len(set(result[2] for result in mine)), 1)
+
+  def test_failed_job_keeps_worker_running(self):
+    self.pool.start()
+    self.pool.submit('a', 'fail')
+    self.pool.submit('a', 'record', 'a', 1)
+    self.pool.join()
+
+    self.assertEquals([result[1] for result in self.results()], [1])
+    self.assertTrue(self.oracle.wakeup.is_set())
+
+
+class ShardPoolTests(unittest.TestCase):
+  def setUp(self):
+    self.oracle = FakeOracle(multiprocessing.Queue())
+    self.pool = ShardPool(self.oracle, 2)
+    self.pool.start()
+
+  def tearDown(self):
+    for shard in self.pool.workers:
+      shard.terminate()
+      shard.join()
+
+  def results(self, count):
+    return [self.oracle.results.get(timeout=10) for _ in range(count)]
+
+  def test_jobs_run_in_owning_shard(self):
+    for number in range(5):
+      for key in ['a', 'b']:
+        self.pool.submit(key, 'record', key, number)
+
+    results = self.results(10)
+    for key in ['a', 'b']:
+      mine = [result for result in results if result[0] == key]
+      self.assertEquals([result[1] for result in mine], range(5))
+      self.assertEquals(set(result[3] for result in mine), set([self.pool.worker_for(key).pid]))
+    self.assertFalse(os.getpid() in [result[3] for result in results])
+
+  def test_shards_survive_block_notify(self):
+    # A key for every shard, once they answer they're running
+    keys = {}
+    for number in range(100):
+      keys.setdefault(self.pool.worker_for(number), number)
+    for key in keys.itervalues():
+      self.pool.submit(key, 'record', key, 0)
+    self.results(len(self.pool.workers))
+
+    for shard in self.pool.workers:
+      os.kill(shard.pid, BLOCK_NOTIFY_SIGNAL)
+    for key in keys.itervalues():
+      self.pool.submit(key, 'record', key, 1)
+
+    self.assertEquals([result[1] for result in self.results(len(self.pool.workers))], [1, 1])
+    self.assertTrue(all(shard.is_alive() for shard in self.pool.workers))
@@ -0,0 +1,124 @@
+# Keyed worker pools
+#
+# Requests and tasks are handled in parallel, but everything sharing the same
+# key (multisig address, rq_hash, pwtxid...) goes to the same worker, so it's
+# handled in submission order and never concurrently.
+#
+# Jobs are (method name, args) pairs called on the worker's own copy of the
+# oracle, so they can be sent to other processes as well as threads
+
+from oracle import BLOCK_NOTIFY_SIGNAL
+
+from Crypto import Random
+
+import Queue
+import hashlib
+import logging
+import multiprocessing
+import signal
+import threading
+
+class WorkerLoop(object):
+  def work(self):
+    # sqlite connection and jsonrpclib server have to be created
+    # in the thread (and process) that uses them
+    worker_oracle = self.oracle.clone_for_worker()
+    self.prepare(worker_oracle)
+
+    while True:
+      method, args = self.jobs.get()
+      try:
+        getattr(worker_oracle, method)(*args)
+      except:
+        logging.exception('error in worker job {}'.format(method))
+      finally:
+        worker_oracle.db.commit()
+        self.jobs.task_done()
+        self.job_done()
+
+  def prepare(self, worker_oracle):
+    return
+
+  def job_done(self):
+    return
+
+
+class Worker(threading.Thread, WorkerLoop):
+  def __init__(self, oracle, number):
+    super(Worker, self).__init__(name='worker-{}'.format(number))
+    self.daemon = True
+    self.oracle = oracle
+    self.jobs = Queue.Queue()
+
+  def run(self):
+    self.work()
+
+  def job_done(self):
+    # Main loop might be waiting for the task to finish
+    self.oracle.wakeup.set()
+
+
+class Shard(multiprocessing.Process, WorkerLoop):
+  def __init__(self, oracle, number):
+    super(Shard, self).__init__(name='shard-{}'.format(number))
+    self.daemon = True
+    self.oracle = oracle
+    self.jobs = multiprocessing.JoinableQueue()
+
+  def run(self):
+    # Blocks are handled by the coordinator. The inherited handler would
+    # only wake up this process's copy of the main loop, which doesn't run
+    signal.signal(BLOCK_NOTIFY_SIGNAL, signal.SIG_IGN)
+    self.work()
+
+  def prepare(self, worker_oracle):
+    # pycrypto refuses to use its random pool inherited through fork,
+    # e.g. by keys cached in fastproto before the shard was started
+    Random.atfork()
+    # Background threads of the coordinator don't exist after fork
+    worker_oracle.broadcaster = None
+
+
+class KeyedWorkerPool:
+  worker_class = Worker
+
+  def __init__(self, oracle, size):
+    self.workers = [self.worker_class(oracle, number) for number in range(size)]
+
+  def start(self):
+    for worker in self.workers:
+      worker.start()
+
+  def worker_for(self, key):
+    # Jobs without a key are all serialized on the first worker
+    if key is None:
+      return self.workers[0]
+
+    # hash() isn't stable between runs (and processes), sha256 is
+    digest = hashlib.sha256(str(key)).hexdigest()
+    return self.workers[int(digest, 16) % len(self.workers)]
+
+  def submit(self, key, method, *args):
+    """
+    Calls method with args on the worker's copy of the oracle
+    """
+    self.worker_for(key).jobs.put((method, args))
+
+  def join(self):
+    for worker in self.workers:
+      worker.jobs.join()
+
+
+class ShardPool(KeyedWorkerPool):
+  """
+  Same as KeyedWorkerPool, but every worker is a separate process owning
+  a shard of contracts, so handlers aren't limited by the GIL. The oracle
+  process stays the coordinator: it fetches messages and blocks once,
+  claims due tasks and routes them to the owning shard. New blocks are
+  handled by the coordinator itself, only requests and tasks are sharded.
+  All shards share oracle.db, so they use the same oracle identity.
+
+  Start the pool after the block notification handler is installed, so
+  a -blocknotify signal can't kill a shard that was just forked
+  """
+  worker_class = Shard
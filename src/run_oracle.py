@@ -1,11 +1,48 @@
 #!/usr/bin/env python2.7
 from shared import logger
 from oracle.oracle import Oracle
+from oracle.runtime import ThreadedRuntime
+from oracle.worker_pool import KeyedWorkerPool, ShardPool
+from shared.bitcoind_client.bitcoinclient import PooledBitcoinClient
+from shared.fastproto import LongPollTransport, set_transport_class
+
+import argparse
 
 def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--threaded', action='store_true',
+      help='fetch messages, blocks and send broadcasts in background threads')
+  parser.add_argument('--long-poll', action='store_true',
+      help='get fastcast messages as soon as they arrive, implies --threaded')
+  parser.add_argument('--compact-bodies', action='store_true',
+      help='broadcast message bodies in the compact binary encoding once all peers read it')
+  parser.add_argument('--workers', type=int, default=0,
+      help='handle requests and tasks in parallel, serialized per contract')
+  parser.add_argument('--shards', type=int, default=0,
+      help='like --workers, but every worker is a separate process')
+  parser.add_argument('--bitcoind-connections', type=int, default=0,
+      help='share a pool of this many bitcoind connections between workers')
+  args = parser.parse_args()
+
+  if args.workers and args.shards:
+    parser.error('--workers and --shards are mutually exclusive')
+
   logger.init_logger()
-  o = Oracle()
-  o.run()
+  if args.long_poll:
+    set_transport_class(LongPollTransport)
+  btc = None
+  if args.bitcoind_connections:
+    btc = PooledBitcoinClient(args.bitcoind_connections)
+  o = Oracle(btc)
+  o.compact_bodies = args.compact_bodies
+  if args.workers:
+    o.worker_pool = KeyedWorkerPool(o, args.workers)
+  if args.shards:
+    o.worker_pool = ShardPool(o, args.shards)
+  if args.threaded or args.long_poll:
+    ThreadedRuntime(o).run()
+  else:
+    o.run()
 
 if __name__=="__main__":
   main()
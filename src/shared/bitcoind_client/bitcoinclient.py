@@ -1,62 +1,366 @@
 from settings_local import *
-
+from shared import settings
+from shared.lru_cache import LRUCache
+from script import decode_script, multisig_script, pubkey_address, script_address
+from transaction import TransactionDecodeError, decode_transaction
+from wallet_index import WalletIndex
+
+from contextlib import contextmanager
+
+import binascii
+import copy
+import hashlib
+import httplib
 import json
 import jsonrpclib
+import os
+import Queue
+import threading
 import time
 from xmlrpclib import ProtocolError
 from decimal import Decimal
 import socket
+import sys
 
 import logging
 
+# Consecutive connection failures after which calls fail fast
+CIRCUIT_FAILURE_THRESHOLD = 3
+# Fail fast period after the circuit opens, doubles with every failed try
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+
+# Calls sent in a single JSON-RPC batch request, bigger batches are split
+BATCH_MAX_SIZE = 500
+
+# Socket timeout of bitcoind calls, None waits as long as bitcoind takes
+RPC_TIMEOUT = None
+
+# Connections of PooledBitcoinClient and their default call timeout
+POOL_SIZE = 4
+POOL_RPC_TIMEOUT = 60
+
+# Decoded transactions shared by all clients in the process, keyed by
+# digest of the raw hex. A signing round decodes the same one many times
+DECODED_TX_CACHE_SIZE = 1024
+decoded_transactions = LRUCache(DECODED_TX_CACHE_SIZE)
+
+# Decoded scripts keyed by their hex, inputs of a contract share one redeemScript
+DECODED_SCRIPT_CACHE_SIZE = 1024
+decoded_scripts = LRUCache(DECODED_SCRIPT_CACHE_SIZE)
+
+# Own addresses and pubkeys, shared by all clients in the process
+wallet_index = WalletIndex()
+
+def decoded_cache_stats():
+  return {'transactions': decoded_transactions.stats(), 'scripts': decoded_scripts.stats()}
+
+# Errors meaning the connection to bitcoind is broken. RPC errors returned
+# by bitcoind itself come as ProtocolError and don't count
+CONNECTION_ERRORS = (socket.error, httplib.HTTPException)
+
+class BitcoindUnavailable(Exception):
+  """
+  Raised when bitcoind can't be reached, and without calling it at all
+  while the circuit breaker is open
+  """
+  pass
+
+class AddressVersionError(Exception):
+  """
+  Raised when bitcoind's addresses don't use the version bytes in settings,
+  i.e. it runs on another network
+  """
+  pass
+
+def raise_unavailable(error):
+  """
+  Re-raises a connection error as BitcoindUnavailable, keeping its traceback
+  """
+  raise BitcoindUnavailable('bitcoind connection failed: {}'.format(error)), None, sys.exc_info()[2]
+
+def keep_alive(fun, idempotent=True):
+  """
+  Tracks connection health by the outcome of real calls. A call broken by
+  a connection error reconnects and, if the call is idempotent, is retried
+  once. A connection error that gets through is raised as
+  BitcoindUnavailable, so callers handle one exception whether the circuit
+  is open or not. After CIRCUIT_FAILURE_THRESHOLD failures in a row the
+  circuit opens and calls raise BitcoindUnavailable right away until the
+  backoff passes, instead of blocking the caller
+  """
+  def call_with_health_check(self, *args, **kwargs):
+    # Methods calling other wrapped methods are checked once, as a whole
+    if getattr(self.local, 'in_call', False):
+      return fun(self, *args, **kwargs)
+
+    self.check_circuit()
+    self.local.in_call = True
+    try:
+      try:
+        response = fun(self, *args, **kwargs)
+      except CONNECTION_ERRORS as e:
+        self.connection_failed()
+        if not idempotent or self.circuit_open():
+          raise_unavailable(e)
+        self.connect()
+        try:
+          response = fun(self, *args, **kwargs)
+        except CONNECTION_ERRORS as e:
+          self.connection_failed()
+          raise_unavailable(e)
+    finally:
+      self.local.in_call = False
+
+    self.connection_ok()
+    return response
+  call_with_health_check.__name__ = fun.__name__
+  call_with_health_check.__doc__ = fun.__doc__
+  return call_with_health_check
+
+def keep_alive_once(fun):
+  """
+  keep_alive for calls with side effects, they're never repeated
+  """
+  return keep_alive(fun, idempotent=False)
+
+
+def rpc_url():
+  return 'http://{0}:{1}@{2}:{3}'.format(
+      BITCOIND_RPC_USERNAME,
+      BITCOIND_RPC_PASSWORD,
+      BITCOIND_RPC_HOST,
+      BITCOIND_RPC_PORT)
+
+
+class TimeoutTransport(jsonrpclib.jsonrpc.Transport):
+  """
+  Keep-alive HTTP transport with its own socket timeout instead of the
+  process-wide default, which can be changed between calls
+  """
+  def __init__(self, timeout=RPC_TIMEOUT):
+    jsonrpclib.jsonrpc.Transport.__init__(self)
+    self.timeout = timeout
+
+  def make_connection(self, host):
+    connection = jsonrpclib.jsonrpc.Transport.make_connection(self, host)
+    connection.timeout = self.timeout
+    if connection.sock is not None:
+      connection.sock.settimeout(self.timeout)
+    return connection
+
+
+class RPCFuture:
+  """
+  Result of a call queued in an RPCBatch, available once the batch is sent
+  """
+  def __init__(self, method):
+    self.method = method
+    self.done = False
+    self.value = None
+    self.error = None
+
+  def set_result(self, value):
+    self.value = value
+    self.done = True
+
+  def set_error(self, error):
+    self.error = error
+    self.done = True
+
+  def result(self):
+    if not self.done:
+      raise RuntimeError('batch with {} was not sent yet'.format(self.method))
+    if self.error:
+      raise self.error
+    return self.value
+
+
+class RPCBatch:
+  """
+  Collects bitcoind calls and sends them as JSON-RPC batch requests,
+  every call returns an RPCFuture. Used as a context manager the batch is
+  sent when the block ends:
+
+    with btc.batch() as batch:
+      futures = [batch.getrawtransaction(txid) for txid in txids]
+    raw_transactions = [future.result() for future in futures]
+
+  Whole batches are retried on connection errors, so only idempotent
+  calls belong here
+  """
+  def __init__(self, client, max_size=BATCH_MAX_SIZE):
+    self.client = client
+    self.max_size = max_size
+    self.calls = []
+
+  def call(self, method, *params):
+    future = RPCFuture(method)
+    self.calls.append((method, params, future))
+    return future
+
+  def __getattr__(self, method):
+    if method.startswith('_'):
+      raise AttributeError(method)
+    return lambda *params: self.call(method, *params)
+
+  def send(self):
+    calls, self.calls = self.calls, []
+    for start in range(0, len(calls), self.max_size):
+      chunk = calls[start:start + self.max_size]
+      results = self.client.run_batch([(method, params) for method, params, future in chunk])
+      for (method, params, future), result in zip(chunk, results):
+        if isinstance(result, ProtocolError):
+          future.set_error(result)
+        else:
+          future.set_result(result)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.send()
+
+
 class BitcoinClient:
 
-  def __init__(self, account=None):
+  def __init__(self, account=None, url=None):
     self.account = account
+    # Defaults to the bitcoind from settings_local
+    self.url = url or rpc_url()
+    self.failures = 0
+    self.retry_at = 0
+    self.health_lock = threading.Lock()
+    # Per thread keep_alive state
+    self.local = threading.local()
     self.connect()
 
   def connect(self):
-    try_factor = 1
+    # jsonrpclib connects lazily, on the first call
+    self.transport = TimeoutTransport()
+    self.server = jsonrpclib.Server(self.url, transport=self.transport)
 
-    while 1:
-      try:
-        self.server = jsonrpclib.Server('http://{0}:{1}@{2}:{3}'.format(
-            BITCOIND_RPC_USERNAME,
-            BITCOIND_RPC_PASSWORD,
-            BITCOIND_RPC_HOST,
-            BITCOIND_RPC_PORT))
-        socket.setdefaulttimeout(None)
-        self.server.help()
+  def for_worker(self):
+    """
+    Client for another worker thread or process, a single connection
+    can't be shared
+    """
+    return BitcoinClient(self.account, self.url)
+
+  @contextmanager
+  def connection(self):
+    yield self.server
+
+  @contextmanager
+  def call_timeout(self, timeout):
+    """
+    Timeout of calls made within the block, None for none
+    """
+    previous = self.transport.timeout
+    self.transport.timeout = timeout
+    try:
+      yield
+    finally:
+      self.transport.timeout = previous
+
+  def circuit_open(self):
+    return time.time() < self.retry_at
+
+  def check_circuit(self):
+    if self.circuit_open():
+      raise BitcoindUnavailable('bitcoind unavailable, retrying in {:.0f}s'.format(self.retry_at - time.time()))
+
+  def connection_failed(self):
+    with self.health_lock:
+      self.failures += 1
+      if self.failures < CIRCUIT_FAILURE_THRESHOLD:
         return
-      except:
-        try_factor *= 2
 
-        if try_factor > 512:
-          logging.critical('can\'t connect to bitcoind server')
-          return
+      # One call is let through after the delay, failing again doubles it
+      delay = min(RECONNECT_MAX_DELAY,
+          RECONNECT_MIN_DELAY * 2 ** (self.failures - CIRCUIT_FAILURE_THRESHOLD))
+      self.retry_at = time.time() + delay
+    logging.warning('can\'t connect to bitcoind server, next try in {}s'.format(delay))
+
+  def connection_ok(self):
+    with self.health_lock:
+      if self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+        logging.info('connection to bitcoind server restored')
+      self.failures = 0
+      self.retry_at = 0
 
-        logging.info('can\'t connect to bitcoind server, waiting {}'.format(try_factor))
-        time.sleep(try_factor)
+  def batch(self, max_size=BATCH_MAX_SIZE):
+    return RPCBatch(self, max_size)
 
-  def keep_alive(fun):
-    def ping_and_reconnect(self, *args, **kwargs):
+  @keep_alive
+  def run_batch(self, calls):
+    """
+    Sends (method, params) calls in one request. Returns their results in
+    order, failed calls get the ProtocolError instead of a result
+    """
+    if not calls:
+      return []
+
+    with self.connection() as server:
+      multicall = jsonrpclib.MultiCall(server)
+      for method, params in calls:
+        getattr(multicall, method)(*params)
+      responses = multicall()
+
+    results = []
+    for number in range(len(calls)):
       try:
-        # Cheap API call that checks wether we're connected
-        self.server.help()
-        response = fun(self, *args, **kwargs)
-        return response
-      except:
-        self.connect()
-      return fun(self, *args, **kwargs)
-    return ping_and_reconnect
+        results.append(responses[number])
+      except jsonrpclib.ProtocolError as e:
+        # Same error single calls get from bitcoind's HTTP 500 responses
+        try:
+          code, message = e.args[0]
+        except (TypeError, ValueError):
+          code, message = -1, str(e)
+        results.append(ProtocolError(BITCOIND_RPC_HOST, code, message, {}))
+    return results
+
+  def decoded_transaction(self, hex_transaction):
+    """
+    decoderawtransaction through the shared cache. Returned dict is
+    shared too, it must not be modified
+    """
+    key = hashlib.sha256(hex_transaction).digest()
+    return decoded_transactions.get_or_create(key,
+        lambda: self.decode_transaction_uncached(hex_transaction))
+
+  def decode_transaction_uncached(self, hex_transaction):
+    if not settings.LOCAL_DECODING:
+      return self.server.decoderawtransaction(hex_transaction)
+
+    try:
+      return decode_transaction(hex_transaction)
+    except TransactionDecodeError as e:
+      # Same error bitcoind gives (RPC_DESERIALIZATION_ERROR)
+      raise ProtocolError(BITCOIND_RPC_HOST, -22, 'TX decode failed: {}'.format(e), {})
 
   @keep_alive
   def decode_raw_transaction(self, hex_transaction):
-    return self.server.decoderawtransaction(hex_transaction)
+    return copy.deepcopy(self.decoded_transaction(hex_transaction))
+
+  @keep_alive
+  def decoded_transactions(self, hex_transactions):
+    """
+    decoded_transaction of every transaction, None for the ones that can't
+    be decoded. Returned dicts are shared, they must not be modified
+    """
+    decoded = []
+    for hex_transaction in hex_transactions:
+      try:
+        decoded.append(self.decoded_transaction(hex_transaction))
+      except ProtocolError:
+        decoded.append(None)
+    return decoded
 
   @keep_alive
   def get_json_transaction(self, hex_transaction):
-    return self.server.decoderawtransaction(hex_transaction)
+    return copy.deepcopy(self.decoded_transaction(hex_transaction))
 
   @keep_alive
   def sign_transaction(self, raw_transaction, prevtx = [], priv_keys=None):
@@ -68,12 +372,12 @@ class BitcoinClient:
 
   @keep_alive
   def get_txid(self, raw_transaction):
-    transaction_dict = self.server.decoderawtransaction(raw_transaction)
+    transaction_dict = self.decoded_transaction(raw_transaction)
     return transaction_dict['txid']
 
   @keep_alive
   def signatures_count(self, raw_transaction, prevtx):
-    transaction_dict = self.server.decoderawtransaction(raw_transaction)
+    transaction_dict = self.decoded_transaction(raw_transaction)
 
     prevtx_dict = {}
     for tx in prevtx:
@@ -89,7 +393,7 @@ class BitcoinClient:
         continue
       asm_elements = asm.split()
       try:
-        asm_script_dict = self.server.decodescript(redeem_script)
+        asm_script_dict = self.decoded_script(redeem_script)
         int(asm_script_dict['reqSigs'])
       except KeyError:
         logging.error('script is missing reqSigs field')
@@ -108,7 +412,7 @@ class BitcoinClient:
 
   @keep_alive
   def signatures(self, raw_transaction, prevtx):
-    transaction_dict = self.server.decoderawtransaction(raw_transaction)
+    transaction_dict = self.decoded_transaction(raw_transaction)
 
     prevtx_dict = {}
     for tx in prevtx:
@@ -124,7 +428,7 @@ class BitcoinClient:
         continue
       asm_elements = asm.split()
       try:
-        asm_script_dict = self.server.decodescript(redeem_script)
+        asm_script_dict = self.decoded_script(redeem_script)
         int(asm_script_dict['reqSigs'])
       except KeyError:
         logging.error('script is missing reqSigs field')
@@ -140,24 +444,82 @@ class BitcoinClient:
   def is_valid_transaction(self, raw_transaction):
     # Is raw transaction valid and decodable?
     try:
-      self.server.decoderawtransaction(raw_transaction)
+      self.decoded_transaction(raw_transaction)
     except ProtocolError:
       logging.exception('tx invalid')
       return False
     return True
 
   @keep_alive
-  def address_is_mine(self, address):
+  def load_wallet_index(self):
+    """
+    Indexes the addresses of the wallet we hold keys for, with one batch
+    of validateaddress calls
+    """
+    entries = self.server.listreceivedbyaddress(0, True)
+    with self.batch() as batch:
+      futures = [batch.validateaddress(entry['address']) for entry in entries]
+
+    keys = []
+    for future in futures:
+      result = future.result()
+      if result.get('ismine'):
+        keys.append((result['address'], result.get('pubkey')))
+    wallet_index.update(keys)
+    logging.info('indexed {} own addresses'.format(len(keys)))
+
+  def ensure_wallet_index(self):
+    if not wallet_index.is_stale():
+      return
+    with wallet_index.load_lock:
+      # Another thread may have loaded it while we waited
+      if wallet_index.is_stale():
+        self.load_wallet_index()
+
+  def index_new_address(self, address):
     result = self.server.validateaddress(address)
-    return result['ismine']
+    wallet_index.add(address, result.get('pubkey'))
+
+  @keep_alive
+  def address_is_mine(self, address):
+    self.ensure_wallet_index()
+    return wallet_index.is_mine(address)
+
+  @keep_alive
+  def get_my_turn(self, redeem_script):
+    """
+    Position of our key among the sorted addresses of a multisig redeem
+    script, -1 if it doesn't include us
+    """
+    self.ensure_wallet_index()
+    return wallet_index.turn(redeem_script,
+        lambda: self.decoded_script(redeem_script)['addresses'])
+
+  def decoded_script(self, script):
+    """
+    decodescript through the shared cache. Returned dict is shared too,
+    it must not be modified
+    """
+    return decoded_scripts.get_or_create(script,
+        lambda: self.decode_script_uncached(script))
+
+  def decode_script_uncached(self, script):
+    if not settings.LOCAL_DECODING:
+      return self.server.decodescript(script)
+
+    try:
+      return decode_script(binascii.unhexlify(script))
+    except (TypeError, ValueError):
+      # Same error bitcoind gives (RPC_INVALID_PARAMETER)
+      raise ProtocolError(BITCOIND_RPC_HOST, -8, 'argument must be hexadecimal string', {})
 
   @keep_alive
   def decode_script(self, script):
-    return self.server.decodescript(script)
+    return copy.deepcopy(self.decoded_script(script))
 
   @keep_alive
   def get_inputs_outputs(self, raw_transaction):
-    transaction_dict = self.server.decoderawtransaction(raw_transaction)
+    transaction_dict = self.decoded_transaction(raw_transaction)
     vin = transaction_dict["vin"]
     vouts = transaction_dict["vout"]
     result = (
@@ -183,7 +545,7 @@ class BitcoinClient:
       return True
     return False
 
-  @keep_alive
+  @keep_alive_once
   def transaction_need_signature(self, raw_transaction):
     """
     This is shameful ugly function. It tries to send transaction to network
@@ -198,7 +560,7 @@ class BitcoinClient:
 
   @keep_alive
   def transaction_contains_output(self, raw_transaction, address, fee):
-    transaction_dict = self.server.decoderawtransaction(raw_transaction)
+    transaction_dict = self.decoded_transaction(raw_transaction)
     if not 'vout' in transaction_dict:
       return False
     for vout in transaction_dict['vout']:
@@ -230,6 +592,32 @@ class BitcoinClient:
     keys = sorted(keys)
     return self.server.createmultisig(min_sigs, keys)
 
+  def multisig_address(self, min_sigs, keys):
+    """
+    Address create_multisig_address returns for hex pubkeys, computed
+    without calling bitcoind
+    """
+    pubkeys = [binascii.unhexlify(key) for key in sorted(keys)]
+    return script_address(multisig_script(int(min_sigs), pubkeys))
+
+  @keep_alive
+  def check_address_versions(self, address, pubkey):
+    """
+    Compares addresses computed locally (multisig_address, local decoding)
+    with bitcoind's for our address and its hex pubkey, raises
+    AddressVersionError if they differ
+    """
+    multisig = self.create_multisig_address(1, [pubkey])['address']
+    local_multisig = self.multisig_address(1, [pubkey])
+    if multisig != local_multisig:
+      raise AddressVersionError('bitcoind multisig address {} is {} locally, check SCRIPT_ADDRESS_VERSION'.format(
+          multisig, local_multisig))
+
+    local_address = pubkey_address(binascii.unhexlify(pubkey))
+    if address != local_address:
+      raise AddressVersionError('bitcoind address {} is {} locally, check PUBKEY_ADDRESS_VERSION'.format(
+          address, local_address))
+
   @keep_alive
   def add_multisig_address(self, min_sigs, keys):
     keys = sorted(keys)
@@ -241,11 +629,14 @@ class BitcoinClient:
   def create_raw_transaction(self, tx_inputs, outputs):
     return self.server.createrawtransaction(tx_inputs, outputs)
 
-  @keep_alive
+  @keep_alive_once
   def get_new_address(self):
     if self.account:
-      return self.server.getnewaddress(self.account)
-    return self.server.getnewaddress()
+      address = self.server.getnewaddress(self.account)
+    else:
+      address = self.server.getnewaddress()
+    self.index_new_address(address)
+    return address
 
   @keep_alive
   def get_addresses_for_account(self, account):
@@ -275,3 +666,78 @@ class BitcoinClient:
   @keep_alive
   def get_raw_transaction(self, txid):
     return self.server.getrawtransaction(txid)
+
+
+class PooledServer:
+  """
+  Stands in for jsonrpclib.Server in PooledBitcoinClient, every call runs
+  on a connection checked out of the pool
+  """
+  def __init__(self, client):
+    self.client = client
+
+  def __getattr__(self, method):
+    if method.startswith('_'):
+      raise AttributeError(method)
+
+    def call(*params):
+      with self.client.connection() as server:
+        return getattr(server, method)(*params)
+    return call
+
+
+class PooledBitcoinClient(BitcoinClient):
+  """
+  BitcoinClient safe to share between threads. It keeps size persistent
+  connections to bitcoind and every call takes one of them, so up to size
+  calls run in parallel and the rest wait for a free connection.
+
+  Calls time out after timeout seconds, slower ones can be given more
+  time with call_timeout:
+
+    with btc.call_timeout(300):
+      btc.sign_transaction(tx, prevtxs)
+  """
+  def __init__(self, size=POOL_SIZE, account=None, timeout=POOL_RPC_TIMEOUT, url=None):
+    self.size = size
+    self.timeout = timeout
+    # Sockets opened before a fork can't be used by both processes
+    self.pid = os.getpid()
+
+    BitcoinClient.__init__(self, account, url)
+
+    self.connections = Queue.Queue()
+    for _ in range(size):
+      transport = TimeoutTransport(timeout)
+      self.connections.put((jsonrpclib.Server(self.url, transport=transport), transport))
+
+  def connect(self):
+    # Transports drop a broken connection and open a new one on their
+    # next call, there's nothing to rebuild
+    self.server = PooledServer(self)
+
+  def for_worker(self):
+    if os.getpid() == self.pid:
+      return self
+    return PooledBitcoinClient(self.size, self.account, self.timeout, self.url)
+
+  @contextmanager
+  def connection(self):
+    server, transport = self.connections.get()
+    try:
+      transport.timeout = getattr(self.local, 'timeout', self.timeout)
+      yield server
+    finally:
+      self.connections.put((server, transport))
+
+  @contextmanager
+  def call_timeout(self, timeout):
+    """
+    Timeout of calls made by this thread within the block, None for none
+    """
+    previous = getattr(self.local, 'timeout', self.timeout)
+    self.local.timeout = timeout
+    try:
+      yield
+    finally:
+      self.local.timeout = previous
@@ -0,0 +1,80 @@
+# Pure Python RIPEMD-160
+#
+# Only used when neither hashlib (OpenSSL builds without legacy digests)
+# nor pycrypto provide it, see script.hash160
+
+import struct
+
+# Selection of message words and amounts of left rotation, left and right lines
+R_LEFT = [
+    0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15,
+    7, 4, 13, 1, 10, 6, 15, 3, 12, 0, 9, 5, 2, 14, 11, 8,
+    3, 10, 14, 4, 9, 15, 8, 1, 2, 7, 0, 6, 13, 11, 5, 12,
+    1, 9, 11, 10, 0, 8, 12, 4, 13, 3, 7, 15, 14, 5, 6, 2,
+    4, 0, 5, 9, 7, 12, 2, 10, 14, 1, 3, 8, 11, 6, 15, 13]
+R_RIGHT = [
+    5, 14, 7, 0, 9, 2, 11, 4, 13, 6, 15, 8, 1, 10, 3, 12,
+    6, 11, 3, 7, 0, 13, 5, 10, 14, 15, 8, 12, 4, 9, 1, 2,
+    15, 5, 1, 3, 7, 14, 6, 9, 11, 8, 12, 2, 10, 0, 4, 13,
+    8, 6, 4, 1, 3, 11, 15, 0, 5, 12, 2, 13, 9, 7, 10, 14,
+    12, 15, 10, 4, 1, 5, 8, 7, 6, 2, 13, 14, 0, 3, 9, 11]
+S_LEFT = [
+    11, 14, 15, 12, 5, 8, 7, 9, 11, 13, 14, 15, 6, 7, 9, 8,
+    7, 6, 8, 13, 11, 9, 7, 15, 7, 12, 15, 9, 11, 7, 13, 12,
+    11, 13, 6, 7, 14, 9, 13, 15, 14, 8, 13, 6, 5, 12, 7, 5,
+    11, 12, 14, 15, 14, 15, 9, 8, 9, 14, 5, 6, 8, 6, 5, 12,
+    9, 15, 5, 11, 6, 8, 13, 12, 5, 12, 13, 14, 11, 8, 5, 6]
+S_RIGHT = [
+    8, 9, 9, 11, 13, 15, 15, 5, 7, 7, 8, 11, 14, 14, 12, 6,
+    9, 13, 15, 7, 12, 8, 9, 11, 7, 7, 12, 7, 6, 15, 13, 11,
+    9, 7, 15, 11, 8, 6, 6, 14, 12, 13, 5, 14, 13, 13, 7, 5,
+    15, 5, 8, 11, 14, 14, 6, 14, 6, 9, 12, 9, 12, 5, 15, 8,
+    8, 5, 12, 9, 12, 5, 14, 6, 8, 13, 6, 5, 15, 13, 11, 11]
+K_LEFT = [0x00000000, 0x5a827999, 0x6ed9eba1, 0x8f1bbcdc, 0xa953fd4e]
+K_RIGHT = [0x50a28be6, 0x5c4dd124, 0x6d703ef3, 0x7a6d76e9, 0x00000000]
+
+MASK = 0xffffffff
+
+def f(j, x, y, z):
+  if j < 16:
+    return x ^ y ^ z
+  if j < 32:
+    return (x & y) | (~x & z)
+  if j < 48:
+    return (x | ~y) ^ z
+  if j < 64:
+    return (x & z) | (y & ~z)
+  return x ^ (y | ~z)
+
+def rotl(x, n):
+  return ((x << n) | (x >> (32 - n))) & MASK
+
+def compress(h, block):
+  x = struct.unpack('<16L', block)
+  al, bl, cl, dl, el = h
+  ar, br, cr, dr, er = h
+
+  for j in range(80):
+    round = j / 16
+    t = rotl((al + f(j, bl, cl, dl) + x[R_LEFT[j]] + K_LEFT[round]) & MASK, S_LEFT[j]) + el
+    al, el, dl, cl, bl = el, dl, rotl(cl, 10), bl, t & MASK
+
+    t = rotl((ar + f(79 - j, br, cr, dr) + x[R_RIGHT[j]] + K_RIGHT[round]) & MASK, S_RIGHT[j]) + er
+    ar, er, dr, cr, br = er, dr, rotl(cr, 10), br, t & MASK
+
+  t = (h[1] + cl + dr) & MASK
+  return [
+      t,
+      (h[2] + dl + er) & MASK,
+      (h[3] + el + ar) & MASK,
+      (h[4] + al + br) & MASK,
+      (h[0] + bl + cr) & MASK]
+
+def ripemd160(data):
+  h = [0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476, 0xc3d2e1f0]
+
+  padded = data + '\x80' + '\x00' * ((55 - len(data)) % 64) + struct.pack('<Q', 8 * len(data))
+  for start in range(0, len(padded), 64):
+    h = compress(h, padded[start:start + 64])
+
+  return struct.pack('<5L', *h)
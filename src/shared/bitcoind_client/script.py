@@ -0,0 +1,275 @@
+# Local bitcoin script helpers: hashes, addresses, disassembly and
+# classification of output scripts, producing the same fields bitcoind
+# does in decoderawtransaction
+
+from shared.settings import PUBKEY_ADDRESS_VERSION, SCRIPT_ADDRESS_VERSION
+
+import hashlib
+import struct
+
+OP_0 = 0x00
+OP_PUSHDATA1 = 0x4c
+OP_PUSHDATA2 = 0x4d
+OP_PUSHDATA4 = 0x4e
+OP_1NEGATE = 0x4f
+OP_1 = 0x51
+OP_16 = 0x60
+OP_RETURN = 0x6a
+OP_DUP = 0x76
+OP_EQUAL = 0x87
+OP_EQUALVERIFY = 0x88
+OP_HASH160 = 0xa9
+OP_CHECKSIG = 0xac
+OP_CHECKMULTISIG = 0xae
+
+# Largest OP_RETURN output script bitcoind considers standard nulldata
+MAX_NULLDATA_SIZE = 83
+
+OPCODE_NAMES = {
+    0x4f: '-1', 0x50: 'OP_RESERVED',
+    0x61: 'OP_NOP', 0x62: 'OP_VER', 0x63: 'OP_IF', 0x64: 'OP_NOTIF',
+    0x65: 'OP_VERIF', 0x66: 'OP_VERNOTIF', 0x67: 'OP_ELSE', 0x68: 'OP_ENDIF',
+    0x69: 'OP_VERIFY', 0x6a: 'OP_RETURN',
+    0x6b: 'OP_TOALTSTACK', 0x6c: 'OP_FROMALTSTACK', 0x6d: 'OP_2DROP',
+    0x6e: 'OP_2DUP', 0x6f: 'OP_3DUP', 0x70: 'OP_2OVER', 0x71: 'OP_2ROT',
+    0x72: 'OP_2SWAP', 0x73: 'OP_IFDUP', 0x74: 'OP_DEPTH', 0x75: 'OP_DROP',
+    0x76: 'OP_DUP', 0x77: 'OP_NIP', 0x78: 'OP_OVER', 0x79: 'OP_PICK',
+    0x7a: 'OP_ROLL', 0x7b: 'OP_ROT', 0x7c: 'OP_SWAP', 0x7d: 'OP_TUCK',
+    0x7e: 'OP_CAT', 0x7f: 'OP_SUBSTR', 0x80: 'OP_LEFT', 0x81: 'OP_RIGHT',
+    0x82: 'OP_SIZE', 0x83: 'OP_INVERT', 0x84: 'OP_AND', 0x85: 'OP_OR',
+    0x86: 'OP_XOR', 0x87: 'OP_EQUAL', 0x88: 'OP_EQUALVERIFY',
+    0x89: 'OP_RESERVED1', 0x8a: 'OP_RESERVED2',
+    0x8b: 'OP_1ADD', 0x8c: 'OP_1SUB', 0x8d: 'OP_2MUL', 0x8e: 'OP_2DIV',
+    0x8f: 'OP_NEGATE', 0x90: 'OP_ABS', 0x91: 'OP_NOT', 0x92: 'OP_0NOTEQUAL',
+    0x93: 'OP_ADD', 0x94: 'OP_SUB', 0x95: 'OP_MUL', 0x96: 'OP_DIV',
+    0x97: 'OP_MOD', 0x98: 'OP_LSHIFT', 0x99: 'OP_RSHIFT',
+    0x9a: 'OP_BOOLAND', 0x9b: 'OP_BOOLOR', 0x9c: 'OP_NUMEQUAL',
+    0x9d: 'OP_NUMEQUALVERIFY', 0x9e: 'OP_NUMNOTEQUAL', 0x9f: 'OP_LESSTHAN',
+    0xa0: 'OP_GREATERTHAN', 0xa1: 'OP_LESSTHANOREQUAL',
+    0xa2: 'OP_GREATERTHANOREQUAL', 0xa3: 'OP_MIN', 0xa4: 'OP_MAX',
+    0xa5: 'OP_WITHIN', 0xa6: 'OP_RIPEMD160', 0xa7: 'OP_SHA1',
+    0xa8: 'OP_SHA256', 0xa9: 'OP_HASH160', 0xaa: 'OP_HASH256',
+    0xab: 'OP_CODESEPARATOR', 0xac: 'OP_CHECKSIG', 0xad: 'OP_CHECKSIGVERIFY',
+    0xae: 'OP_CHECKMULTISIG', 0xaf: 'OP_CHECKMULTISIGVERIFY',
+    0xb0: 'OP_NOP1', 0xb1: 'OP_CHECKLOCKTIMEVERIFY', 0xb2: 'OP_CHECKSEQUENCEVERIFY',
+    0xb3: 'OP_NOP4', 0xb4: 'OP_NOP5', 0xb5: 'OP_NOP6', 0xb6: 'OP_NOP7',
+    0xb7: 'OP_NOP8', 0xb8: 'OP_NOP9', 0xb9: 'OP_NOP10',
+    0xff: 'OP_INVALIDOPCODE',
+}
+
+BASE58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+class ScriptError(Exception):
+  pass
+
+def sha256d(data):
+  return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def ripemd160(data):
+  # OpenSSL 3 builds of hashlib don't have it anymore
+  try:
+    return hashlib.new('ripemd160', data).digest()
+  except ValueError:
+    pass
+
+  try:
+    from Crypto.Hash import RIPEMD
+    return RIPEMD.new(data).digest()
+  except ImportError:
+    from ripemd160 import ripemd160 as pure_ripemd160
+    return pure_ripemd160(data)
+
+def hash160(data):
+  return ripemd160(hashlib.sha256(data).digest())
+
+def base58_encode(data):
+  n = int(data.encode('hex') or '0', 16)
+  encoded = ''
+  while n > 0:
+    n, remainder = divmod(n, 58)
+    encoded = BASE58_ALPHABET[remainder] + encoded
+
+  # Leading zero bytes are kept as '1's
+  zeros = len(data) - len(data.lstrip('\x00'))
+  return BASE58_ALPHABET[0] * zeros + encoded
+
+def base58check_encode(version, payload):
+  data = chr(version) + payload
+  return base58_encode(data + sha256d(data)[:4])
+
+def base58check_decode(encoded):
+  """
+  Returns (version, payload), raises ScriptError on an invalid string
+  """
+  n = 0
+  for char in encoded:
+    if not char in BASE58_ALPHABET:
+      raise ScriptError('invalid base58 character')
+    n = n * 58 + BASE58_ALPHABET.index(char)
+
+  digits = '{:x}'.format(n) if n else ''
+  data = '\x00' * (len(encoded) - len(encoded.lstrip(BASE58_ALPHABET[0])))
+  data += ('0' * (len(digits) % 2) + digits).decode('hex')
+
+  if len(data) < 5 or sha256d(data[:-4])[:4] != data[-4:]:
+    raise ScriptError('invalid base58 checksum')
+  return ord(data[0]), data[1:-4]
+
+def pubkey_address(pubkey):
+  return base58check_encode(PUBKEY_ADDRESS_VERSION, hash160(pubkey))
+
+def script_address(script):
+  return base58check_encode(SCRIPT_ADDRESS_VERSION, hash160(script))
+
+def push_data(data):
+  if len(data) < OP_PUSHDATA1:
+    return chr(len(data)) + data
+  if len(data) <= 0xff:
+    return chr(OP_PUSHDATA1) + chr(len(data)) + data
+  return chr(OP_PUSHDATA2) + struct.pack('<H', len(data)) + data
+
+def multisig_script(req_sigs, pubkeys):
+  """
+  m-of-n redeem script, the way createmultisig builds it
+  """
+  if not 1 <= req_sigs <= len(pubkeys) <= 16:
+    raise ScriptError('invalid multisig parameters')
+  return chr(OP_1 + req_sigs - 1) + ''.join(push_data(pubkey) for pubkey in pubkeys) \
+      + chr(OP_1 + len(pubkeys) - 1) + chr(OP_CHECKMULTISIG)
+
+def address_script(address):
+  """
+  Output script paying to a pubkeyhash or scripthash address
+  """
+  version, payload = base58check_decode(address)
+  if len(payload) != 20:
+    raise ScriptError('invalid address length')
+  if version == PUBKEY_ADDRESS_VERSION:
+    return chr(OP_DUP) + chr(OP_HASH160) + push_data(payload) + chr(OP_EQUALVERIFY) + chr(OP_CHECKSIG)
+  if version == SCRIPT_ADDRESS_VERSION:
+    return chr(OP_HASH160) + push_data(payload) + chr(OP_EQUAL)
+  raise ScriptError('unknown address version')
+
+def script_ops(script):
+  """
+  Yields (opcode, pushed data or None) for every operation of the script,
+  raises ScriptError on a truncated push
+  """
+  position = 0
+  while position < len(script):
+    opcode = ord(script[position])
+    position += 1
+
+    if opcode > OP_PUSHDATA4:
+      yield opcode, None
+      continue
+
+    if opcode < OP_PUSHDATA1:
+      size = opcode
+    else:
+      width = {OP_PUSHDATA1: 1, OP_PUSHDATA2: 2, OP_PUSHDATA4: 4}[opcode]
+      if position + width > len(script):
+        raise ScriptError('truncated push')
+      size = struct.unpack('<' + {1: 'B', 2: 'H', 4: 'L'}[width], script[position:position + width])[0]
+      position += width
+
+    if position + size > len(script):
+      raise ScriptError('truncated push')
+    yield opcode, script[position:position + size]
+    position += size
+
+def script_number(data):
+  # Little-endian, sign bit in the last byte
+  if not data:
+    return 0
+  n = int(data[::-1].encode('hex'), 16)
+  if ord(data[-1]) & 0x80:
+    return -(n & ~(0x80 << (8 * (len(data) - 1))))
+  return n
+
+def disassemble(script):
+  """
+  Script in bitcoind's asm notation: pushes up to 4 bytes as numbers,
+  longer ones as hex, opcodes by name
+  """
+  parts = []
+  try:
+    for opcode, data in script_ops(script):
+      if data is not None:
+        if len(data) <= 4:
+          parts.append(str(script_number(data)))
+        else:
+          parts.append(data.encode('hex'))
+      elif OP_1 <= opcode <= OP_16:
+        parts.append(str(opcode - OP_1 + 1))
+      else:
+        parts.append(OPCODE_NAMES.get(opcode, 'OP_UNKNOWN'))
+  except ScriptError:
+    parts.append('[error]')
+  return ' '.join(parts)
+
+def small_int(opcode):
+  if OP_1 <= opcode <= OP_16:
+    return opcode - OP_1 + 1
+  return None
+
+def is_pubkey(data):
+  return data is not None and len(data) in (33, 65)
+
+def classify(script):
+  """
+  Returns (type, reqSigs, addresses) of an output script, the last two
+  are None for nulldata and nonstandard scripts
+  """
+  try:
+    ops = list(script_ops(script))
+  except ScriptError:
+    return 'nonstandard', None, None
+  opcodes = [opcode for opcode, data in ops]
+
+  if len(script) == 23 and opcodes == [OP_HASH160, 20, OP_EQUAL]:
+    return 'scripthash', 1, [base58check_encode(SCRIPT_ADDRESS_VERSION, ops[1][1])]
+
+  if len(ops) == 5 and opcodes[:2] == [OP_DUP, OP_HASH160] and opcodes[3:] == [OP_EQUALVERIFY, OP_CHECKSIG] \
+      and ops[2][1] is not None and len(ops[2][1]) == 20:
+    return 'pubkeyhash', 1, [base58check_encode(PUBKEY_ADDRESS_VERSION, ops[2][1])]
+
+  if len(ops) == 2 and is_pubkey(ops[0][1]) and opcodes[1] == OP_CHECKSIG:
+    return 'pubkey', 1, [pubkey_address(ops[0][1])]
+
+  if len(ops) >= 4 and opcodes[-1] == OP_CHECKMULTISIG:
+    req_sigs, total = small_int(opcodes[0]), small_int(opcodes[-2])
+    pubkeys = [data for opcode, data in ops[1:-2]]
+    if req_sigs and total and req_sigs <= total == len(pubkeys) and all(is_pubkey(pubkey) for pubkey in pubkeys):
+      return 'multisig', req_sigs, [pubkey_address(pubkey) for pubkey in pubkeys]
+
+  if opcodes and opcodes[0] == OP_RETURN and len(script) <= MAX_NULLDATA_SIZE \
+      and all(data is not None or opcode <= OP_16 for opcode, data in ops[1:]):
+    return 'nulldata', None, None
+
+  return 'nonstandard', None, None
+
+def decode_script_pubkey(script):
+  """
+  scriptPubKey entry of a decoded transaction output
+  """
+  script_type, req_sigs, addresses = classify(script)
+
+  decoded = {
+      'asm': disassemble(script),
+      'hex': script.encode('hex'),
+      'type': script_type,
+  }
+  if addresses is not None:
+    decoded['reqSigs'] = req_sigs
+    decoded['addresses'] = addresses
+  return decoded
+
+def decode_script(script):
+  """
+  Same fields as bitcoind's decodescript, e.g. for m-of-n multisig redeem
+  scripts: reqSigs, addresses of the pubkeys and the P2SH address
+  """
+  decoded = decode_script_pubkey(script)
+  decoded['p2sh'] = script_address(script)
+  return decoded
@@ -0,0 +1,260 @@
+# Run from src/ with: python2 -m unittest shared.bitcoind_client.tests
+
+from shared.bitcoind_client.script import (
+    ScriptError,
+    address_script,
+    base58check_decode,
+    base58check_encode,
+    decode_script,
+    disassemble,
+    hash160,
+    multisig_script,
+    script_address)
+from shared.bitcoind_client.transaction import TransactionDecodeError, decode_transaction, encode_transaction
+from shared.bitcoind_client.wallet_index import WalletIndex
+
+import struct
+import unittest
+
+# Transactions with their decoderawtransaction output recorded from bitcoind
+# (0.9/0.10 asm notation, signatures without sighash suffix)
+GENESIS_COINBASE = (
+    '01000000010000000000000000000000000000000000000000000000000000000000000000ffffffff4d04ffff001d01'
+    '04455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b206f6620'
+    '7365636f6e64206261696c6f757420666f722062616e6b73ffffffff0100f2052a01000000434104678afdb0fe554827'
+    '1967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d57'
+    '8a4c702b6bf11d5fac00000000')
+
+GENESIS_COINBASE_DECODED = {
+    'txid': '4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b',
+    'version': 1,
+    'locktime': 0,
+    'vin': [{
+        'coinbase': '04ffff001d0104455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f'
+                    '6e206272696e6b206f66207365636f6e64206261696c6f757420666f722062616e6b73',
+        'sequence': 4294967295,
+    }],
+    'vout': [{
+        'value': 50.0,
+        'n': 0,
+        'scriptPubKey': {
+            'asm': '04678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504'
+                   'e51ec112de5c384df7ba0b8d578a4c702b6bf11d5f OP_CHECKSIG',
+            'hex': '4104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f355'
+                   '04e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac',
+            'reqSigs': 1,
+            'type': 'pubkey',
+            'addresses': ['1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa'],
+        },
+    }],
+}
+
+# First transaction between two people, block 170
+BLOCK_170_TRANSFER = (
+    '0100000001c997a5e56e104102fa209c6a852dd90660a20b2d9c352423edce25857fcd3704000000004847304402204e'
+    '45e16932b8af514961a1d3a1a25fdf3f4f7732e9d624c6c61548ab5fb8cd410220181522ec8eca07de4860a4acdd1290'
+    '9d831cc56cbbac4622082221a8768d1d0901ffffffff0200ca9a3b00000000434104ae1a62fe09c5f51b13905f07f06b'
+    '99a2f7159b2225f374cd378d71302fa28414e7aab37397f554a7df5f142c21c1b7303b8a0626f1baded5c72a704f7e6c'
+    'd84cac00286bee0000000043410411db93e1dcdb8a016b49840f8c53bc1eb68a382e97b1482ecad7b148a6909a5cb2e0'
+    'eaddfb84ccf9744464f82e160bfa9b8b64f9d4c03f999b8643f656b412a3ac00000000')
+
+BLOCK_170_SIGNATURE = (
+    '304402204e45e16932b8af514961a1d3a1a25fdf3f4f7732e9d624c6c61548ab5fb8cd410220181522ec8eca07de4860'
+    'a4acdd12909d831cc56cbbac4622082221a8768d1d0901')
+
+BLOCK_170_TRANSFER_DECODED = {
+    'txid': 'f4184fc596403b9d638783cf57adfe4c75c605f6356fbc91338530e9831e9e16',
+    'version': 1,
+    'locktime': 0,
+    'vin': [{
+        'txid': '0437cd7f8525ceed2324359c2d0ba26006d92d856a9c20fa0241106ee5a597c9',
+        'vout': 0,
+        'scriptSig': {
+            'asm': BLOCK_170_SIGNATURE,
+            'hex': '47' + BLOCK_170_SIGNATURE,
+        },
+        'sequence': 4294967295,
+    }],
+    'vout': [{
+        'value': 10.0,
+        'n': 0,
+        'scriptPubKey': {
+            'asm': '04ae1a62fe09c5f51b13905f07f06b99a2f7159b2225f374cd378d71302fa28414e7aab37397f554a7df5f14'
+                   '2c21c1b7303b8a0626f1baded5c72a704f7e6cd84c OP_CHECKSIG',
+            'hex': '4104ae1a62fe09c5f51b13905f07f06b99a2f7159b2225f374cd378d71302fa28414e7aab37397f554a7df5f'
+                   '142c21c1b7303b8a0626f1baded5c72a704f7e6cd84cac',
+            'reqSigs': 1,
+            'type': 'pubkey',
+            'addresses': ['1Q2TWHE3GMdB6BZKafqwxXtWAWgFt5Jvm3'],
+        },
+    }, {
+        'value': 40.0,
+        'n': 1,
+        'scriptPubKey': {
+            'asm': '0411db93e1dcdb8a016b49840f8c53bc1eb68a382e97b1482ecad7b148a6909a5cb2e0eaddfb84ccf9744464'
+                   'f82e160bfa9b8b64f9d4c03f999b8643f656b412a3 OP_CHECKSIG',
+            'hex': '410411db93e1dcdb8a016b49840f8c53bc1eb68a382e97b1482ecad7b148a6909a5cb2e0eaddfb84ccf97444'
+                   '64f82e160bfa9b8b64f9d4c03f999b8643f656b412a3ac',
+            'reqSigs': 1,
+            'type': 'pubkey',
+            'addresses': ['12cbQLTFMXRnSzktFkuoG3eHoMeFtpTu3S'],
+        },
+    }],
+}
+
+# 2 of 4 multisig used by the client, and its P2SH output script
+REDEEM_SCRIPT = (
+    '52210281cf9fa9241f0a9799f27a4d5d60cff74f30eed1d536bf7a72d3dec936c151632102e8e22190b0adfefd0962c6'
+    '332e74ab68831d56d0bfc2b01b32beccd56e3ef6f021035ff60e6745093b9bcbae93082e1c50ca5b3fcf8bcd186a46da'
+    '46ded5132530522103a9bd3bfbd9f9b1719d3ecad8658796dc5e778177d77145b5c37247eb3060861854ae')
+P2SH_SCRIPT_PUBKEY = 'a914a37ce66d7065157037e90ca4d4b4a20d8d865a2687'
+
+GENESIS_PUBKEY = (
+    '04678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112'
+    'de5c384df7ba0b8d578a4c702b6bf11d5f')
+
+def build_transaction(inputs, outputs, locktime=0):
+  """
+  Serializes (txid, vout, scriptSig hex) inputs and (satoshis, script hex) outputs
+  """
+  def varint(n):
+    assert n < 0xfd
+    return chr(n)
+
+  data = struct.pack('<l', 1) + varint(len(inputs))
+  for txid, vout, script in inputs:
+    script = script.decode('hex')
+    data += txid.decode('hex')[::-1] + struct.pack('<L', vout) + varint(len(script)) + script
+    data += struct.pack('<L', 0xffffffff)
+  data += varint(len(outputs))
+  for value, script in outputs:
+    script = script.decode('hex')
+    data += struct.pack('<q', value) + varint(len(script)) + script
+  data += struct.pack('<L', locktime)
+  return data.encode('hex')
+
+def push(data_hex):
+  return chr(len(data_hex) / 2).encode('hex') + data_hex
+
+
+class TransactionDecoderTests(unittest.TestCase):
+  def test_recorded_coinbase(self):
+    self.assertEquals(decode_transaction(GENESIS_COINBASE), GENESIS_COINBASE_DECODED)
+
+  def test_recorded_transfer(self):
+    self.assertEquals(decode_transaction(BLOCK_170_TRANSFER), BLOCK_170_TRANSFER_DECODED)
+
+  def test_multisig_spend(self):
+    signature = '30' + '11' * 70 + '01'
+    script_sig = '00' + push(signature) + '00' + '4c' + chr(len(REDEEM_SCRIPT) / 2).encode('hex') + REDEEM_SCRIPT
+    pubkey_hash_script = '76a914' + hash160(GENESIS_PUBKEY.decode('hex')).encode('hex') + '88ac'
+    tx = build_transaction(
+        [('10a3ab54e1e19701fcb86c7725621b5b1b26415f94363de35a493ba9ca502b15', 0, script_sig)],
+        [(12345, P2SH_SCRIPT_PUBKEY), (3000, pubkey_hash_script), (0, '6a0568656c6c6f')],
+        locktime=1402318623)
+
+    decoded = decode_transaction(tx)
+
+    self.assertEquals(decoded['locktime'], 1402318623)
+    # Signature counting in BitcoinClient relies on this layout
+    self.assertEquals(decoded['vin'][0]['scriptSig']['asm'].split(), ['0', signature, '0', REDEEM_SCRIPT])
+
+    p2sh, p2pkh, nulldata = [vout['scriptPubKey'] for vout in decoded['vout']]
+    self.assertEquals(decoded['vout'][0]['value'], 0.00012345)
+    self.assertEquals(p2sh['type'], 'scripthash')
+    self.assertEquals(p2sh['addresses'], [script_address(REDEEM_SCRIPT.decode('hex'))])
+    self.assertEquals(p2sh['asm'], 'OP_HASH160 a37ce66d7065157037e90ca4d4b4a20d8d865a26 OP_EQUAL')
+    self.assertEquals(p2pkh['type'], 'pubkeyhash')
+    self.assertEquals(p2pkh['addresses'], ['1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa'])
+    self.assertEquals(nulldata, {'asm': 'OP_RETURN 68656c6c6f', 'hex': '6a0568656c6c6f', 'type': 'nulldata'})
+
+  def test_txid_ignores_witness(self):
+    legacy = BLOCK_170_TRANSFER
+    # Same transaction with marker, flag and one witness item for the input
+    outputs_end = len(legacy) - 8
+    segwit = legacy[:8] + '0001' + legacy[8:outputs_end] + '01' + '02abcd' + legacy[outputs_end:]
+
+    decoded = decode_transaction(segwit)
+    self.assertEquals(decoded['txid'], BLOCK_170_TRANSFER_DECODED['txid'])
+    self.assertEquals(decoded['vin'][0]['txinwitness'], ['abcd'])
+
+  def test_encode_round_trip(self):
+    decoded = decode_transaction(BLOCK_170_TRANSFER)
+    inputs = [(vin['txid'], vin['vout'], vin['scriptSig']['hex'].decode('hex'), vin['sequence']) for vin in decoded['vin']]
+    outputs = [(int(vout['value'] * 100000000), vout['scriptPubKey']['hex'].decode('hex')) for vout in decoded['vout']]
+
+    self.assertEquals(encode_transaction(inputs, outputs), BLOCK_170_TRANSFER)
+
+  def test_rejects_malformed(self):
+    for tx in ['', 'zz', GENESIS_COINBASE[:-2], GENESIS_COINBASE + '00']:
+      self.assertRaises(TransactionDecodeError, decode_transaction, tx)
+
+
+class ScriptTests(unittest.TestCase):
+  def test_p2sh_of_redeem_script(self):
+    self.assertEquals('a914' + hash160(REDEEM_SCRIPT.decode('hex')).encode('hex') + '87', P2SH_SCRIPT_PUBKEY)
+
+  def test_multisig_redeem_script(self):
+    decoded = decode_script(REDEEM_SCRIPT.decode('hex'))
+
+    self.assertEquals(decoded['type'], 'multisig')
+    self.assertEquals(decoded['reqSigs'], 2)
+    self.assertEquals(len(decoded['addresses']), 4)
+    self.assertEquals(decoded['asm'].split()[0], '2')
+    self.assertEquals(decoded['asm'].split()[-2:], ['4', 'OP_CHECKMULTISIG'])
+    # P2SH address is the one the P2SH output script pays to
+    self.assertEquals(decoded['p2sh'], base58check_encode(5, P2SH_SCRIPT_PUBKEY[4:-2].decode('hex')))
+
+  def test_small_pushes_are_numbers(self):
+    self.assertEquals(disassemble('0002e803010051'.decode('hex')), '0 1000 0 1')
+    self.assertEquals(disassemble('0181'.decode('hex')), '-1')
+    self.assertEquals(disassemble('4c05ab'.decode('hex')), '[error]')
+
+  def test_base58check(self):
+    self.assertEquals(base58check_encode(0, '\x00' * 20), '1111111111111111111114oLvT2')
+    self.assertEquals(base58check_decode('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa'),
+        (0, hash160(GENESIS_PUBKEY.decode('hex'))))
+    self.assertRaises(ScriptError, base58check_decode, '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNb')
+
+  def test_build_scripts(self):
+    redeem_script = REDEEM_SCRIPT.decode('hex')
+    pubkeys = [decode_script(redeem_script)['asm'].split()[n].decode('hex') for n in range(1, 5)]
+
+    self.assertEquals(multisig_script(2, pubkeys), redeem_script)
+    self.assertEquals(address_script(script_address(redeem_script)).encode('hex'), P2SH_SCRIPT_PUBKEY)
+
+
+class WalletIndexTests(unittest.TestCase):
+  def setUp(self):
+    self.index = WalletIndex()
+    self.lookups = 0
+
+  def addresses(self):
+    self.lookups += 1
+    return ['1C', '1A', '1B']
+
+  def test_turn_is_position_in_sorted_addresses(self):
+    self.index.update([('1B', '02bb'), ('1X', None)])
+
+    self.assertEquals(self.index.turn('script', self.addresses), 1)
+    self.assertTrue(self.index.pubkey_is_mine('02bb'))
+    self.assertFalse(self.index.is_mine('1A'))
+
+  def test_turn_is_cached_until_keys_change(self):
+    self.index.update([])
+
+    self.assertEquals(self.index.turn('script', self.addresses), -1)
+    self.assertEquals(self.index.turn('script', self.addresses), -1)
+    self.assertEquals(self.lookups, 1)
+
+    self.index.add('1A')
+    self.assertEquals(self.index.turn('script', self.addresses), 0)
+    self.assertEquals(self.lookups, 2)
+
+  def test_stale_until_loaded_and_after_max_age(self):
+    self.assertTrue(self.index.is_stale())
+    self.index.update([])
+    self.assertFalse(self.index.is_stale())
+
+    self.index.loaded_at -= self.index.max_age + 1
+    self.assertTrue(self.index.is_stale())
@@ -0,0 +1,148 @@
+# Local raw transaction decoder
+#
+# Produces the txid, version, locktime, vin and vout fields of bitcoind's
+# decoderawtransaction, so BitcoinClient can validate and inspect
+# transactions without a round-trip to bitcoind
+
+from script import decode_script_pubkey, disassemble, sha256d
+
+import binascii
+import struct
+
+# Input spending this outpoint is a coinbase
+NULL_HASH = '\x00' * 32
+COINBASE_INDEX = 0xffffffff
+
+COIN = 100000000
+
+class TransactionDecodeError(Exception):
+  pass
+
+
+class Reader:
+  def __init__(self, data):
+    self.data = data
+    self.position = 0
+
+  def read(self, size):
+    if self.position + size > len(self.data):
+      raise TransactionDecodeError('unexpected end of transaction')
+    chunk = self.data[self.position:self.position + size]
+    self.position += size
+    return chunk
+
+  def unpack(self, fmt):
+    return struct.unpack(fmt, self.read(struct.calcsize(fmt)))[0]
+
+  def varint(self):
+    n = ord(self.read(1))
+    if n < 0xfd:
+      return n
+    return self.unpack({0xfd: '<H', 0xfe: '<L', 0xff: '<Q'}[n])
+
+  def varbytes(self):
+    return self.read(self.varint())
+
+  def finished(self):
+    return self.position == len(self.data)
+
+
+def read_input(reader):
+  prev_hash = reader.read(32)
+  prev_index = reader.unpack('<L')
+  script = reader.varbytes()
+  sequence = reader.unpack('<L')
+
+  if prev_hash == NULL_HASH and prev_index == COINBASE_INDEX:
+    return {'coinbase': script.encode('hex'), 'sequence': sequence}
+
+  return {
+      'txid': prev_hash[::-1].encode('hex'),
+      'vout': prev_index,
+      'scriptSig': {'asm': disassemble(script), 'hex': script.encode('hex')},
+      'sequence': sequence,
+  }
+
+def read_output(reader, n):
+  value = reader.unpack('<q')
+  script = reader.varbytes()
+  return {
+      'value': value / float(COIN),
+      'n': n,
+      'scriptPubKey': decode_script_pubkey(script),
+  }
+
+def write_varint(n):
+  if n < 0xfd:
+    return chr(n)
+  if n <= 0xffff:
+    return '\xfd' + struct.pack('<H', n)
+  if n <= 0xffffffff:
+    return '\xfe' + struct.pack('<L', n)
+  return '\xff' + struct.pack('<Q', n)
+
+def encode_transaction(inputs, outputs, locktime=0, version=1):
+  """
+  Serializes (txid hex, vout, scriptSig, sequence) inputs and (satoshis,
+  scriptPubKey) outputs into raw transaction hex, without witness data
+  """
+  data = struct.pack('<l', version) + write_varint(len(inputs))
+  for txid, vout, script, sequence in inputs:
+    data += binascii.unhexlify(txid)[::-1] + struct.pack('<L', vout)
+    data += write_varint(len(script)) + script + struct.pack('<L', sequence)
+
+  data += write_varint(len(outputs))
+  for value, script in outputs:
+    data += struct.pack('<q', value) + write_varint(len(script)) + script
+
+  data += struct.pack('<L', locktime)
+  return binascii.hexlify(data)
+
+def decode_transaction(hex_transaction):
+  """
+  Decodes raw transaction hex the way decoderawtransaction does,
+  raises TransactionDecodeError where bitcoind would fail with
+  'TX decode failed'
+  """
+  try:
+    data = binascii.unhexlify(hex_transaction)
+  except (TypeError, ValueError):
+    raise TransactionDecodeError('not a hex string')
+
+  reader = Reader(data)
+  version = reader.unpack('<l')
+
+  # Segregated witness marker and flag
+  witness = False
+  input_count = reader.varint()
+  if input_count == 0:
+    if ord(reader.read(1)) != 1:
+      raise TransactionDecodeError('unknown witness flag')
+    witness = True
+    input_count = reader.varint()
+  inputs_start = 4 + (2 if witness else 0)
+
+  vin = [read_input(reader) for _ in xrange(input_count)]
+  vout = [read_output(reader, n) for n in xrange(reader.varint())]
+  outputs_end = reader.position
+
+  if witness:
+    for tx_input in vin:
+      items = [reader.varbytes().encode('hex') for _ in xrange(reader.varint())]
+      if items:
+        tx_input['txinwitness'] = items
+
+  locktime = reader.unpack('<L')
+  if not reader.finished():
+    raise TransactionDecodeError('trailing data after transaction')
+
+  # txid never covers the witness
+  stripped = data[:4] + data[inputs_start:outputs_end] + data[-4:]
+
+  return {
+      'txid': sha256d(stripped)[::-1].encode('hex'),
+      'version': version,
+      'locktime': locktime,
+      'vin': vin,
+      'vout': vout,
+  }
@@ -0,0 +1,69 @@
+# In-memory index of the wallet's own addresses and pubkeys, so finding
+# our key in a multisig script is a set lookup instead of validateaddress
+# calls for every address
+
+from shared.lru_cache import LRUCache
+
+import threading
+import time
+
+# Turns cached per redeemScript hex
+TURN_CACHE_SIZE = 1024
+# Reloaded after this many seconds, picks up keys added to the wallet
+# outside of this process
+WALLET_INDEX_MAX_AGE = 10 * 60
+
+class WalletIndex:
+  """
+  Own keys as (address, pubkey) pairs. Sets are replaced, never modified,
+  so lookups don't need the lock
+  """
+  def __init__(self, max_age=WALLET_INDEX_MAX_AGE):
+    self.max_age = max_age
+    self.addresses = frozenset()
+    self.pubkeys = frozenset()
+    self.loaded_at = None
+    self.turns = LRUCache(TURN_CACHE_SIZE)
+    self.lock = threading.Lock()
+    # Held while loading, so threads finding the index stale load it once
+    self.load_lock = threading.Lock()
+
+  def is_stale(self):
+    return self.loaded_at is None or time.time() - self.loaded_at > self.max_age
+
+  def invalidate(self):
+    self.loaded_at = None
+
+  def update(self, keys):
+    with self.lock:
+      self.addresses = frozenset(address for address, pubkey in keys)
+      self.pubkeys = frozenset(pubkey for address, pubkey in keys if pubkey)
+      self.turns.clear()
+      self.loaded_at = time.time()
+
+  def add(self, address, pubkey=None):
+    with self.lock:
+      self.addresses = self.addresses | set([address])
+      if pubkey:
+        self.pubkeys = self.pubkeys | set([pubkey])
+      # A new key can give us a turn in scripts we had none in
+      self.turns.clear()
+
+  def is_mine(self, address):
+    return address in self.addresses
+
+  def pubkey_is_mine(self, pubkey):
+    return pubkey in self.pubkeys
+
+  def turn(self, redeem_script, get_addresses):
+    """
+    Position of our address among the sorted addresses of redeem_script,
+    -1 if none of them is ours. get_addresses() is only called on a cache
+    miss, the result is kept until the index changes
+    """
+    def find_turn():
+      for idx, address in enumerate(sorted(get_addresses())):
+        if self.is_mine(address):
+          return idx
+      return -1
+    return self.turns.get_or_create(redeem_script, find_turn)
@@ -0,0 +1,681 @@
+# Local stand-in for bitcoind's JSON-RPC interface
+#
+# Implements the calls BitcoinClient makes on top of an in-memory chain and
+# wallet, so the oracle and its handlers can be run and measured without a
+# real node. Transactions are real serialized transactions. Signatures are
+# fake but deterministic, so partially signed multisig transactions look
+# and count the way they do with bitcoind 0.9 ("0 sig 0 redeemScript").
+#
+# Tests and benchmarks script the chain and inject latency or faults:
+#
+#   server = BitcoindServer(latency=0.005)
+#   server.start()
+#   txid = server.node.fund(address, 1.5)
+#   server.node.mine(6)
+#   server.inject_fault('disconnect', method='getblock')
+#   btc = BitcoinClient(url=server.url)
+#
+# or run standalone and point settings_local at it:
+#
+#   python2 -m shared.bitcoind_server --port 8332 --blocks 100
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from collections import Counter, OrderedDict
+
+from shared.bitcoind_client.script import (
+    OP_0,
+    ScriptError,
+    SCRIPT_ADDRESS_VERSION,
+    address_script,
+    base58check_decode,
+    classify,
+    decode_script,
+    multisig_script,
+    pubkey_address,
+    push_data,
+    script_address,
+    script_ops,
+    sha256d,
+    small_int)
+from shared.bitcoind_client.transaction import (
+    COIN,
+    COINBASE_INDEX,
+    TransactionDecodeError,
+    decode_transaction,
+    encode_transaction)
+
+import argparse
+import base64
+import binascii
+import hashlib
+import json
+import socket
+import struct
+import threading
+import time
+
+# bitcoind error codes
+RPC_MISC_ERROR = -1
+RPC_INVALID_ADDRESS_OR_KEY = -5
+RPC_INVALID_PARAMETER = -8
+RPC_DESERIALIZATION_ERROR = -22
+RPC_VERIFY_REJECTED = -26
+RPC_VERIFY_ALREADY_IN_CHAIN = -27
+RPC_PARSE_ERROR = -32700
+RPC_METHOD_NOT_FOUND = -32601
+
+GENESIS_TIME = 1400000000
+BLOCK_SPACING = 600
+BLOCK_REWARD = 50 * COIN
+
+NULL_TXID = '00' * 32
+
+class RPCError(Exception):
+  def __init__(self, code, message):
+    Exception.__init__(self, message)
+    self.code = code
+    self.message = message
+
+
+def fake_signature(pubkey, sighash):
+  """
+  DER shaped signature only this stand-in can produce and check
+  """
+  r = hashlib.sha256(pubkey + sighash).digest()
+  s = hashlib.sha256(sighash + pubkey).digest()
+  return '\x30\x44\x02\x20' + r + '\x02\x20' + s + '\x01'
+
+def multisig_pubkeys(script):
+  """
+  Returns (reqSigs, pubkeys) of an m-of-n script, None for other scripts
+  """
+  if classify(script)[0] != 'multisig':
+    return None
+  ops = list(script_ops(script))
+  return small_int(ops[0][0]), [data for opcode, data in ops[1:-2]]
+
+def satoshis(amount):
+  return int(round(float(amount) * COIN))
+
+
+class Node:
+  """
+  Chain, mempool and wallet behind the RPC calls. Every rpc_ method is a
+  bitcoind call of the same name
+  """
+  def __init__(self):
+    self.lock = threading.RLock()
+    self.blocks = []
+    self.block_heights = {}
+    self.transactions = {}
+    self.transaction_heights = {}
+    self.mempool = []
+
+    # Address book: own keys (address -> pubkey) and multisig addresses
+    # (address -> redeem script)
+    self.keys = OrderedDict()
+    self.scripts = OrderedDict()
+    self.accounts = {}
+    self.created = 0
+
+    self.mine()
+
+  def unique(self):
+    self.created += 1
+    return struct.pack('<L', self.created)
+
+  # Scripting the chain
+
+  def add_transaction(self, hex_transaction):
+    """
+    Puts a transaction into the mempool without any checks
+    """
+    with self.lock:
+      txid = decode_transaction(hex_transaction)['txid']
+      if not txid in self.transactions:
+        self.transactions[txid] = hex_transaction
+        self.mempool.append(txid)
+      return txid
+
+  def fund(self, address, amount):
+    """
+    Mempool transaction paying amount to address in output 0, out of thin air
+    """
+    with self.lock:
+      tx = encode_transaction(
+          [(NULL_TXID, COINBASE_INDEX, self.unique(), 0xffffffff)],
+          [(satoshis(amount), address_script(address))])
+      return self.add_transaction(tx)
+
+  def mine(self, count=1):
+    """
+    Adds count blocks, the first one takes the mempool. Returns hash of the last one
+    """
+    with self.lock:
+      for _ in range(count):
+        height = len(self.blocks)
+        coinbase = encode_transaction(
+            [(NULL_TXID, COINBASE_INDEX, push_data(struct.pack('<L', height)) + self.unique(), 0xffffffff)],
+            [(BLOCK_REWARD, '\x51')])
+        coinbase_txid = decode_transaction(coinbase)['txid']
+        self.transactions[coinbase_txid] = coinbase
+
+        txids = [coinbase_txid] + self.mempool
+        self.mempool = []
+
+        previous = self.blocks[-1]['hash'] if self.blocks else NULL_TXID
+        block_time = GENESIS_TIME + height * BLOCK_SPACING
+        merkle = sha256d(''.join(txids))
+        header = previous.decode('hex') + merkle + struct.pack('<LL', block_time, height)
+        block_hash = sha256d(header)[::-1].encode('hex')
+
+        self.blocks.append({
+            'hash': block_hash,
+            'height': height,
+            'version': 2,
+            'merkleroot': merkle[::-1].encode('hex'),
+            'tx': txids,
+            'time': block_time,
+            'nonce': 0,
+            'bits': '1d00ffff',
+            'difficulty': 1.0,
+            'previousblockhash': previous if height else None,
+        })
+        self.block_heights[block_hash] = height
+        for txid in txids:
+          self.transaction_heights[txid] = height
+      return self.blocks[-1]['hash']
+
+  def new_key(self, account=''):
+    with self.lock:
+      pubkey = '\x02' + hashlib.sha256('stand-in key' + self.unique()).digest()
+      address = pubkey_address(pubkey)
+      self.keys[address] = pubkey.encode('hex')
+      self.accounts[address] = account
+      return address
+
+  # Signatures
+
+  def sighash(self, decoded, index):
+    inputs = [(vin['txid'], vin['vout'], '', vin['sequence']) for vin in decoded['vin'] if 'txid' in vin]
+    outputs = [(satoshis(vout['value']), vout['scriptPubKey']['hex'].decode('hex')) for vout in decoded['vout']]
+    unsigned = encode_transaction(inputs, outputs, decoded['locktime'], decoded['version'])
+    return sha256d(unsigned.decode('hex') + struct.pack('<L', index))
+
+  def previous_output_script(self, vin):
+    hex_transaction = self.transactions.get(vin['txid'])
+    if hex_transaction is None:
+      return None
+    vouts = decode_transaction(hex_transaction)['vout']
+    if vin['vout'] >= len(vouts):
+      return None
+    return vouts[vin['vout']]['scriptPubKey']
+
+  def signatures_in(self, script_sig, sighash, pubkeys):
+    """
+    Pubkeys with a valid signature in a multisig scriptSig
+    """
+    try:
+      pushes = [data for opcode, data in script_ops(script_sig)]
+    except ScriptError:
+      return set()
+    return set(pubkey for pubkey in pubkeys if fake_signature(pubkey, sighash) in pushes[1:-1])
+
+  def is_signed(self, decoded, index):
+    vin = decoded['vin'][index]
+    if 'coinbase' in vin:
+      return True
+
+    script_sig = vin['scriptSig']['hex'].decode('hex')
+    try:
+      pushes = [data for opcode, data in script_ops(script_sig)]
+    except ScriptError:
+      return False
+    if len(pushes) < 2 or None in pushes:
+      return False
+
+    sighash = self.sighash(decoded, index)
+    multisig = multisig_pubkeys(pushes[-1])
+    if multisig:
+      req_sigs, pubkeys = multisig
+      return len(self.signatures_in(script_sig, sighash, pubkeys)) >= req_sigs
+    return len(pushes) == 2 and pushes[0] == fake_signature(pushes[1], sighash)
+
+  def sign_input(self, decoded, index, redeem_script):
+    """
+    Returns (scriptSig, complete) with our signatures added
+    """
+    vin = decoded['vin'][index]
+    sighash = self.sighash(decoded, index)
+    script_sig = vin['scriptSig']['hex'].decode('hex')
+
+    if redeem_script is None:
+      script_pubkey = self.previous_output_script(vin)
+      if script_pubkey is None:
+        return script_sig, False
+      address = (script_pubkey.get('addresses') or [None])[0]
+      if script_pubkey['type'] == 'scripthash' and address in self.scripts:
+        redeem_script = self.scripts[address].decode('hex')
+      elif script_pubkey['type'] == 'pubkeyhash' and address in self.keys:
+        pubkey = self.keys[address].decode('hex')
+        return push_data(fake_signature(pubkey, sighash)) + push_data(pubkey), True
+      else:
+        return script_sig, self.is_signed(decoded, index)
+
+    multisig = multisig_pubkeys(redeem_script)
+    if not multisig:
+      return script_sig, False
+    req_sigs, pubkeys = multisig
+
+    signed = self.signatures_in(script_sig, sighash, pubkeys)
+    mine = set(self.keys.values())
+    signed |= set(key for key in pubkeys if key.encode('hex') in mine)
+
+    # Signatures in the order of pubkeys, missing ones are OP_0
+    signatures = [fake_signature(key, sighash) for key in pubkeys if key in signed][:req_sigs]
+    slots = [push_data(signature) for signature in signatures]
+    slots += [chr(OP_0)] * (req_sigs - len(slots))
+    return chr(OP_0) + ''.join(slots) + push_data(redeem_script), len(signatures) >= req_sigs
+
+  # RPC calls
+
+  def rpc_help(self, command=None):
+    return 'bitcoind JSON-RPC stand-in'
+
+  def rpc_getinfo(self):
+    return {'version': 90200, 'protocolversion': 70002, 'blocks': self.rpc_getblockcount(),
+        'connections': 0, 'testnet': False, 'errors': ''}
+
+  def rpc_getblockcount(self):
+    return len(self.blocks) - 1
+
+  def rpc_getblockhash(self, height):
+    if not 0 <= height < len(self.blocks):
+      raise RPCError(RPC_INVALID_PARAMETER, 'Block height out of range')
+    return self.blocks[height]['hash']
+
+  def rpc_getblock(self, block_hash, verbose=True):
+    if not block_hash in self.block_heights:
+      raise RPCError(RPC_INVALID_ADDRESS_OR_KEY, 'Block not found')
+    height = self.block_heights[block_hash]
+
+    block = dict(self.blocks[height])
+    block['confirmations'] = len(self.blocks) - height
+    if block['previousblockhash'] is None:
+      del block['previousblockhash']
+    if height + 1 < len(self.blocks):
+      block['nextblockhash'] = self.blocks[height + 1]['hash']
+    return block
+
+  def rpc_getrawtransaction(self, txid, verbose=0):
+    if not txid in self.transactions:
+      raise RPCError(RPC_INVALID_ADDRESS_OR_KEY, 'No information available about transaction')
+    hex_transaction = self.transactions[txid]
+    if not verbose:
+      return hex_transaction
+
+    decoded = decode_transaction(hex_transaction)
+    decoded['hex'] = hex_transaction
+    if txid in self.transaction_heights:
+      height = self.transaction_heights[txid]
+      decoded['blockhash'] = self.blocks[height]['hash']
+      decoded['confirmations'] = len(self.blocks) - height
+    return decoded
+
+  def rpc_decoderawtransaction(self, hex_transaction):
+    try:
+      return decode_transaction(hex_transaction)
+    except TransactionDecodeError:
+      raise RPCError(RPC_DESERIALIZATION_ERROR, 'TX decode failed')
+
+  def rpc_decodescript(self, hex_script):
+    try:
+      script = binascii.unhexlify(hex_script)
+    except (TypeError, ValueError):
+      raise RPCError(RPC_INVALID_PARAMETER, 'argument must be hexadecimal string')
+    return decode_script(script)
+
+  def rpc_createrawtransaction(self, inputs, outputs, locktime=0):
+    tx_inputs = []
+    for tx_input in inputs:
+      if not 'txid' in tx_input or not 'vout' in tx_input:
+        raise RPCError(RPC_INVALID_PARAMETER, 'Invalid parameter, missing txid or vout key')
+      tx_inputs.append((tx_input['txid'], tx_input['vout'], '', 0xffffffff))
+
+    tx_outputs = []
+    for address, amount in outputs.iteritems():
+      try:
+        tx_outputs.append((satoshis(amount), address_script(address)))
+      except ScriptError:
+        raise RPCError(RPC_INVALID_ADDRESS_OR_KEY, 'Invalid Bitcoin address: {}'.format(address))
+    return encode_transaction(tx_inputs, tx_outputs, locktime)
+
+  def multisig(self, req_sigs, keys):
+    pubkeys = []
+    for key in keys:
+      if key in self.keys:
+        key = self.keys[key]
+      try:
+        pubkey = binascii.unhexlify(key)
+      except (TypeError, ValueError):
+        pubkey = ''
+      if not len(pubkey) in (33, 65):
+        raise RPCError(RPC_MISC_ERROR, 'Invalid public key: {}'.format(key))
+      pubkeys.append(pubkey)
+
+    try:
+      return multisig_script(req_sigs, pubkeys)
+    except ScriptError:
+      raise RPCError(RPC_MISC_ERROR, 'a multisignature address must require at least one key '
+          'to redeem, and not more keys than supplied')
+
+  def rpc_createmultisig(self, req_sigs, keys):
+    script = self.multisig(req_sigs, keys)
+    return {'address': script_address(script), 'redeemScript': script.encode('hex')}
+
+  def rpc_addmultisigaddress(self, req_sigs, keys, account=''):
+    script = self.multisig(req_sigs, keys)
+    address = script_address(script)
+    self.scripts[address] = script.encode('hex')
+    self.accounts[address] = account
+    return address
+
+  def rpc_getnewaddress(self, account=''):
+    return self.new_key(account)
+
+  def rpc_validateaddress(self, address):
+    try:
+      version, payload = base58check_decode(address)
+      address_script(address)
+    except ScriptError:
+      return {'isvalid': False}
+
+    result = {'isvalid': True, 'address': address, 'isscript': version == SCRIPT_ADDRESS_VERSION}
+    if address in self.keys:
+      result.update({'ismine': True, 'pubkey': self.keys[address], 'iscompressed': True})
+    elif address in self.scripts:
+      req_sigs, pubkeys = multisig_pubkeys(self.scripts[address].decode('hex'))
+      result['ismine'] = all(pubkey_address(pubkey) in self.keys for pubkey in pubkeys)
+      result['addresses'] = [pubkey_address(pubkey) for pubkey in pubkeys]
+      result['sigsrequired'] = req_sigs
+    else:
+      result['ismine'] = False
+    if address in self.accounts:
+      result['account'] = self.accounts[address]
+    return result
+
+  def rpc_listreceivedbyaddress(self, minconf=1, include_empty=False):
+    received = Counter()
+    confirmations = {}
+    for block in self.blocks:
+      block_confirmations = len(self.blocks) - block['height']
+      if block_confirmations < minconf:
+        break
+      for txid in block['tx']:
+        for vout in decode_transaction(self.transactions[txid])['vout']:
+          for address in vout['scriptPubKey'].get('addresses', []):
+            received[address] += satoshis(vout['value'])
+            confirmations[address] = block_confirmations
+
+    result = []
+    for address in self.keys.keys() + self.scripts.keys():
+      if received[address] or include_empty:
+        result.append({
+            'address': address,
+            'account': self.accounts.get(address, ''),
+            'amount': received[address] / float(COIN),
+            'confirmations': confirmations.get(address, 0),
+        })
+    return result
+
+  def rpc_signrawtransaction(self, hex_transaction, prevtxs=None, privkeys=None, sighashtype='ALL'):
+    if privkeys:
+      raise RPCError(RPC_INVALID_PARAMETER, 'private keys are not supported by the stand-in')
+    decoded = self.rpc_decoderawtransaction(hex_transaction)
+
+    redeem_scripts = {}
+    for prevtx in prevtxs or []:
+      if 'redeemScript' in prevtx:
+        redeem_scripts[(prevtx['txid'], prevtx['vout'])] = prevtx['redeemScript'].decode('hex')
+
+    inputs = []
+    complete = True
+    for index, vin in enumerate(decoded['vin']):
+      script_sig, signed = self.sign_input(decoded, index, redeem_scripts.get((vin['txid'], vin['vout'])))
+      inputs.append((vin['txid'], vin['vout'], script_sig, vin['sequence']))
+      complete = complete and signed
+
+    outputs = [(satoshis(vout['value']), vout['scriptPubKey']['hex'].decode('hex')) for vout in decoded['vout']]
+    return {
+        'hex': encode_transaction(inputs, outputs, decoded['locktime'], decoded['version']),
+        'complete': complete,
+    }
+
+  def rpc_sendrawtransaction(self, hex_transaction, allow_high_fees=False):
+    decoded = self.rpc_decoderawtransaction(hex_transaction)
+    txid = decoded['txid']
+    if txid in self.transaction_heights:
+      raise RPCError(RPC_VERIFY_ALREADY_IN_CHAIN, 'transaction already in block chain')
+
+    for index in range(len(decoded['vin'])):
+      if not self.is_signed(decoded, index):
+        raise RPCError(RPC_VERIFY_REJECTED, '16: mandatory-script-verify-flag-failed')
+    return self.add_transaction(hex_transaction)
+
+  def call(self, method, params):
+    function = getattr(self, 'rpc_' + str(method), None)
+    if function is None:
+      raise RPCError(RPC_METHOD_NOT_FOUND, 'Method not found')
+    with self.lock:
+      try:
+        return function(*params)
+      except TypeError as e:
+        raise RPCError(RPC_MISC_ERROR, str(e))
+
+
+class Fault:
+  """
+  Injected failure of the next times requests calling method (any method
+  if None). Kinds: 'disconnect' closes the connection without a response,
+  'error' fails the call with an RPC error, 'delay' answers after delay
+  seconds
+  """
+  def __init__(self, kind, method=None, times=1, code=RPC_MISC_ERROR, message='injected fault', delay=0):
+    self.kind = kind
+    self.method = method
+    self.times = times
+    self.code = code
+    self.message = message
+    self.delay = delay
+
+  def matches(self, method):
+    return self.method is None or self.method == method
+
+
+class BitcoindRequestHandler(BaseHTTPRequestHandler):
+  # Keep-alive connections, like bitcoind's
+  protocol_version = 'HTTP/1.1'
+
+  def do_POST(self):
+    server = self.server
+    server.count('requests')
+
+    if not self.authorized():
+      self.respond(None, 401)
+      return
+
+    length = int(self.headers.getheader('content-length', 0))
+    try:
+      # Keeps the order of createrawtransaction outputs
+      request = json.loads(self.rfile.read(length), object_pairs_hook=OrderedDict)
+    except ValueError:
+      self.respond(self.error_response(None, RPC_PARSE_ERROR, 'Parse error'), 500)
+      return
+
+    batch = isinstance(request, list)
+    calls = request if batch else [request]
+    methods = [call.get('method') if isinstance(call, dict) else None for call in calls]
+
+    fault = server.take_fault(methods)
+    if fault and fault.kind == 'disconnect':
+      self.close_connection = 1
+      return
+    server.wait(methods, fault)
+
+    responses = [self.execute(call, fault) for call in calls]
+    if batch:
+      self.respond(responses)
+      return
+
+    response = responses[0]
+    code = 200
+    if response['error']:
+      code = 404 if response['error']['code'] == RPC_METHOD_NOT_FOUND else 500
+    self.respond(response, code)
+
+  def execute(self, call, fault):
+    if not isinstance(call, dict):
+      return self.error_response(None, RPC_PARSE_ERROR, 'Invalid request')
+
+    method = call.get('method')
+    self.server.count(method)
+    if fault and fault.kind == 'error' and fault.matches(method):
+      return self.error_response(call.get('id'), fault.code, fault.message)
+
+    try:
+      result = self.server.node.call(method, call.get('params') or [])
+    except RPCError as e:
+      return self.error_response(call.get('id'), e.code, e.message)
+    return {'result': result, 'error': None, 'id': call.get('id')}
+
+  def error_response(self, call_id, code, message):
+    return {'result': None, 'error': {'code': code, 'message': message}, 'id': call_id}
+
+  def authorized(self):
+    if self.server.rpc_user is None:
+      return True
+    credentials = '{}:{}'.format(self.server.rpc_user, self.server.rpc_password)
+    return self.headers.getheader('authorization') == 'Basic ' + base64.b64encode(credentials)
+
+  def respond(self, data, code=200):
+    body = json.dumps(data) if data is not None else ''
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    return
+
+
+class BitcoindServer(ThreadingMixIn, HTTPServer):
+  """
+  Serves a Node over JSON-RPC. Every request waits latency seconds plus
+  method_latency of each call in it, requests run in parallel. Counts
+  connections, requests and calls per method in .stats
+  """
+  daemon_threads = True
+
+  def __init__(self, host='127.0.0.1', port=0, node=None, latency=0, method_latency=None,
+      rpc_user=None, rpc_password=None):
+    HTTPServer.__init__(self, (host, port), BitcoindRequestHandler)
+    self.node = node or Node()
+    self.latency = latency
+    self.method_latency = method_latency or {}
+    self.rpc_user = rpc_user
+    self.rpc_password = rpc_password
+
+    self.lock = threading.Lock()
+    self.faults = []
+    self.stats = Counter()
+    # Keep-alive connections outlive serve_forever, stop() closes them
+    self.open_connections = set()
+
+    self.url = 'http://{}:{}@{}:{}'.format(rpc_user or 'user', rpc_password or 'password', *self.server_address)
+    self.thread = None
+
+  def process_request(self, request, client_address):
+    self.count('connections')
+    with self.lock:
+      self.open_connections.add(request)
+    ThreadingMixIn.process_request(self, request, client_address)
+
+  def shutdown_request(self, request):
+    with self.lock:
+      self.open_connections.discard(request)
+    HTTPServer.shutdown_request(self, request)
+
+  def count(self, name):
+    with self.lock:
+      self.stats[name] += 1
+
+  def inject_fault(self, kind, method=None, times=1, **kwargs):
+    with self.lock:
+      self.faults.append(Fault(kind, method, times, **kwargs))
+
+  def take_fault(self, methods):
+    with self.lock:
+      for fault in self.faults:
+        if any(fault.matches(method) for method in methods):
+          fault.times -= 1
+          if fault.times <= 0:
+            self.faults.remove(fault)
+          return fault
+    return None
+
+  def wait(self, methods, fault):
+    delay = self.latency + sum(self.method_latency.get(method, 0) for method in methods)
+    if fault and fault.kind == 'delay':
+      delay += fault.delay
+    if delay > 0:
+      time.sleep(delay)
+
+  def start(self):
+    """
+    Serves requests in a background thread
+    """
+    self.thread = threading.Thread(target=self.serve_forever, name='bitcoind-server')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    """
+    Stops serving and drops open connections, like a bitcoind that exited
+    """
+    self.shutdown()
+    self.server_close()
+
+    with self.lock:
+      connections = list(self.open_connections)
+      self.open_connections.clear()
+    for connection in connections:
+      try:
+        connection.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        pass
+      connection.close()
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8332)
+  parser.add_argument('--rpcuser')
+  parser.add_argument('--rpcpassword')
+  parser.add_argument('--blocks', type=int, default=0,
+      help='blocks mined on top of the genesis block at start')
+  parser.add_argument('--latency', type=float, default=0,
+      help='seconds every request waits before being answered')
+  args = parser.parse_args()
+
+  server = BitcoindServer(args.host, args.port, latency=args.latency,
+      rpc_user=args.rpcuser, rpc_password=args.rpcpassword)
+  if args.blocks:
+    server.node.mine(args.blocks)
+  print 'bitcoind stand-in at {}:{}, {} blocks'.format(args.host, args.port, server.node.rpc_getblockcount())
+  server.serve_forever()
+
+if __name__=="__main__":
+  main()
@@ -0,0 +1,266 @@
+# Fastcast message body encodings
+#
+# Bodies are JSON by default. The compact encoding is a small binary-safe
+# serializer for the same JSON values, storing hex strings (transactions,
+# scripts, hashes) as raw bytes and optionally compressed with zlib. Compact
+# bodies start with MAGIC and a version byte, so both formats can always be
+# decoded, whichever one the sender used.
+#
+# Senders advertise the highest version they read in ENCODING_FIELD of
+# their bodies. Broadcasts reach every peer, so they're compact only when
+# every peer heard from recently advertised it (see PeerEncodings).
+#
+# Layout: MAGIC, version, flags, then one value. Values are a tag followed by:
+#   N, T, F                 nothing (null, true, false)
+#   i                       zig-zag varint
+#   f                       8 byte big-endian double
+#   u                       varint length, utf-8 bytes
+#   h                       varint length, bytes of a lowercase hex string
+#   l                       varint count, values
+#   d                       varint count, key/value pairs (keys are u values)
+
+import binascii
+import json
+import struct
+import threading
+import time
+import zlib
+
+MAGIC = '\x00fc'
+COMPACT_VERSION = 1
+
+# Body field advertising the highest compact version the sender reads
+ENCODING_FIELD = 'body_encoding'
+# Peers not heard from for this long don't take part in negotiation
+PEER_ENCODING_TTL = 24 * 60 * 60
+
+# Flags byte
+FLAG_ZLIB = 1
+
+# Shorter payloads aren't worth compressing
+COMPRESS_THRESHOLD = 256
+# Shorter hex strings are kept as text, they're rarely hex on purpose
+MIN_HEX_LENGTH = 16
+
+class BodyDecodeError(Exception):
+  pass
+
+def is_compact(body):
+  return body.startswith(MAGIC)
+
+def advertise(obj):
+  """
+  Returns a dict body with our compact version advertised in it
+  """
+  if not isinstance(obj, dict) or ENCODING_FIELD in obj:
+    return obj
+  obj = dict(obj)
+  obj[ENCODING_FIELD] = COMPACT_VERSION
+  return obj
+
+def advertised_version(obj):
+  """
+  Compact version a decoded body advertises, 0 means JSON only
+  """
+  if not isinstance(obj, dict):
+    return 0
+  try:
+    return int(obj.get(ENCODING_FIELD, 0))
+  except (TypeError, ValueError):
+    return 0
+
+
+class PeerEncodings:
+  """
+  Compact versions advertised by fastcast peers, by message source. Read by
+  the broadcaster thread while the main loop records incoming messages
+  """
+  def __init__(self, ttl=PEER_ENCODING_TTL):
+    self.ttl = ttl
+    self.peers = {}
+    self.lock = threading.Lock()
+
+  def seen(self, source, obj, now=None):
+    with self.lock:
+      self.peers[source] = (advertised_version(obj), now or time.time())
+
+  def known(self, source, now=None):
+    """
+    Whether source advertised a compact version recently, only oracles do
+    """
+    now = now or time.time()
+    with self.lock:
+      version, last_seen = self.peers.get(source, (0, 0))
+    return version > 0 and now - last_seen <= self.ttl
+
+  def common_version(self, ignore=None, now=None):
+    """
+    Highest compact version every recent peer reads (except ignore, i.e.
+    ourselves), 0 if it's JSON or we haven't heard from anybody
+    """
+    now = now or time.time()
+    with self.lock:
+      for source, (version, last_seen) in self.peers.items():
+        if now - last_seen > self.ttl:
+          del self.peers[source]
+      versions = [version for source, (version, last_seen) in self.peers.iteritems() if source != ignore]
+
+    if not versions:
+      return 0
+    return min(versions)
+
+def encode_body(obj, compact=False, compress=True):
+  """
+  Encodes a JSON-compatible object as a fastcast body
+  """
+  if not compact:
+    return json.dumps(obj)
+
+  out = []
+  write_value(out, obj)
+  payload = ''.join(out)
+
+  flags = 0
+  if compress and len(payload) >= COMPRESS_THRESHOLD:
+    compressed = zlib.compress(payload)
+    if len(compressed) < len(payload):
+      payload = compressed
+      flags |= FLAG_ZLIB
+
+  return MAGIC + chr(COMPACT_VERSION) + chr(flags) + payload
+
+def decode_body(body):
+  """
+  Decodes a JSON or compact fastcast body
+  """
+  if not is_compact(body):
+    return json.loads(body)
+
+  header = len(MAGIC)
+  if len(body) < header + 2:
+    raise BodyDecodeError('truncated header')
+
+  version, flags = ord(body[header]), ord(body[header + 1])
+  if version > COMPACT_VERSION:
+    raise BodyDecodeError('unsupported compact body version {}'.format(version))
+
+  payload = body[header + 2:]
+  if flags & FLAG_ZLIB:
+    try:
+      payload = zlib.decompress(payload)
+    except zlib.error:
+      raise BodyDecodeError('corrupted compressed body')
+
+  try:
+    obj, position = read_value(payload, 0)
+  except (IndexError, struct.error, UnicodeDecodeError):
+    raise BodyDecodeError('truncated body')
+
+  if position != len(payload):
+    raise BodyDecodeError('trailing data')
+  return obj
+
+def write_varint(out, n):
+  while n >= 0x80:
+    out.append(chr((n & 0x7f) | 0x80))
+    n >>= 7
+  out.append(chr(n))
+
+def read_varint(data, position):
+  n = 0
+  shift = 0
+  while True:
+    byte = ord(data[position])
+    position += 1
+    n |= (byte & 0x7f) << shift
+    if byte < 0x80:
+      return n, position
+    shift += 7
+
+def is_hex(s):
+  if len(s) < MIN_HEX_LENGTH or len(s) % 2:
+    return False
+  try:
+    return binascii.hexlify(binascii.unhexlify(s)) == s
+  except (TypeError, UnicodeEncodeError):
+    return False
+
+def write_value(out, value):
+  if value is None:
+    out.append('N')
+  elif value is True:
+    out.append('T')
+  elif value is False:
+    out.append('F')
+  elif isinstance(value, (int, long)):
+    out.append('i')
+    # zig-zag, so negative numbers stay short
+    write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+  elif isinstance(value, float):
+    out.append('f')
+    out.append(struct.pack('>d', value))
+  elif isinstance(value, basestring):
+    if isinstance(value, unicode):
+      value = value.encode('utf-8')
+    if is_hex(value):
+      out.append('h')
+      value = binascii.unhexlify(value)
+    else:
+      out.append('u')
+    write_varint(out, len(value))
+    out.append(value)
+  elif isinstance(value, (list, tuple)):
+    out.append('l')
+    write_varint(out, len(value))
+    for item in value:
+      write_value(out, item)
+  elif isinstance(value, dict):
+    out.append('d')
+    write_varint(out, len(value))
+    for key, item in value.iteritems():
+      write_value(out, unicode(key))
+      write_value(out, item)
+  else:
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+def read_value(data, position):
+  tag = data[position]
+  position += 1
+
+  if tag == 'N':
+    return None, position
+  if tag == 'T':
+    return True, position
+  if tag == 'F':
+    return False, position
+  if tag == 'i':
+    n, position = read_varint(data, position)
+    return (n >> 1) if not n & 1 else -((n + 1) >> 1), position
+  if tag == 'f':
+    return struct.unpack('>d', data[position:position + 8])[0], position + 8
+  if tag in 'uh':
+    length, position = read_varint(data, position)
+    value = data[position:position + length]
+    if len(value) != length:
+      raise IndexError()
+    position += length
+    if tag == 'h':
+      # Same type json.loads would give
+      return unicode(binascii.hexlify(value)), position
+    return value.decode('utf-8'), position
+  if tag == 'l':
+    count, position = read_varint(data, position)
+    items = []
+    for _ in xrange(count):
+      item, position = read_value(data, position)
+      items.append(item)
+    return items, position
+  if tag == 'd':
+    count, position = read_varint(data, position)
+    obj = {}
+    for _ in xrange(count):
+      key, position = read_value(data, position)
+      obj[key], position = read_value(data, position)
+    return obj, position
+
+  raise BodyDecodeError('unknown tag {!r}'.format(tag))
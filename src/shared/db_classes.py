@@ -1,6 +1,12 @@
 import sqlite3
 
 class GeneralDb:
+  # TableDb classes created by bootstrap_schema
+  tables = []
+  # (version, function(cursor)) pairs, applied in order on top of tables
+  migrations = []
+
+  schema_ready = False
 
   def __init__(self, filename):
     self._filename = filename
@@ -18,6 +24,34 @@ class GeneralDb:
     cursor.execute(sql)
     self.conn.commit()
 
+  def schema_version(self):
+    return self.conn.execute('pragma user_version').fetchone()[0]
+
+  def bootstrap_schema(self):
+    """
+    Creates missing tables and applies pending migrations once, when the
+    database is opened. Schema version is kept in sqlite's user_version.
+    After that TableDb wrappers don't touch sqlite_master at all
+    """
+    version = self.schema_version()
+    cursor = self.conn.cursor()
+
+    if version == 0:
+      for table in self.tables:
+        if not table.table_exists_in(cursor):
+          cursor.execute(table.create_sql.format(table.table_name))
+
+    for migration_version, migration in self.migrations:
+      if migration_version <= version:
+        continue
+      migration(cursor)
+      # pragma doesn't accept parameters
+      cursor.execute('pragma user_version = {0}'.format(int(migration_version)))
+      version = migration_version
+
+    self.conn.commit()
+    self.schema_ready = True
+
   def get_cursor(self):
     if not self.conn:
       self.connect()
@@ -39,16 +73,19 @@ class TableDb(object):
 
   def __init__(self, db):
     self.db = db
-    if not self.table_exists():
+    # Databases with bootstrapped schema already have all their tables
+    if not db.schema_ready and not self.table_exists():
       self.create_table()
 
-  def table_exists(self):
-    cursor = self.db.get_cursor()
-    sql = self.exist_sql.format(self.table_name)
-    cursor = cursor.execute(sql)
-    results = cursor.fetchall()
+  @classmethod
+  def table_exists_in(cls, cursor):
+    sql = cls.exist_sql.format(cls.table_name)
+    results = cursor.execute(sql).fetchall()
     return len(results) > 0
 
+  def table_exists(self):
+    return self.table_exists_in(self.db.get_cursor())
+
   def create_table(self):
     cursor = self.db.get_cursor()
     sql = self.create_sql.format(self.table_name)
@@ -0,0 +1,175 @@
+# Local stand-in for the fastcast gateway
+#
+# Keeps broadcast messages in memory and serves them the same way the
+# gateway does: GET returns {'results': [...], 'next': url, 'cursor': n},
+# POST publishes a message. Supports the parameters used by fastproto
+# transports: since (epoch, inclusive), after + wait (long-poll) and
+# gzip responses. Meant for tests and local development, e.g.
+#
+#   python2 -m shared.fastcast_server --port 8080
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+from collections import Counter
+
+import argparse
+import gzip
+import json
+import threading
+import urllib
+import urlparse
+
+# Messages returned in a single page, the rest is behind 'next'
+PAGE_SIZE = 100
+
+class MessageStore:
+  def __init__(self):
+    self.messages = []
+    self.changed = threading.Condition()
+
+  def add(self, message):
+    with self.changed:
+      self.messages.append(message)
+      self.changed.notify_all()
+
+  def cursor(self):
+    with self.changed:
+      return len(self.messages)
+
+  def wait_after(self, cursor, timeout):
+    """
+    Blocks until there's a message after cursor, or for timeout seconds
+    """
+    with self.changed:
+      if len(self.messages) <= cursor:
+        self.changed.wait(timeout)
+
+  def select(self, since):
+    with self.changed:
+      messages = list(self.messages)
+    if since is None:
+      return messages
+    return [message for message in messages if int(message['epoch']) >= since]
+
+
+class FastcastRequestHandler(BaseHTTPRequestHandler):
+  # Keep-alive connections from the transport's session
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    store = self.server.store
+    params = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+
+    def param(name, convert):
+      if not name in params:
+        return None
+      return convert(params[name][0])
+
+    since = param('since', float)
+    after = param('after', int)
+    wait = param('wait', float)
+    offset = param('offset', int) or 0
+
+    if after is not None and wait:
+      store.wait_after(after, wait)
+
+    # Taken before selecting, so messages arriving meanwhile are after it
+    cursor = store.cursor()
+    messages = store.select(since)
+    page = messages[offset:offset + self.server.page_size]
+
+    next_url = None
+    if offset + len(page) < len(messages):
+      query = {'format': 'json', 'offset': offset + len(page)}
+      if since is not None:
+        query['since'] = since
+      next_url = '{}?{}'.format(self.server.base_url, urllib.urlencode(query))
+
+    self.respond({'results': page, 'next': next_url, 'cursor': cursor})
+
+  def do_POST(self):
+    length = int(self.headers.getheader('content-length', 0))
+    try:
+      message = json.loads(self.rfile.read(length))
+      assert isinstance(message, dict) and 'body' in message and 'epoch' in message
+    except:
+      self.respond({'status': 'error', 'error': 'malformed message'}, 400)
+      return
+
+    self.server.store.add(message)
+    self.respond({'status': 'ok'})
+
+  def respond(self, data, code=200):
+    body = json.dumps(data)
+
+    gzipped = 'gzip' in (self.headers.getheader('accept-encoding') or '')
+    if gzipped:
+      self.server.count('gzipped')
+      buf = StringIO()
+      with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(body)
+      body = buf.getvalue()
+
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    if gzipped:
+      self.send_header('Content-Encoding', 'gzip')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    return
+
+
+class FastcastServer(ThreadingMixIn, HTTPServer):
+  """
+  Counts accepted connections and gzipped responses in .stats
+  """
+  daemon_threads = True
+
+  def __init__(self, host='127.0.0.1', port=0, page_size=PAGE_SIZE):
+    HTTPServer.__init__(self, (host, port), FastcastRequestHandler)
+    self.store = MessageStore()
+    self.page_size = page_size
+    self.base_url = 'http://{}:{}/'.format(*self.server_address)
+    self.url = self.base_url + '?format=json'
+    self.thread = None
+
+    self.lock = threading.Lock()
+    self.stats = Counter()
+
+  def process_request(self, request, client_address):
+    self.count('connections')
+    ThreadingMixIn.process_request(self, request, client_address)
+
+  def count(self, name):
+    with self.lock:
+      self.stats[name] += 1
+
+  def start(self):
+    """
+    Serves requests in a background thread
+    """
+    self.thread = threading.Thread(target=self.serve_forever, name='fastcast-server')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8080)
+  args = parser.parse_args()
+
+  server = FastcastServer(args.host, args.port)
+  print 'fastcast gateway stand-in at {}'.format(server.url)
+  server.serve_forever()
+
+if __name__=="__main__":
+  main()
@@ -3,28 +3,189 @@ import requests
 import base64
 import time
 import datetime
+import multiprocessing
+import os
+import threading
 
+from Crypto import Random
 from Crypto.PublicKey import RSA
 from Crypto.Signature import PKCS1_v1_5
 from Crypto.Hash import SHA256
 
+from lru_cache import LRUCache
+
 import logging
 requests_log = logging.getLogger("requests")
 requests_log.setLevel(logging.WARNING)
 
 FASTCAST_API_URL = 'http://54.77.58.8?format=json'
 
+# Seconds to wait for a connection to the gateway and for its response
+FASTCAST_CONNECT_TIMEOUT = 5
+FASTCAST_READ_TIMEOUT = 30
+# Keep-alive connections kept open to the gateway, per process
+FASTCAST_POOL_SIZE = 4
+# How long the gateway holds a long-poll request when there are no new messages
+FASTCAST_LONG_POLL_WAIT = 25
+# Gateway pages followed in one poll, the rest is fetched by the next poll
+FASTCAST_MAX_PAGES = 50
+
+# Parsed RSA keys, the same few oracles and clients keep talking to us
+KEY_CACHE_SIZE = 256
+verifiers = LRUCache(KEY_CACHE_SIZE)
+signers = LRUCache(KEY_CACHE_SIZE)
+
+# Smaller batches are verified in place, process pool overhead isn't worth it
+PARALLEL_VERIFY_THRESHOLD = 32
+verify_pool = None
+
 headers = {'content-type': 'application/json'}
+
+class FastcastTransport:
+  """
+  Connection to fastcast. fetch returns a page of raw messages as
+  {'results': [...], 'next': page}, where page can be passed back to fetch
+  for the following page, send publishes one message.
+
+  Streaming transports return from fetch as soon as new messages arrive
+  (or after some time with an empty page), so a fetcher can call fetch
+  again right away instead of sleeping between polls
+  """
+  streaming = False
+
+  def fetch(self, since_epoch=None, page=None):
+    raise NotImplementedError()
+
+  def send(self, payload):
+    raise NotImplementedError()
+
+  def close(self):
+    return
+
+
+class PollingTransport(FastcastTransport):
+  """
+  HTTP fastcast gateway. Keeps a session with a pool of keep-alive
+  connections, so polls and broadcasts don't pay for connection setup
+  every time, and asks for gzipped responses. Safe to share between
+  threads, but not between processes
+  """
+  def __init__(self, url=FASTCAST_API_URL, pool_size=FASTCAST_POOL_SIZE,
+      connect_timeout=FASTCAST_CONNECT_TIMEOUT, read_timeout=FASTCAST_READ_TIMEOUT):
+    self.url = url
+    self.timeout = (connect_timeout, read_timeout)
+
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+    self.session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+
+  def get(self, url=None, params=None):
+    r = self.session.get(url or self.url, params=params, timeout=self.timeout)
+    r.raise_for_status()
+    return r.text
+
+  def post(self, payload):
+    r = self.session.post(self.url, data=payload, headers=headers, timeout=self.timeout)
+    r.raise_for_status()
+    return r.text
+
+  def query(self, since_epoch):
+    params = {}
+    if since_epoch is not None:
+      params['since'] = since_epoch
+    return params
+
+  def fetch(self, since_epoch=None, page=None):
+    # 'next' already carries the query parameters
+    if page:
+      return json.loads(self.get(page))
+    return json.loads(self.get(self.url, self.query(since_epoch)))
+
+  def send(self, payload):
+    return self.post(payload)
+
+  def close(self):
+    self.session.close()
+
+
+class LongPollTransport(PollingTransport):
+  """
+  Same gateway, but every response carries the gateway's 'cursor' (sequence
+  number of the last message it received) and the next request for the
+  first page is held open until a message after that cursor arrives, or
+  for `wait` seconds. Messages are then handled as soon as they're broadcast
+  """
+  streaming = True
+
+  def __init__(self, url=FASTCAST_API_URL, wait=FASTCAST_LONG_POLL_WAIT, **kwargs):
+    PollingTransport.__init__(self, url, **kwargs)
+    self.wait = wait
+    self.cursor = None
+    connect_timeout, read_timeout = self.timeout
+    self.timeout = (connect_timeout, read_timeout + wait)
+
+  def query(self, since_epoch):
+    params = PollingTransport.query(self, since_epoch)
+    # Without a cursor (first request) the gateway answers right away
+    if self.cursor is not None:
+      params['after'] = self.cursor
+      params['wait'] = self.wait
+    return params
+
+  def fetch(self, since_epoch=None, page=None):
+    data = PollingTransport.fetch(self, since_epoch, page)
+    if not page and 'cursor' in data:
+      self.cursor = data['cursor']
+    return data
+
+# Transport created by get_transport, e.g. run_oracle.py switches it to LongPollTransport
+transport_class = PollingTransport
+
+transport = None
+transport_pid = None
+transport_lock = threading.Lock()
+
+def set_transport_class(cls):
+  global transport_class, transport
+  with transport_lock:
+    transport_class = cls
+    transport = None
+
+def get_transport():
+  """
+  Returns the transport shared by this process. Forked processes (shards,
+  verify pool) get their own, sockets inherited through fork can't be reused
+  """
+  global transport, transport_pid
+  with transport_lock:
+    if transport is None or transport_pid != os.getpid():
+      transport = transport_class()
+      transport_pid = os.getpid()
+    return transport
+
 def decode_data(data):
         return base64.decodestring(data)
 
 def code_data(data):
         base64.encodestring(data)
 
-def sign(message, priv_b64):
+def import_signer(priv_b64):
   priv = base64.decodestring(priv_b64)
   key = RSA.importKey(priv)
-  signer = PKCS1_v1_5.new(key)
+  return PKCS1_v1_5.new(key)
+
+def import_verifier(pub_b64):
+  pub = base64.decodestring(pub_b64)
+  key = RSA.importKey(pub)
+  return PKCS1_v1_5.new(key)
+
+def key_cache_stats():
+  return {'verifiers': verifiers.stats(), 'signers': signers.stats()}
+
+def sign(message, priv_b64):
+  signer = signers.get_or_create(priv_b64, lambda: import_signer(priv_b64))
 
   digest = SHA256.new()
   digest.update(message)
@@ -34,16 +195,40 @@ def sign(message, priv_b64):
   return base64.encodestring(sign)
 
 def verify(message, signature_b64, pub_b64):
-  pub = base64.decodestring(pub_b64)
   signature = base64.decodestring(signature_b64)
-  key = RSA.importKey(pub)
-  signer = PKCS1_v1_5.new(key)
+  signer = verifiers.get_or_create(pub_b64, lambda: import_verifier(pub_b64))
   digest = SHA256.new()
   digest.update(message)
   if signer.verify(digest, signature):
     return True
   return False
 
+def verify_item(item):
+  message, signature_b64, pub_b64 = item
+  try:
+    return verify(message, signature_b64, pub_b64)
+  except:
+    return False
+
+def get_verify_pool():
+  global verify_pool
+  if verify_pool is None:
+    verify_pool = multiprocessing.Pool(initializer=Random.atfork)
+  return verify_pool
+
+def verify_batch(items):
+  """
+  Verifies a list of (message, signature_b64, pub_b64) and returns a list
+  of booleans in the same order. Large batches (e.g. gateway backlog) are
+  spread over a process pool
+  """
+  if len(items) < PARALLEL_VERIFY_THRESHOLD:
+    return [verify_item(item) for item in items]
+
+  pool = get_verify_pool()
+  chunksize = max(1, len(items) / (multiprocessing.cpu_count() * 4))
+  return pool.map(verify_item, items, chunksize)
+
 def constructMessage(priv, **kwargs):
     """
     Constructing a message, with base64 encoding of body, and signing
@@ -68,41 +253,74 @@ def generateKey():
 
   return (public_key_base64, private_key_base64)
 
-def sendMessage(payload):
+def sendMessage(payload, transport=None):
     """
     Sending a message via api gateway
     """
-    url = 'http://54.77.58.8?format=json'
-    r = requests.post(url, data=payload, headers=headers)
-    print r.text
-    return r.text
-
-def getMessages():
-  url = 'http://54.77.58.8?format=json'
-  r = requests.get(url)
-  data = json.loads(r.text)
+    transport = transport or get_transport()
+    text = transport.send(payload)
+    print text
+    return text
 
-  decoded_results = []
-  for req in data['results']:
-    try:
-      decoded_body = decode_data(req['body'])
-      req['body'] = decoded_body
+def iterMessagePages(since_epoch=None, transport=None, max_pages=FASTCAST_MAX_PAGES):
+  """
+  Yields lists of verified messages, page by page. With since_epoch the gateway
+  is asked only for messages from that epoch on, and anything older is skipped
+  before decoding and verification in case the gateway ignores the cursor.
+  Messages from since_epoch itself are included, epochs only have one second
+  resolution and more messages can arrive within the same second, callers
+  drop the duplicates. Gateway pages are followed through their 'next' links,
+  at most max_pages of them, and paging stops at a page with nothing newer
+  than since_epoch
+  """
+  transport = transport or get_transport()
+  data = transport.fetch(since_epoch)
+  pages = 1
 
-      if not verify(req['body'], req['signature'], req['source']):
+  while True:
+    decoded = []
+    for req in data['results']:
+      try:
+        if since_epoch is not None and int(req['epoch']) < since_epoch:
+          continue
+        req['body'] = decode_data(req['body'])
+      except:
         continue
+      decoded.append(req)
+
+    verified = verify_batch([(req['body'], req.get('signature'), req.get('source')) for req in decoded])
+    yield [req for req, valid in zip(decoded, verified) if valid]
+
+    if not data.get('next'):
+      return
+    if pages > 1 and since_epoch is not None and not any(newer_than(req, since_epoch) for req in data['results']):
+      # Gateway ignores the cursor, the rest is older still. The first
+      # page is always followed, the whole of it can be from since_epoch
+      return
+    if pages >= max_pages:
+      logging.debug('fastcast page limit reached, continuing with the next poll')
+      return
+    data = transport.fetch(since_epoch, data['next'])
+    pages += 1
+
+def newer_than(req, epoch):
+  try:
+    return int(req['epoch']) > epoch
+  except:
+    return False
 
-      decoded_results.append(req)
-    except:
-      continue
+def getMessages(since_epoch=None, transport=None, max_pages=FASTCAST_MAX_PAGES):
+  results = []
+  for page in iterMessagePages(since_epoch, transport, max_pages):
+    results.extend(page)
 
-  data['results'] = decoded_results
-  return data
+  return {'results': results}
 
-def broadcastMessage(body, pub, priv):
+def broadcastMessage(body, pub, priv, transport=None):
   meta_request = {}
   meta_request['source'] = pub
   meta_request['channel'] = 0
   meta_request['epoch'] = time.mktime(datetime.datetime.utcnow().timetuple())
   meta_request['body'] = body
 
-  print sendMessage(constructMessage(priv, **meta_request))
+  print sendMessage(constructMessage(priv, **meta_request), transport)
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+
+import threading
+
+class LRUCache:
+  """
+  Bounded mapping evicting least recently used entries, safe to share
+  between threads. Keeps hit, miss and eviction counters
+  """
+  def __init__(self, size):
+    self.size = size
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key, default=None):
+    with self.lock:
+      if not key in self.entries:
+        self.misses += 1
+        return default
+
+      self.hits += 1
+      # Move to the most recently used end
+      value = self.entries.pop(key)
+      self.entries[key] = value
+      return value
+
+  def put(self, key, value):
+    with self.lock:
+      if key in self.entries:
+        del self.entries[key]
+      self.entries[key] = value
+
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+  def get_or_create(self, key, create):
+    """
+    Returns cached value for key, calling create() on a miss. create runs
+    outside the lock, so two threads can occasionally both create a value
+    """
+    missing = object()
+    value = self.get(key, missing)
+    if value is missing:
+      value = create()
+      self.put(key, value)
+    return value
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def stats(self):
+    with self.lock:
+      return {
+        'size': len(self.entries),
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+      }
@@ -5,3 +5,10 @@ PATH = os.path.dirname(os.path.abspath(__file__))
 LOGGING_ENABLED = True
 LOGGING_PATH = PATH + '/logger.log'
 
+# Decode transactions and scripts locally instead of calling bitcoind
+LOCAL_DECODING = False
+
+# Address version bytes of the bitcoind network, used by local decoding
+# and for worker keys of multisig contracts. Testnet uses 0x6f and 0xc4
+PUBKEY_ADDRESS_VERSION = 0x00
+SCRIPT_ADDRESS_VERSION = 0x05
@@ -0,0 +1,370 @@
+from shared.bitcoind_client import bitcoinclient
+from shared.bitcoind_client.bitcoinclient import (
+    AddressVersionError,
+    BitcoinClient,
+    BitcoindUnavailable,
+    CIRCUIT_FAILURE_THRESHOLD,
+    PooledBitcoinClient)
+from shared.bitcoind_client.script import base58check_encode, hash160
+from shared.bitcoind_server import BitcoindServer
+from shared.body_codec import (
+    COMPACT_VERSION,
+    MAGIC,
+    BodyDecodeError,
+    PeerEncodings,
+    advertise,
+    decode_body,
+    encode_body)
+from shared.fastcast_server import FastcastServer
+from shared.fastproto import (
+    PARALLEL_VERIFY_THRESHOLD,
+    LongPollTransport,
+    PollingTransport,
+    broadcastMessage,
+    generateKey,
+    getMessages,
+    sign,
+    verify_batch)
+
+from xmlrpclib import ProtocolError
+
+import json
+import threading
+import time
+import unittest
+
+class BodyCodecTests(unittest.TestCase):
+  body = {
+      'operation': 'sign',
+      'transaction': '0100000001' + 'ab' * 200,
+      'pwtxid': 'cafe' * 16,
+      'sigs': 2,
+      'fee': -0.5,
+      'name': u'za\u017c\xf3\u0142\u0107',
+      'prevtx': [{'vout': 0, 'redeemScript': None, 'spent': True}],
+  }
+
+  def test_round_trip(self):
+    encoded = encode_body(self.body, compact=True)
+
+    self.assertTrue(encoded.startswith(MAGIC))
+    self.assertEquals(decode_body(encoded), self.body)
+    self.assertEquals(decode_body(encode_body(self.body)), self.body)
+
+  def test_compact_is_smaller(self):
+    self.assertTrue(len(encode_body(self.body, compact=True)) < len(encode_body(self.body)))
+
+  def test_hex_strings(self):
+    body = {
+        'hex': 'ab' * 16,
+        # Not lowercase hex, odd length or too short, kept as text
+        'upper': 'AB' * 16,
+        'odd': 'a' * 17,
+        'short': 'abab',
+        'text': 'g' * 32,
+    }
+    decoded = decode_body(encode_body(body, compact=True))
+
+    self.assertEquals(decoded, body)
+    for value in decoded.itervalues():
+      self.assertTrue(isinstance(value, unicode))
+
+  def test_zlib(self):
+    compressed = encode_body(self.body, compact=True)
+    plain = encode_body(self.body, compact=True, compress=False)
+
+    self.assertTrue(len(compressed) < len(plain))
+    self.assertNotEquals(ord(compressed[len(MAGIC) + 1]), ord(plain[len(MAGIC) + 1]))
+    self.assertEquals(decode_body(compressed), decode_body(plain))
+
+  def test_bad_magic(self):
+    encoded = encode_body(self.body, compact=True)
+    self.assertRaises(ValueError, decode_body, 'x' + encoded[1:])
+
+  def test_bad_version(self):
+    encoded = encode_body(self.body, compact=True)
+    newer = encoded[:len(MAGIC)] + chr(COMPACT_VERSION + 1) + encoded[len(MAGIC) + 1:]
+    self.assertRaises(BodyDecodeError, decode_body, newer)
+
+  def test_truncated(self):
+    encoded = encode_body(self.body, compact=True, compress=False)
+    self.assertRaises(BodyDecodeError, decode_body, encoded[:-3])
+    self.assertRaises(BodyDecodeError, decode_body, encoded[:len(MAGIC) + 1])
+
+  def test_negotiation(self):
+    peers = PeerEncodings(ttl=60)
+    self.assertEquals(peers.common_version(), 0)
+
+    peers.seen('me', advertise({}), now=100)
+    peers.seen('oracle', advertise({'operation': 'sign'}), now=100)
+    self.assertEquals(peers.common_version(ignore='me', now=100), COMPACT_VERSION)
+
+    # A JSON-only client keeps everybody on JSON until it goes quiet
+    peers.seen('client', {'operation': 'sign'}, now=110)
+    self.assertEquals(peers.common_version(ignore='me', now=110), 0)
+    peers.seen('oracle', advertise({}), now=170)
+    self.assertEquals(peers.common_version(ignore='me', now=171), COMPACT_VERSION)
+
+
+class VerifyBatchTests(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.pub, cls.priv = generateKey()
+    cls.other_pub, cls.other_priv = generateKey()
+
+  def items(self, count):
+    # Every third one is signed with someone else's key
+    items = []
+    for number in range(count):
+      body = json.dumps({'number': number})
+      priv = self.other_priv if number % 3 == 0 else self.priv
+      items.append((body, sign(body, priv), self.pub))
+    return items
+
+  def test_parallel_matches_serial(self):
+    items = self.items(PARALLEL_VERIFY_THRESHOLD + 5)
+    expected = [number % 3 != 0 for number in range(len(items))]
+
+    self.assertEquals(verify_batch(items), expected)
+    self.assertEquals(verify_batch(items[:5]), expected[:5])
+
+  def test_malformed_items(self):
+    items = [
+        ('body', 'not a signature', self.pub),
+        ('body', sign('body', self.priv), 'not a key'),
+        ('body', None, self.pub),
+    ]
+    self.assertEquals(verify_batch(items), [False, False, False])
+
+
+class FastcastTransportTests(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.pub, cls.priv = generateKey()
+
+  def setUp(self):
+    self.server = FastcastServer(page_size=2)
+    self.server.start()
+
+  def tearDown(self):
+    self.server.stop()
+
+  def broadcast(self, body, transport=None):
+    broadcastMessage(json.dumps(body), self.pub, self.priv,
+        transport or PollingTransport(self.server.url))
+
+  def test_broadcast_and_fetch(self):
+    transport = PollingTransport(self.server.url)
+    self.broadcast({'operation': 'ping'}, transport)
+
+    results = getMessages(transport=transport)['results']
+    self.assertEquals(len(results), 1)
+    self.assertEquals(json.loads(results[0]['body']), {'operation': 'ping'})
+    self.assertEquals(results[0]['source'], self.pub)
+
+  def test_reuses_connection(self):
+    transport = PollingTransport(self.server.url)
+    for number in range(3):
+      self.broadcast({'number': number}, transport)
+    for _ in range(3):
+      getMessages(transport=transport)
+
+    self.assertEquals(self.server.stats['connections'], 1)
+    self.assertTrue(self.server.stats['gzipped'] >= 3)
+
+  def test_follows_pages(self):
+    for number in range(5):
+      self.broadcast({'number': number})
+
+    results = getMessages(transport=PollingTransport(self.server.url))['results']
+    self.assertEquals(sorted(json.loads(r['body'])['number'] for r in results), range(5))
+
+  def test_caps_pages_per_poll(self):
+    for number in range(5):
+      self.broadcast({'number': number})
+
+    results = getMessages(transport=PollingTransport(self.server.url), max_pages=2)['results']
+    self.assertEquals(len(results), 4)
+
+  def test_skips_messages_before_since_epoch(self):
+    self.broadcast({'number': 0})
+    epoch = int(getMessages(transport=PollingTransport(self.server.url))['results'][0]['epoch'])
+
+    results = getMessages(since_epoch=epoch + 1, transport=PollingTransport(self.server.url))['results']
+    self.assertEquals(results, [])
+
+  def test_skips_invalid_signatures(self):
+    other_pub, other_priv = generateKey()
+    broadcastMessage('{}', self.pub, other_priv, PollingTransport(self.server.url))
+
+    results = getMessages(transport=PollingTransport(self.server.url))['results']
+    self.assertEquals(results, [])
+
+  def test_long_poll_returns_on_new_message(self):
+    transport = LongPollTransport(self.server.url, wait=10)
+    self.assertEquals(getMessages(transport=transport)['results'], [])
+
+    threading.Timer(0.2, self.broadcast, [{'operation': 'sign'}]).start()
+    started = time.time()
+    results = getMessages(transport=transport)['results']
+
+    self.assertEquals(len(results), 1)
+    self.assertTrue(time.time() - started < 5)
+
+  def test_long_poll_times_out_without_messages(self):
+    transport = LongPollTransport(self.server.url, wait=0.5)
+    getMessages(transport=transport)
+
+    self.assertEquals(getMessages(transport=transport)['results'], [])
+
+
+class BitcoindServerTests(unittest.TestCase):
+  def setUp(self):
+    self.server = BitcoindServer()
+    self.server.start()
+    self.node = self.server.node
+    self.btc = BitcoinClient(url=self.server.url)
+
+  def tearDown(self):
+    self.server.stop()
+
+  def multisig_prevtx(self, req_sigs=2):
+    """
+    Funded multisig of two own keys and a foreign one, returns (prevtx, redeem script)
+    """
+    pubkeys = [self.btc.validate_address(self.btc.get_new_address())['pubkey'] for _ in range(2)]
+    pubkeys.append('03' + 'ab' * 32)
+    multisig = self.btc.create_multisig_address(req_sigs, pubkeys)
+    self.btc.add_multisig_address(req_sigs, pubkeys)
+
+    txid = self.node.fund(multisig['address'], 1.0)
+    self.node.mine()
+    prevtx = {'txid': txid, 'vout': 0, 'scriptPubKey': '', 'redeemScript': multisig['redeemScript']}
+    return prevtx, multisig['redeemScript']
+
+  def test_blocks(self):
+    self.node.mine(5)
+
+    self.assertEquals(self.btc.get_block_count(), 5)
+    block = self.btc.get_block(self.btc.get_block_hash(2))
+    self.assertEquals(block['height'], 2)
+    self.assertEquals(block['confirmations'], 4)
+    self.assertEquals(self.btc.get_block_hash(6), None)
+
+  def test_multisig_signing(self):
+    prevtx, redeem_script = self.multisig_prevtx()
+    tx = self.btc.create_raw_transaction([{'txid': prevtx['txid'], 'vout': 0}], {self.btc.get_new_address(): 0.9})
+
+    self.assertEquals(self.btc.signatures_count(tx, [prevtx]), 0)
+    self.assertTrue(self.btc.transaction_need_signature(tx))
+
+    signed = self.btc.sign_transaction(tx, [prevtx])
+    self.assertEquals(self.btc.signatures_count(signed, [prevtx]), 2)
+    self.assertTrue(self.btc.transaction_already_signed(signed, [prevtx]))
+    self.assertFalse(self.btc.transaction_need_signature(signed))
+
+  def test_turn_from_wallet_index(self):
+    prevtx, redeem_script = self.multisig_prevtx()
+    self.btc.load_wallet_index()
+
+    addresses = sorted(self.btc.decode_script(redeem_script)['addresses'])
+    mine = [idx for idx, address in enumerate(addresses) if self.btc.validate_address(address)['ismine']]
+    calls = self.server.stats['validateaddress']
+
+    self.assertEquals(self.btc.get_my_turn(redeem_script), mine[0])
+    self.assertEquals(self.server.stats['validateaddress'], calls)
+
+  def test_local_multisig_address(self):
+    pubkeys = [self.btc.validate_address(self.btc.get_new_address())['pubkey'] for _ in range(3)]
+    requests = self.server.stats['requests']
+
+    self.assertEquals(self.btc.multisig_address(2, pubkeys), self.btc.create_multisig_address(2, pubkeys)['address'])
+    self.assertEquals(self.server.stats['requests'], requests + 1)
+
+  def test_address_versions(self):
+    address = self.btc.get_new_address()
+    pubkey = self.btc.validate_address(address)['pubkey']
+    self.btc.check_address_versions(address, pubkey)
+
+    # Testnet version locally, the stand-in is on mainnet
+    script_address = bitcoinclient.script_address
+    bitcoinclient.script_address = lambda script: base58check_encode(0xc4, hash160(script))
+    try:
+      self.assertRaises(AddressVersionError, self.btc.check_address_versions, address, pubkey)
+    finally:
+      bitcoinclient.script_address = script_address
+
+  def test_decoded_transactions_cached(self):
+    txid = self.node.fund(self.btc.get_new_address(), 1.0)
+    raw_transaction = self.btc.get_raw_transaction(txid)
+
+    decoded = self.btc.decoded_transactions([raw_transaction, '00'])
+    self.assertEquals(decoded[0]['txid'], txid)
+    self.assertEquals(decoded[1], None)
+
+    calls = self.server.stats['decoderawtransaction']
+    self.assertEquals(self.btc.decoded_transactions([raw_transaction]), decoded[:1])
+    self.assertEquals(self.server.stats['decoderawtransaction'], calls)
+
+  def test_batch_is_one_request(self):
+    self.node.mine(2)
+    requests = self.server.stats['requests']
+
+    with self.btc.batch() as batch:
+      futures = [batch.getblockhash(height) for height in range(4)]
+
+    self.assertEquals(self.server.stats['requests'], requests + 1)
+    self.assertEquals(futures[2].result(), self.btc.get_block_hash(2))
+    self.assertRaises(ProtocolError, futures[3].result)
+
+  def test_reconnects_after_disconnect(self):
+    self.server.inject_fault('disconnect', method='getblockcount')
+    self.assertEquals(self.btc.get_block_count(), 0)
+
+  def test_circuit_opens(self):
+    self.server.inject_fault('disconnect', times=100)
+
+    for _ in range(CIRCUIT_FAILURE_THRESHOLD):
+      self.assertRaises(BitcoindUnavailable, self.btc.get_block_count)
+    requests = self.server.stats['requests']
+
+    self.assertRaises(BitcoindUnavailable, self.btc.get_block_count)
+    self.assertEquals(self.server.stats['requests'], requests)
+
+  def test_stopped_server(self):
+    self.assertEquals(self.btc.get_block_count(), 0)
+    port = self.server.server_address[1]
+    self.server.stop()
+
+    self.assertRaises(BitcoindUnavailable, self.btc.get_block_count)
+
+    # bitcoind restarting on the same port
+    self.server = BitcoindServer(port=port, node=self.node)
+    self.server.start()
+    self.assertEquals(self.btc.get_block_count(), 0)
+
+  def test_pool_runs_calls_in_parallel(self):
+    self.server.latency = 0.2
+    btc = PooledBitcoinClient(4, url=self.server.url)
+
+    def call():
+      for _ in range(2):
+        btc.get_block_count()
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    started = time.time()
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    # One connection would need 8 * 0.2s
+    self.assertTrue(time.time() - started < 1.2)
+    self.assertTrue(self.server.stats['connections'] <= 4)
+
+  def test_pool_call_timeout(self):
+    btc = PooledBitcoinClient(1, url=self.server.url, timeout=5)
+    self.server.inject_fault('delay', method='getblockcount', times=2, delay=1)
+
+    with btc.call_timeout(0.2):
+      self.assertRaises(BitcoindUnavailable, btc.get_block_count)
+    self.assertEquals(btc.get_block_count(), 0)
@@ -1,24 +1,65 @@
 #!/usr/bin/env python2.7
-from oracle.tests import OracleTests
-from client.tests import ClientTests
+from oracle.unit_tests import (
+    AdmissionTests,
+    BlockFetcherTests,
+    DedupTests,
+    HandlerRegistryTests,
+    KeyedWorkerPoolTests,
+    MessageFetcherTests,
+    OutboxTests,
+    SchemaTests,
+    ShardPoolTests,
+    TaskQueueTests)
+from shared.bitcoind_client.tests import (
+    ScriptTests,
+    TransactionDecoderTests,
+    WalletIndexTests)
+from shared.tests import (
+    BitcoindServerTests,
+    BodyCodecTests,
+    FastcastTransportTests,
+    VerifyBatchTests)
 
+import sys
 import unittest
 
 TESTS = [
-   OracleTests,
-   ClientTests,
+   AdmissionTests,
+   BlockFetcherTests,
+   DedupTests,
+   MessageFetcherTests,
+   HandlerRegistryTests,
+   SchemaTests,
+   TaskQueueTests,
+   OutboxTests,
+   KeyedWorkerPoolTests,
+   ShardPoolTests,
+   BodyCodecTests,
+   VerifyBatchTests,
+   FastcastTransportTests,
+   BitcoindServerTests,
+   TransactionDecoderTests,
+   ScriptTests,
+   WalletIndexTests,
 ]
 
-def test():
+def legacy_tests():
+  # These don't work currently (bitmessage era modules), run with --legacy
+  from oracle.tests import OracleTests
+  from client.tests import ClientTests
+  return [OracleTests, ClientTests]
+
+def test(test_classes=TESTS):
   suite = []
-  for test_cls in TESTS:
+  for test_cls in test_classes:
     st = unittest.TestLoader().loadTestsFromTestCase(test_cls)
     suite.append(st)
   suite = unittest.TestSuite(suite)
-  unittest.TextTestRunner(verbosity=2).run(suite)
+  return unittest.TextTestRunner(verbosity=2).run(suite)
 
 if __name__=="__main__":
-  print "Our tests doesnt work currently"
-  exit()
-  test()
-
+  test_classes = list(TESTS)
+  if '--legacy' in sys.argv:
+    test_classes += legacy_tests()
+  result = test(test_classes)
+  sys.exit(not result.wasSuccessful())